@@ -0,0 +1,64 @@
+"""Add telemetrydata dedupe index
+
+Revision ID: 1043207a1a90
+Revises: 6f8f50d5741d
+Create Date: 2026-10-18 12:41:05.266310
+
+DESTRUCTIVE: before creating the unique index, this DELETEs every stored
+report that repeats the device_id, timestamp and event_seqnum of an earlier
+one (by id), keeping only the first copy. The deleted rows can't be restored
+by the downgrade. Back up telemetrydata first if the copies matter.
+
+Set TELEMETRY_DEDUPLICATE=false when running it to skip both the DELETE and
+the index; ingest then stores resent reports again. To turn deduplication on
+later, run the statements of upgrade() by hand.
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel.sql.sqltypes
+
+from app.core.config import settings
+
+
+# revision identifiers, used by Alembic.
+revision = '1043207a1a90'
+down_revision = '6f8f50d5741d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if not settings.TELEMETRY_DEDUPLICATE:
+        return
+
+    # Remove the duplicates stored so far, keeping the first copy of each report
+    op.execute("""
+        DELETE FROM telemetrydata t
+        USING (
+            SELECT id, timestamp, row_number() OVER (
+                PARTITION BY device_id, timestamp, event_seqnum ORDER BY id
+            ) AS copy
+            FROM telemetrydata
+            WHERE event_seqnum IS NOT NULL
+        ) d
+        WHERE d.copy > 1 AND t.id = d.id AND t.timestamp = d.timestamp;
+    """)
+
+    # Ingest skips resent reports with ON CONFLICT DO NOTHING. Reports without
+    # an event_seqnum never conflict, NULLs are distinct.
+    op.create_index(
+        'uq_telemetrydata_device_id_timestamp_event_seqnum',
+        'telemetrydata',
+        ['device_id', 'timestamp', 'event_seqnum'],
+        unique=True,
+    )
+
+
+def downgrade():
+    # The index is missing when the upgrade ran without deduplication
+    op.drop_index(
+        'uq_telemetrydata_device_id_timestamp_event_seqnum',
+        table_name='telemetrydata',
+        if_exists=True,
+    )
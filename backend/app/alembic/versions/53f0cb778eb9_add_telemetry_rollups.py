@@ -0,0 +1,100 @@
+"""Add telemetry rollups
+
+Revision ID: 53f0cb778eb9
+Revises: 7e0c4d1cf03e
+Create Date: 2026-10-18 17:12:44.930517
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel.sql.sqltypes
+
+
+# revision identifiers, used by Alembic.
+revision = '53f0cb778eb9'
+down_revision = '7e0c4d1cf03e'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Hourly and daily aggregates per device, kept up to date by TimescaleDB.
+    # The daily rollup is computed from the hourly one. Averages are stored
+    # as sums and counts so rollups can be combined into wider buckets.
+    # Distance and ignition time are estimated from the span of the reports
+    # of each hour, assuming speeds in km/h.
+    #
+    # The views are created empty, as continuous aggregates can only be
+    # filled outside of a transaction, and the existing history is
+    # materialized below. The refresh policies then keep recent buckets up to
+    # date, queries aggregate the buckets above the watermark in real time
+    # and the app refreshes the days of late reports (app.ingest.rollups).
+    op.execute("""
+        CREATE MATERIALIZED VIEW telemetry_hourly
+        WITH (timescaledb.continuous, timescaledb.materialized_only = FALSE) AS
+        SELECT
+            device_id,
+            time_bucket(INTERVAL '1 hour', timestamp) AS bucket,
+            count(*) AS message_count,
+            min(position_speed) AS speed_min,
+            max(position_speed) AS speed_max,
+            sum(position_speed) AS speed_sum,
+            count(position_speed) AS speed_count,
+            last(position_speed, timestamp) AS speed_last,
+            (coalesce(avg(position_speed), 0)
+                * EXTRACT(EPOCH FROM max(timestamp) - min(timestamp)) / 3600
+            )::double precision AS distance_km,
+            (EXTRACT(EPOCH FROM max(timestamp) - min(timestamp))
+                * sum(CASE WHEN engine_ignition_status THEN 1 ELSE 0 END)
+                / count(*)
+            )::double precision AS ignition_on_seconds
+        FROM telemetrydata
+        GROUP BY device_id, bucket
+        WITH NO DATA;
+    """)
+    op.execute("""
+        CREATE MATERIALIZED VIEW telemetry_daily
+        WITH (timescaledb.continuous, timescaledb.materialized_only = FALSE) AS
+        SELECT
+            device_id,
+            time_bucket(INTERVAL '1 day', bucket) AS bucket,
+            sum(message_count)::bigint AS message_count,
+            min(speed_min) AS speed_min,
+            max(speed_max) AS speed_max,
+            sum(speed_sum) AS speed_sum,
+            sum(speed_count)::bigint AS speed_count,
+            last(speed_last, bucket) AS speed_last,
+            sum(distance_km) AS distance_km,
+            sum(ignition_on_seconds) AS ignition_on_seconds
+        FROM telemetry_hourly
+        GROUP BY device_id, time_bucket(INTERVAL '1 day', bucket)
+        WITH NO DATA;
+    """)
+    op.execute("""
+        SELECT add_continuous_aggregate_policy('telemetry_hourly',
+            start_offset => INTERVAL '3 days',
+            end_offset => INTERVAL '1 hour',
+            schedule_interval => INTERVAL '30 minutes');
+    """)
+    op.execute("""
+        SELECT add_continuous_aggregate_policy('telemetry_daily',
+            start_offset => INTERVAL '7 days',
+            end_offset => INTERVAL '1 day',
+            schedule_interval => INTERVAL '1 hour');
+    """)
+    with op.get_context().autocommit_block():
+        op.execute("""
+            CALL refresh_continuous_aggregate('telemetry_hourly', NULL, NULL);
+        """)
+        op.execute("""
+            CALL refresh_continuous_aggregate('telemetry_daily', NULL, NULL);
+        """)
+
+
+def downgrade():
+    op.execute("""
+        DROP MATERIALIZED VIEW IF EXISTS telemetry_daily;
+    """)
+    op.execute("""
+        DROP MATERIALIZED VIEW IF EXISTS telemetry_hourly;
+    """)
@@ -0,0 +1,32 @@
+"""Add spoolcheckpoint
+
+Revision ID: 6f8f50d5741d
+Revises: b7fbe80cc4a0
+Create Date: 2026-10-18 11:02:17.514093
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel.sql.sqltypes
+
+
+# revision identifiers, used by Alembic.
+revision = '6f8f50d5741d'
+down_revision = 'b7fbe80cc4a0'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Replay position of each ingest spool segment, committed together with
+    # the telemetry rows replayed from it
+    op.create_table('spoolcheckpoint',
+        sa.Column('segment', sqlmodel.sql.sqltypes.AutoString(length=255), nullable=False),
+        sa.Column('position', sa.BigInteger(), nullable=False),
+        sa.Column('updated_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('segment')
+    )
+
+
+def downgrade():
+    op.drop_table('spoolcheckpoint')
@@ -0,0 +1,32 @@
+"""Add telemetrydata timestamp id index
+
+Revision ID: 7e0c4d1cf03e
+Revises: fc294f0e0d91
+Create Date: 2026-10-18 16:31:07.482915
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel.sql.sqltypes
+
+
+# revision identifiers, used by Alembic.
+revision = '7e0c4d1cf03e'
+down_revision = 'fc294f0e0d91'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Reads page by (timestamp, id) in either direction. The index ends the
+    # sort on the id tie breaker, so a page is an index range scan from the
+    # cursor position on every chunk.
+    op.create_index(
+        'ix_telemetrydata_timestamp_id',
+        'telemetrydata',
+        ['timestamp', 'id'],
+    )
+
+
+def downgrade():
+    op.drop_index('ix_telemetrydata_timestamp_id', table_name='telemetrydata')
@@ -0,0 +1,50 @@
+"""Add unique index on device.provider_device_id
+
+The upgrade fails, without changing anything, if several devices share a
+provider_device_id. Those devices own telemetry, so they are not merged
+automatically: reassign or delete the duplicates, then upgrade again.
+
+Revision ID: b7fbe80cc4a0
+Revises: 70e453fcaef5
+Create Date: 2026-10-18 09:12:41.318204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel.sql.sqltypes
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7fbe80cc4a0'
+down_revision = '70e453fcaef5'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    duplicates = op.get_bind().execute(sa.text("""
+        SELECT provider_device_id, count(*)
+        FROM device
+        WHERE provider_device_id IS NOT NULL
+        GROUP BY provider_device_id
+        HAVING count(*) > 1
+        ORDER BY provider_device_id
+        """)).all()
+    if duplicates:
+        listed = ', '.join(f'{value!r} ({count})' for value, count in duplicates[:10])
+        raise RuntimeError(
+            f'{len(duplicates)} provider_device_id values are shared by several '
+            f'devices, resolve them before creating the unique index: {listed}'
+        )
+    # Ingest resolves devices with INSERT ... ON CONFLICT (provider_device_id),
+    # which requires a unique index on the conflict target
+    op.create_index(
+        op.f('ix_device_provider_device_id'),
+        'device',
+        ['provider_device_id'],
+        unique=True,
+    )
+
+
+def downgrade():
+    op.drop_index(op.f('ix_device_provider_device_id'), table_name='device')
@@ -0,0 +1,73 @@
+"""Add device_state
+
+Revision ID: c3144bdc5b08
+Revises: 1043207a1a90
+Create Date: 2026-10-18 14:26:41.803117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel.sql.sqltypes
+
+
+# revision identifiers, used by Alembic.
+revision = 'c3144bdc5b08'
+down_revision = '1043207a1a90'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # The last known state of devices is rewritten by every report. It lives
+    # in a narrow table with free space in every page and no index on the
+    # updated columns, so updates are HOT and the device table stays small.
+    op.create_table('device_state',
+        sa.Column('device_id', sa.Uuid(), nullable=False),
+        sa.Column('last_online_timestamp', sa.DateTime(), nullable=True),
+        sa.Column('last_reported_latitude', sa.Float(), nullable=True),
+        sa.Column('last_reported_longitude', sa.Float(), nullable=True),
+        sa.Column('last_reported_speed', sa.Float(), nullable=True),
+        sa.Column('engine_ignition_status', sa.Boolean(), nullable=True),
+        sa.Column('is_online', sa.Boolean(), nullable=False),
+        sa.ForeignKeyConstraint(['device_id'], ['device.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('device_id')
+    )
+    op.execute(
+        'ALTER TABLE device_state SET ('
+        'fillfactor = 50, autovacuum_vacuum_scale_factor = 0.01)'
+    )
+    op.execute(
+        """
+        INSERT INTO device_state (
+            device_id, last_online_timestamp, last_reported_latitude,
+            last_reported_longitude, is_online
+        )
+        SELECT id, last_online_timestamp, last_reported_latitude,
+            last_reported_longitude, is_online
+        FROM device
+        """
+    )
+    op.drop_column('device', 'last_online_timestamp')
+    op.drop_column('device', 'last_reported_latitude')
+    op.drop_column('device', 'last_reported_longitude')
+    op.drop_column('device', 'is_online')
+
+
+def downgrade():
+    op.add_column('device', sa.Column('is_online', sa.Boolean(), server_default=sa.true(), nullable=False))
+    op.add_column('device', sa.Column('last_reported_longitude', sa.Float(), nullable=True))
+    op.add_column('device', sa.Column('last_reported_latitude', sa.Float(), nullable=True))
+    op.add_column('device', sa.Column('last_online_timestamp', sa.DateTime(), nullable=True))
+    op.execute(
+        """
+        UPDATE device
+        SET last_online_timestamp = device_state.last_online_timestamp,
+            last_reported_latitude = device_state.last_reported_latitude,
+            last_reported_longitude = device_state.last_reported_longitude,
+            is_online = device_state.is_online
+        FROM device_state
+        WHERE device_state.device_id = device.id
+        """
+    )
+    op.alter_column('device', 'is_online', server_default=None)
+    op.drop_table('device_state')
@@ -0,0 +1,95 @@
+"""Store telemetrydata raw_data as jsonb
+
+Revision ID: d883d5a86dc7
+Revises: c3144bdc5b08
+Create Date: 2026-10-18 15:08:52.361940
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel.sql.sqltypes
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'd883d5a86dc7'
+down_revision = 'c3144bdc5b08'
+branch_labels = None
+depends_on = None
+
+
+def _disable_compression():
+    # Column types can't change while the hypertable is compressed
+    op.execute("""
+        SELECT remove_compression_policy('telemetrydata', if_exists => TRUE);
+    """)
+    op.execute("""
+        DO $$
+        DECLARE
+            r RECORD;
+        BEGIN
+            FOR r IN (SELECT show_chunks('telemetrydata')) LOOP
+                EXECUTE 'SELECT decompress_chunk(' || quote_literal(r.show_chunks) || ', TRUE);';
+            END LOOP;
+        END $$;
+    """)
+    op.execute("""
+        ALTER TABLE telemetrydata SET (timescaledb.compress = FALSE);
+    """)
+
+
+def _enable_compression():
+    op.execute("""
+        ALTER TABLE telemetrydata SET (
+            timescaledb.compress,
+            timescaledb.compress_segmentby = 'device_id'
+        );
+    """)
+    op.execute("""
+        SELECT add_compression_policy('telemetrydata', INTERVAL '90 days');
+    """)
+
+
+def upgrade():
+    _disable_compression()
+
+    op.alter_column('telemetrydata', 'raw_data',
+                    type_=postgresql.JSONB(),
+                    existing_type=sa.JSON(),
+                    existing_nullable=True,
+                    postgresql_using='raw_data::jsonb')
+
+    # Large values are TOASTed with lz4 where the server was built with it,
+    # otherwise the default pglz is kept
+    op.execute("""
+        DO $$
+        BEGIN
+            IF current_setting('server_version_num')::int >= 140000 THEN
+                ALTER TABLE telemetrydata ALTER COLUMN raw_data SET COMPRESSION lz4;
+            END IF;
+        EXCEPTION WHEN feature_not_supported OR invalid_parameter_value THEN
+            RAISE NOTICE 'lz4 compression is not available, keeping pglz';
+        END $$;
+    """)
+
+    _enable_compression()
+
+
+def downgrade():
+    _disable_compression()
+
+    op.execute("""
+        DO $$
+        BEGIN
+            IF current_setting('server_version_num')::int >= 140000 THEN
+                ALTER TABLE telemetrydata ALTER COLUMN raw_data SET COMPRESSION default;
+            END IF;
+        END $$;
+    """)
+    op.alter_column('telemetrydata', 'raw_data',
+                    type_=sa.JSON(),
+                    existing_type=postgresql.JSONB(),
+                    existing_nullable=True,
+                    postgresql_using='raw_data::json')
+
+    _enable_compression()
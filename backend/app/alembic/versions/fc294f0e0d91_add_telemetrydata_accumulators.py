@@ -0,0 +1,30 @@
+"""Add telemetrydata accumulators
+
+Revision ID: fc294f0e0d91
+Revises: d883d5a86dc7
+Create Date: 2026-10-18 15:47:19.024586
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel.sql.sqltypes
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'fc294f0e0d91'
+down_revision = 'd883d5a86dc7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Accumulators packed in one array, written instead of the accumulator_N
+    # columns with TELEMETRY_ACCUMULATORS=array. Rows written before keep
+    # their columns, reads take the array value first. Adding a nullable
+    # column works on compressed chunks too.
+    op.add_column('telemetrydata', sa.Column('accumulators', postgresql.ARRAY(sa.Float()), nullable=True))
+
+
+def downgrade():
+    op.drop_column('telemetrydata', 'accumulators')
@@ -8,14 +8,17 @@ from typing import Any
 
 from fastapi import APIRouter, HTTPException
 from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
 from sqlmodel import select
 
 from app.api.deps import CurrentUser, SessionDep
+from app.ingest.devices import device_cache, notify_devices_changed
 from app.models import (
     Device,
     DeviceCreate,
     DevicePublic,
     DevicesPublic,
+    DeviceState,
     DeviceUpdate,
     Message,
 )
@@ -23,6 +26,12 @@ from app.models import (
 router = APIRouter()
 
 
+def _device_public(device: Device, state: DeviceState | None) -> DevicePublic:
+    """Merge a device and its last known state into the API representation"""
+    update = state.model_dump(exclude={"device_id"}) if state is not None else {}
+    return DevicePublic.model_validate(device, update=update)
+
+
 @router.get("/", response_model=DevicesPublic)
 def read_devices(
     session: SessionDep, current_user: CurrentUser, skip: int = 0, limit: int = 100
@@ -34,7 +43,9 @@ def read_devices(
     if current_user.is_superuser:
         count_statement = select(func.count()).select_from(Device)
         count = session.exec(count_statement).one()
-        statement = select(Device).offset(skip).limit(limit)
+        statement = (
+            select(Device, DeviceState).outerjoin(DeviceState).offset(skip).limit(limit)
+        )
         devices = session.exec(statement).all()
     else:
         count_statement = (
@@ -44,14 +55,18 @@ def read_devices(
         )
         count = session.exec(count_statement).one()
         statement = (
-            select(Device)
+            select(Device, DeviceState)
+            .outerjoin(DeviceState)
             .where(Device.owner_id == current_user.id)
             .offset(skip)
             .limit(limit)
         )
         devices = session.exec(statement).all()
 
-    return DevicesPublic(data=devices, count=count)
+    return DevicesPublic(
+        data=[_device_public(device, state) for device, state in devices],
+        count=count,
+    )
 
 
 @router.get("/{id}", response_model=DevicePublic)
@@ -64,7 +79,7 @@ def read_device(session: SessionDep, current_user: CurrentUser, id: uuid.UUID) -
         raise HTTPException(status_code=404, detail="Device not found")
     if not current_user.is_superuser and (device.owner_id != current_user.id):
         raise HTTPException(status_code=400, detail="Not enough permissions")
-    return device
+    return _device_public(device, device.state)
 
 
 @router.post("/", response_model=DevicePublic)
@@ -75,13 +90,23 @@ def create_device(
     Create new device.
     """
     device = Device.model_validate(device_in, update={"owner_id": current_user.id})
+    state = DeviceState.model_validate(device_in, update={"device_id": device.id})
     # Set last_online_timestamp to current time if not provided
-    if device.last_online_timestamp is None:
-        device.last_online_timestamp = datetime.now(timezone.utc)
+    if state.last_online_timestamp is None:
+        state.last_online_timestamp = datetime.now(timezone.utc)
+    device.state = state
     session.add(device)
-    session.commit()
+    session.execute(notify_devices_changed([(device.provider_device_id, None)]))
+    try:
+        session.commit()
+    except IntegrityError:
+        session.rollback()
+        raise HTTPException(
+            status_code=409,
+            detail="Device with this provider_device_id already exists",
+        )
     session.refresh(device)
-    return device
+    return _device_public(device, device.state)
 
 
 @router.put("/{id}", response_model=DevicePublic)
@@ -103,9 +128,11 @@ def update_device(
     update_dict = device_in.model_dump(exclude_unset=True)
     device.sqlmodel_update(update_dict)
     session.add(device)
+    session.execute(notify_devices_changed([(device.provider_device_id, None)]))
     session.commit()
     session.refresh(device)
-    return device
+    device_cache.invalidate(device.provider_device_id)
+    return _device_public(device, device.state)
 
 
 @router.delete("/{id}")
@@ -120,6 +147,9 @@ def delete_device(
         raise HTTPException(status_code=404, detail="Device not found")
     if not current_user.is_superuser and (device.owner_id != current_user.id):
         raise HTTPException(status_code=400, detail="Not enough permissions")
+    provider_device_id = device.provider_device_id
     session.delete(device)
+    session.execute(notify_devices_changed([(provider_device_id, None)]))
     session.commit()
+    device_cache.invalidate(provider_device_id)
     return Message(message="Device deleted successfully")
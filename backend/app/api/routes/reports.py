@@ -4,158 +4,144 @@ It includes endpoints for receiving and storing telemetry reports and
 retrieving telemetry data from the database.
 """
 
-from datetime import datetime
-from datetime import timezone as tz
-from typing import Any
+import base64
+import csv
+import io
+import uuid
+from collections.abc import AsyncIterator, Callable, Container, Sequence
+from datetime import datetime, timedelta, timezone
+from functools import partial
+from typing import Annotated, Any, Literal, NamedTuple
 
-from fastapi import APIRouter, HTTPException, Query, Request
-from sqlalchemy import exc
-from sqlmodel import Session, select
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
+from sqlalchemy import (
+    BigInteger,
+    Column,
+    ColumnElement,
+    DateTime,
+    Float,
+    MetaData,
+    Row,
+    Table,
+    Uuid,
+    and_,
+    cast,
+    exc,
+    func,
+    literal_column,
+    or_,
+    select,
+)
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncResult
+from sqlmodel import col
+from starlette.background import BackgroundTask
 
+from app.api.deps import AsyncSessionDep, get_current_active_superuser
+from app.core import arrow, jsonlib
 from app.core.config import settings
-from app.core.db import engine
-from app.models import Device, TelemetryData, User
+from app.core.db import async_engine
+from app.ingest.mapping import ACCUMULATOR_COLUMNS
+from app.ingest.parsing import (
+    PayloadTooLargeError,
+    UnsupportedEncodingError,
+    UnsupportedMediaTypeError,
+    decode_body,
+    iter_row_chunks,
+    media_type,
+)
+from app.ingest.pipeline import IngestUnavailableError, store_rows
+from app.ingest.queue import ingest_queue
+from app.ingest.rollups import ROLLUPS, Rollup, is_current
+from app.ingest.spool import ingest_spool
+from app.models import IngestQueueStats, TelemetryData, TelemetryDataPublic
 
 router = APIRouter()
 
+_TELEMETRY_TABLE = TelemetryData.__table__  # type: ignore[attr-defined]
 
-def convert_timestamp(timestamp: float | None) -> datetime | None:
-    """Convert a Unix timestamp to a datetime object"""
-    if timestamp is not None:
-        return datetime.fromtimestamp(timestamp, tz.utc)
-    return None
 
+def _public_column(name: str) -> ColumnElement[Any]:
+    column: ColumnElement[Any] = _TELEMETRY_TABLE.c[name]
+    if name in ACCUMULATOR_COLUMNS:
+        # Rows written with packed accumulators leave the columns null
+        packed = _TELEMETRY_TABLE.c.accumulators[ACCUMULATOR_COLUMNS.index(name) + 1]
+        column = func.coalesce(packed, column).label(name)
+    return column
 
-def validate_report(report: dict[str, Any]) -> None:
-    """Validate a report dictionary"""
-    required_fields = ["timestamp", "server.timestamp", "device.id"]
-    missing_fields = [field for field in required_fields if not report.get(field)]
-    if missing_fields:
-        raise ValueError(f"Missing required fields: {', '.join(missing_fields)}")
 
+# Columns of TelemetryDataPublic by name, with packed accumulators unpacked
+_PUBLIC_COLUMNS = {
+    name: _public_column(name) for name in TelemetryDataPublic.model_fields
+}
 
-@router.post("/reports/")
-async def receive_report(request: Request) -> dict[str, str]:
-    """Receive a report from a streaming telemetry source"""
+# Fields returned when none are requested, raw_data only on request
+_DEFAULT_FIELDS = [name for name in _PUBLIC_COLUMNS if name != "raw_data"]
+
+# Order of pages by timestamp and id, descending or not
+_ORDER_BY = {
+    True: (_TELEMETRY_TABLE.c.timestamp.desc(), _TELEMETRY_TABLE.c.id.desc()),
+    False: (_TELEMETRY_TABLE.c.timestamp.asc(), _TELEMETRY_TABLE.c.id.asc()),
+}
+
+
+# Numeric fields that can be aggregated
+_AGGREGATE_FIELDS = [
+    name for name, column in _PUBLIC_COLUMNS.items() if isinstance(column.type, Float)
+]
+
+
+def _parse_fields(
+    fields: str | None,
+    allowed: Container[str] = _PUBLIC_COLUMNS,
+    default: list[str] = _DEFAULT_FIELDS,
+) -> list[str]:
+    """Return the requested fields of a comma separated list"""
+    if not fields:
+        return default
+    names = list(dict.fromkeys(name.strip() for name in fields.split(",")))
+    unknown = [name for name in names if name not in allowed]
+    if unknown:
+        raise HTTPException(
+            status_code=400, detail=f"Unknown fields: {', '.join(unknown)}"
+        )
+    return names
+
+
+def _encode_cursor(row: Row[Any], order: str, backward: bool) -> str:
+    timestamp = row.timestamp
+    position = [timestamp.isoformat() if timestamp else None, row.id]
+    payload = jsonlib.dumps([*position, order, backward])
+    return base64.urlsafe_b64encode(payload).decode().rstrip("=")
+
+
+def _decode_cursor(cursor: str, order: str) -> tuple[tuple[datetime, int], bool]:
+    """Return the position and direction of a cursor"""
     try:
-        reports_json = await request.json()
-        # Ensure reports is a list
-        if isinstance(reports_json, dict):
-            reports: list[dict[str, Any]] = [reports_json]
-        else:
-            reports = reports_json
-
-        telemetry_data_list: list[TelemetryData] = []
-
-        with Session(engine) as session:
-            for report in reports:
-                validate_report(report)
-
-                # Fetch the device using the provider_device_id from the report
-                provider_device_id = report.get("device.id")
-                device_result = session.exec(
-                    select(Device)
-                    .where(Device.provider_device_id == provider_device_id)
-                    .limit(1)
-                )
-                device: Device | None = device_result.first()
-
-                if device is None:
-                    user = session.exec(
-                        select(User).where(User.email == settings.FIRST_SUPERUSER)
-                    ).first()
-
-                    if user is None:
-                        raise ValueError("Superuser not found")
-
-                    # CREATE A NEW DEVICE
-                    device = Device(
-                        provider_device_id=provider_device_id,
-                        device_name=report.get("device.name", ""),
-                        last_online_timestamp=convert_timestamp(
-                            report.get("timestamp")
-                        ),
-                        owner_id=user.id,
-                        last_reported_latitude=report.get("position.latitude"),
-                        last_reported_longitude=report.get("position.longitude"),
-                    )
-                    session.add(device)
-                    session.commit()
-                    session.refresh(device)
-
-                else:
-                    # UPDATE EXISTING DEVICE
-                    device.last_online_timestamp = convert_timestamp(
-                        report.get("timestamp")
-                    )
-                    device.last_reported_latitude = report.get("position.latitude")
-                    device.last_reported_longitude = report.get("position.longitude")
-                    session.add(device)
-                    session.commit()
-
-                telemetry_data = TelemetryData(
-                    storage_server_timestamp_utc=datetime.now(tz.utc),
-                    ident=str(report.get("ident", "unknown_device")),
-                    position_altitude=report.get("position.altitude"),
-                    position_hdop=report.get("position.hdop"),
-                    position_latitude=report.get("position.latitude"),
-                    position_longitude=report.get("position.longitude"),
-                    position_satellites=report.get("position.satellites"),
-                    server_timestamp=convert_timestamp(report.get("server.timestamp")),
-                    timestamp=convert_timestamp(report.get("timestamp")),
-                    device_type_id=report.get("device.type.id"),
-                    channel_id=report.get("channel.id"),
-                    protocol_id=report.get("protocol.id"),
-                    engine_ignition_status=report.get("engine.ignition.status", False),
-                    provider_device_id=report.get("device.id"),
-                    device_name=report.get("device.name"),
-                    din=report.get("din"),
-                    event_enum=report.get("event.enum"),
-                    event_seqnum=report.get("event.seqnum"),
-                    gnss_antenna_status=report.get("gnss.antenna.status"),
-                    gsm_network_roaming_status=report.get("gsm.network.roaming.status"),
-                    message_type_enum=report.get("message.type.enum"),
-                    peer=report.get("peer"),
-                    position_direction=report.get("position.direction"),
-                    position_speed=report.get("position.speed"),
-                    position_valid=report.get("position.valid"),
-                    timestamp_key=report.get("timestamp.key"),
-                    accumulator_0=report.get("accumulator.0"),
-                    accumulator_1=report.get("accumulator.1"),
-                    accumulator_2=report.get("accumulator.2"),
-                    accumulator_3=report.get("accumulator.3"),
-                    accumulator_4=report.get("accumulator.4"),
-                    accumulator_5=report.get("accumulator.5"),
-                    accumulator_6=report.get("accumulator.6"),
-                    accumulator_7=report.get("accumulator.7"),
-                    accumulator_8=report.get("accumulator.8"),
-                    accumulator_9=report.get("accumulator.9"),
-                    accumulator_10=report.get("accumulator.10"),
-                    accumulator_11=report.get("accumulator.11"),
-                    accumulator_12=report.get("accumulator.12"),
-                    accumulator_13=report.get("accumulator.13"),
-                    accumulator_14=report.get("accumulator.14"),
-                    accumulator_15=report.get("accumulator.15"),
-                    raw_data=report,
-                    device_id=device.id,
-                )
-                telemetry_data_list.append(telemetry_data)
-
-        with Session(engine) as session:
-            session.bulk_save_objects(telemetry_data_list)
-            session.commit()
-
-        return {"status": "success", "message": f"{len(reports)} reports processed"}
-    except exc.SQLAlchemyError as e:
-        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}") from e
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=str(e)) from e
+        payload = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        timestamp, row_id, cursor_order, backward = jsonlib.loads(payload)
+        position = (datetime.fromisoformat(timestamp), int(row_id))
+    except (ValueError, TypeError) as e:
+        raise HTTPException(status_code=400, detail="Invalid cursor") from e
+    if cursor_order != order:
+        raise HTTPException(status_code=400, detail="Cursor is for another order")
+    return position, bool(backward)
 
 
-@router.get("/reports/")
-async def get_telemetry_data(
-    limit: int = Query(default=10, description="Limit the number of records returned"),
-    offset: int = Query(default=0, description="Offset for pagination"),
+def _after(position: tuple[datetime, int], descending: bool) -> ColumnElement[bool]:
+    """
+    Rows past position in the direction of travel. The timestamp bound on its
+    own lets the planner use a timestamp index.
+    """
+    timestamp, row_id = position
+    column, id_column = _TELEMETRY_TABLE.c.timestamp, _TELEMETRY_TABLE.c.id
+    if descending:
+        return and_(column <= timestamp, or_(column < timestamp, id_column < row_id))
+    return and_(column >= timestamp, or_(column > timestamp, id_column > row_id))
+
+
+def telemetry_filters(
+    device_id: uuid.UUID | None = Query(None, description="Filter by device"),
     ident: str | None = Query(None, description="Filter by device identifier (ident)"),
     position_latitude: float | None = Query(
         None, description="Filter by position latitude"
@@ -170,39 +156,583 @@ async def get_telemetry_data(
         None, description="Filter by timestamp from"
     ),
     timestamp_to: datetime | None = Query(None, description="Filter by timestamp to"),
-) -> list[TelemetryData]:
-    """Retrieve telemetry data from the database"""
+) -> list[ColumnElement[bool]]:
+    """Conditions on telemetry rows shared by the read endpoints"""
+    filters = []
+    if device_id:
+        filters.append(col(TelemetryData.device_id) == device_id)
+    if ident:
+        filters.append(col(TelemetryData.ident) == ident)
+    if position_latitude:
+        filters.append(col(TelemetryData.position_latitude) == position_latitude)
+    if position_longitude:
+        filters.append(col(TelemetryData.position_longitude) == position_longitude)
+    if engine_ignition_status is not None:
+        filters.append(
+            col(TelemetryData.engine_ignition_status) == engine_ignition_status
+        )
+    if timestamp_from:
+        filters.append(col(TelemetryData.timestamp) >= timestamp_from)
+    if timestamp_to:
+        filters.append(col(TelemetryData.timestamp) <= timestamp_to)
+    return filters
+
+
+TelemetryFiltersDep = Annotated[list[ColumnElement[bool]], Depends(telemetry_filters)]
+
+
+class _NdjsonWriter:
+    def __init__(self, columns: list[ColumnElement[Any]]) -> None:
+        self._names = [column.name for column in columns]
+
+    def write(self, rows: Sequence[Row[Any]]) -> bytes:
+        return b"".join(
+            jsonlib.dumps(dict(zip(self._names, row, strict=True))) + b"\n"
+            for row in rows
+        )
+
+    def close(self) -> bytes:
+        return b""
+
+
+def _csv_value(value: Any) -> Any:
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, dict):
+        return jsonlib.dumps(value).decode()
+    return value
+
+
+class _CsvWriter:
+    def __init__(self, columns: list[ColumnElement[Any]]) -> None:
+        self._buffer = io.StringIO()
+        self._writer = csv.writer(self._buffer)
+        self._writer.writerow([column.name for column in columns])
+
+    def write(self, rows: Sequence[Row[Any]]) -> bytes:
+        self._writer.writerows([_csv_value(value) for value in row] for row in rows)
+        return self.close()
+
+    def close(self) -> bytes:
+        data = self._buffer.getvalue().encode()
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        return data
+
+
+_RowWriter = _NdjsonWriter | _CsvWriter | arrow.RecordBatchWriter
+
+
+class _ExportFormat(NamedTuple):
+    media_type: str
+    extension: str
+    writer: Callable[[list[ColumnElement[Any]]], _RowWriter]
+
+
+ExportFormat = Literal["ndjson", "csv", "arrow", "parquet"]
+
+_EXPORT_FORMATS: dict[ExportFormat, _ExportFormat] = {
+    "ndjson": _ExportFormat("application/x-ndjson", "ndjson", _NdjsonWriter),
+    "csv": _ExportFormat("text/csv", "csv", _CsvWriter),
+    "arrow": _ExportFormat(
+        arrow.ARROW_STREAM_MEDIA_TYPE,
+        "arrows",
+        partial(arrow.RecordBatchWriter, file_format="arrow"),
+    ),
+    "parquet": _ExportFormat(
+        arrow.PARQUET_MEDIA_TYPE,
+        "parquet",
+        partial(arrow.RecordBatchWriter, file_format="parquet"),
+    ),
+}
+
+
+def _accepted_format(request: Request) -> ExportFormat | None:
+    """Return the columnar format listed in the Accept header, if any"""
+    accepted = {
+        media_type(part) for part in request.headers.get("accept", "").split(",")
+    }
+    for name in ("arrow", "parquet"):
+        if _EXPORT_FORMATS[name].media_type in accepted:
+            return name
+    return None
+
+
+def _check_format(export_format: ExportFormat) -> None:
+    if export_format in ("arrow", "parquet") and not arrow.available():
+        raise HTTPException(
+            status_code=406, detail="Arrow and Parquet responses are not supported"
+        )
+
+
+async def _export_chunks(
+    connection: AsyncConnection,
+    result: AsyncResult[Any],
+    writer: _RowWriter,
+) -> AsyncIterator[bytes]:
+    try:
+        async for rows in result.partitions():
+            if chunk := writer.write(rows):
+                yield chunk
+        if chunk := writer.close():
+            yield chunk
+    finally:
+        await connection.close()
+
+
+def _ingest_error(
+    status_code: int,
+    detail: str,
+    accepted: int,
+    headers: dict[str, str] | None = None,
+) -> HTTPException:
+    """
+    Error of an upload. Chunks handed to the spool or the queue before it stay
+    accepted, X-Reports-Accepted tells the client how many of the first
+    reports of the body it shouldn't resend.
+    """
+    if accepted:
+        detail = f"{detail}, the first {accepted} reports were accepted"
+    return HTTPException(
+        status_code=status_code,
+        detail=detail,
+        headers={**(headers or {}), "X-Reports-Accepted": str(accepted)},
+    )
+
+
+@router.post("/reports/")
+async def receive_report(
+    session: AsyncSessionDep, request: Request, response: Response
+) -> dict[str, Any]:
+    """
+    Receive reports from a streaming telemetry source.
+
+    The body is a JSON report, a JSON array of reports, NDJSON
+    (application/x-ndjson), MessagePack (application/msgpack), an Arrow IPC
+    stream (application/vnd.apache.arrow.stream) or a Parquet file
+    (application/vnd.apache.parquet). It is parsed incrementally and
+    processed in chunks of INGEST_CHUNK_SIZE reports. Bodies may be
+    compressed with gzip, deflate or zstd (Content-Encoding) up to
+    INGEST_MAX_DECOMPRESSED_BYTES.
+
+    Reports are written to the local spool, the in-memory queue or straight to
+    the database, depending on the INGEST_SPOOL_ENABLED and
+    INGEST_QUEUE_ENABLED settings. Reports already stored (same device,
+    timestamp and event.seqnum) are skipped. When written straight to the
+    database the response counts inserted and duplicate reports.
+
+    When the body turns out to be invalid part way, the chunks already handed
+    to the spool or queue stay accepted and the error response says how many
+    reports that is. Straight to the database, nothing is written.
+    """
+    queued = settings.INGEST_SPOOL_ENABLED or settings.INGEST_QUEUE_ENABLED
+    accepted = 0
+    inserted = 0
+    try:
+        body = decode_body(
+            request.stream(),
+            request.headers.get("content-encoding"),
+            settings.INGEST_MAX_DECOMPRESSED_BYTES,
+        )
+        async for rows in iter_row_chunks(
+            body,
+            request.headers.get("content-type"),
+            settings.INGEST_CHUNK_SIZE,
+            settings.INGEST_RAW_DATA,
+        ):
+            if settings.INGEST_SPOOL_ENABLED:
+                try:
+                    await ingest_spool.put(rows)
+                except OSError as e:
+                    raise _ingest_error(
+                        503,
+                        "Ingest spool unavailable",
+                        accepted,
+                        {"Retry-After": "1"},
+                    ) from e
+            elif settings.INGEST_QUEUE_ENABLED:
+                if not await ingest_queue.put(rows):
+                    raise _ingest_error(
+                        503, "Ingest queue is full", accepted, {"Retry-After": "1"}
+                    )
+            else:
+                inserted += await store_rows(session, rows)
+            accepted += len(rows)
+
+        if queued:
+            response.status_code = 202
+            return {"status": "accepted", "message": f"{accepted} reports queued"}
+
+        # Devices and telemetry are written in a single transaction
+        await session.commit()
+
+        return {
+            "status": "success",
+            "message": f"{accepted} reports processed",
+            "inserted": inserted,
+            "duplicates": accepted - inserted,
+        }
+    except HTTPException:
+        raise
+    except PayloadTooLargeError as e:
+        raise _ingest_error(413, str(e), accepted if queued else 0) from e
+    except (UnsupportedEncodingError, UnsupportedMediaTypeError) as e:
+        raise _ingest_error(415, str(e), accepted if queued else 0) from e
+    except IngestUnavailableError as e:
+        raise _ingest_error(
+            503, str(e), accepted if queued else 0, {"Retry-After": "1"}
+        ) from e
+    except exc.SQLAlchemyError as e:
+        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}") from e
+    except Exception as e:
+        raise _ingest_error(400, str(e), accepted if queued else 0) from e
+
+
+@router.get(
+    "/ingest-stats/",
+    dependencies=[Depends(get_current_active_superuser)],
+    response_model=IngestQueueStats,
+)
+def read_ingest_stats() -> Any:
+    """Ingest queue depth, drop counts and flush latency of this worker"""
+    return ingest_queue.stats()
+
+
+@router.get("/reports/", response_model=list[TelemetryDataPublic])
+async def get_telemetry_data(
+    session: AsyncSessionDep,
+    request: Request,
+    filters: TelemetryFiltersDep,
+    fields: str | None = Query(
+        None,
+        description="Comma separated fields to return, all but raw_data by default",
+    ),
+    limit: int = Query(default=10, description="Limit the number of records returned"),
+    offset: int = Query(
+        default=0, description="Offset for pagination, ignored with a cursor"
+    ),
+    cursor: str | None = Query(
+        None,
+        description="X-Next-Cursor or X-Prev-Cursor header of a previous page",
+    ),
+    order: Literal["asc", "desc"] = Query(
+        "desc", description="Order by timestamp and id"
+    ),
+) -> Response:
+    """
+    Retrieve telemetry data from the database.
+
+    Only the requested fields are selected, raw_data is left out unless it is
+    listed. Rows are ordered by timestamp and id. The cursors of the adjacent
+    pages are returned in the X-Next-Cursor and X-Prev-Cursor headers, paging
+    with them costs the same at any depth, unlike offset.
+
+    The page is returned as an Arrow IPC stream or a Parquet file when the
+    Accept header asks for one.
+    """
+    names = _parse_fields(fields)
+    columnar_format = _accepted_format(request)
+    if columnar_format:
+        _check_format(columnar_format)
+    try:
+        # Start building the query, the cursor needs the timestamp and id,
+        # they come after the requested fields
+        selected = dict.fromkeys([*names, "timestamp", "id"])
+        query = select(*(_PUBLIC_COLUMNS[name] for name in selected)).where(*filters)
+
+        # Apply pagination, one more row tells whether another page follows
+        backward = False
+        if cursor:
+            position, backward = _decode_cursor(cursor, order)
+            query = query.where(
+                _after(position, descending=(order == "desc") != backward)
+            )
+        else:
+            query = query.offset(offset)
+        query = query.order_by(*_ORDER_BY[(order == "desc") != backward]).limit(
+            limit + 1
+        )
+
+        # Execute the query and fetch results
+        results = await session.execute(query)
+        rows = list(results)
+        more = len(rows) > limit
+        del rows[limit:]
+        if backward:
+            rows.reverse()
+            has_next, has_prev = True, more
+        else:
+            has_next, has_prev = more, bool(cursor or offset)
+        headers: dict[str, str] = {}
+        if rows and has_next:
+            headers["X-Next-Cursor"] = _encode_cursor(rows[-1], order, False)
+        if rows and has_prev:
+            headers["X-Prev-Cursor"] = _encode_cursor(rows[0], order, True)
+    except exc.SQLAlchemyError as e:
+        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}") from e
+
+    if columnar_format:
+        export = _EXPORT_FORMATS[columnar_format]
+        writer = export.writer([_PUBLIC_COLUMNS[name] for name in names])
+        content = writer.write(rows) + writer.close()
+        return Response(content, media_type=export.media_type, headers=headers)
+
+    # Rows are serialized as they come from the database, without building
+    # a model for each of them
+    content = jsonlib.dumps([dict(zip(names, row, strict=False)) for row in rows])
+    return Response(content, media_type="application/json", headers=headers)
+
+
+@router.get("/reports/export/", response_class=StreamingResponse)
+async def export_telemetry_data(
+    request: Request,
+    filters: TelemetryFiltersDep,
+    fields: str | None = Query(
+        None,
+        description="Comma separated fields to export, all but raw_data by default",
+    ),
+    export_format: ExportFormat | None = Query(
+        None,
+        alias="format",
+        description="NDJSON, CSV with a header row, an Arrow IPC stream or"
+        " Parquet. Defaults to the Arrow or Parquet type of the Accept header,"
+        " or NDJSON",
+    ),
+    order: Literal["asc", "desc"] = Query(
+        "asc", description="Order by timestamp and id"
+    ),
+) -> StreamingResponse:
+    """
+    Export every telemetry row matching the filters.
+
+    Rows are read through a server-side cursor TELEMETRY_EXPORT_BATCH_SIZE at
+    a time and streamed as they are encoded, so memory use doesn't grow with
+    the size of the export. Arrow and Parquet exports get one record batch,
+    or row group, per batch of rows.
+    """
+    if export_format is None:
+        export_format = _accepted_format(request) or "ndjson"
+    _check_format(export_format)
+    columns = [_PUBLIC_COLUMNS[name] for name in _parse_fields(fields)]
+    export = _EXPORT_FORMATS[export_format]
+    writer = export.writer(columns)
+    query = (
+        select(*columns)
+        .where(*filters)
+        .order_by(*_ORDER_BY[order == "desc"])
+        .execution_options(yield_per=settings.TELEMETRY_EXPORT_BATCH_SIZE)
+    )
+
+    # The connection outlives the request handler. It's closed once the rows
+    # are streamed, or after the response when streaming never started.
+    connection = await async_engine.connect()
+    try:
+        result = await connection.stream(query)
+    except exc.SQLAlchemyError as e:
+        await connection.close()
+        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}") from e
+    return StreamingResponse(
+        _export_chunks(connection, result, writer),
+        media_type=export.media_type,
+        headers={
+            "Content-Disposition": f'attachment; filename="telemetry.{export.extension}"'
+        },
+        background=BackgroundTask(connection.close),
+    )
+
+
+def _rollup_table(name: str) -> Table:
+    return Table(
+        name,
+        MetaData(),
+        Column("device_id", Uuid),
+        Column("bucket", DateTime),
+        Column("message_count", BigInteger),
+        Column("speed_min", Float),
+        Column("speed_max", Float),
+        Column("speed_sum", Float),
+        Column("speed_count", BigInteger),
+        Column("speed_last", Float),
+        Column("distance_km", Float),
+        Column("ignition_on_seconds", Float),
+    )
+
+
+_ROLLUP_TABLES = {rollup.name: _rollup_table(rollup.name) for rollup in ROLLUPS}
+
+# Fields aggregated by the rollups, and the metrics only they have
+_ROLLUP_FIELDS = ("position_speed",)
+_ROLLUP_METRICS = ("distance_km", "ignition_on_seconds")
+
+
+def _naive_utc(value: datetime) -> datetime:
+    """Timestamps are stored as naive UTC, bounds with an offset are converted"""
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def _aligned(value: datetime, width: timedelta) -> bool:
+    return (value - datetime(2000, 1, 1)) % width == timedelta(0)
+
+
+def _rollup(
+    bucket: timedelta, timestamp_from: datetime, timestamp_to: datetime
+) -> Rollup | None:
+    """Return the widest rollup whose buckets add up to the requested ones"""
+    for rollup in ROLLUPS:
+        if (
+            bucket % rollup.width == timedelta(0)
+            and _aligned(timestamp_from, rollup.width)
+            and _aligned(timestamp_to, rollup.width)
+        ):
+            return rollup
+    return None
+
+
+def _last(value: ColumnElement[Any], time: ColumnElement[Any], gapfill: bool) -> Any:
+    last = func.last(value, time)
+    return func.locf(last) if gapfill else last
+
+
+def _telemetry_stats(names: list[str], gapfill: bool) -> list[ColumnElement[Any]]:
+    timestamp = _TELEMETRY_TABLE.c.timestamp
+    stats: list[ColumnElement[Any]] = [func.count().label("count")]
+    for name in names:
+        column = _PUBLIC_COLUMNS[name]
+        stats += [
+            func.min(column).label(f"{name}_min"),
+            func.max(column).label(f"{name}_max"),
+            func.avg(column).label(f"{name}_avg"),
+            _last(column, timestamp, gapfill).label(f"{name}_last"),
+        ]
+    return stats
+
+
+def _rollup_stats(
+    rollup: Table, names: list[str], gapfill: bool
+) -> list[ColumnElement[Any]]:
+    # Rollup buckets are combined, averages from their sums and counts
+    stats: list[ColumnElement[Any]] = [
+        cast(func.sum(rollup.c.message_count), BigInteger).label("count")
+    ]
+    for name in names:
+        if name in _ROLLUP_METRICS:
+            stats.append(func.sum(rollup.c[name]).label(name))
+            continue
+        speed_count = func.nullif(cast(func.sum(rollup.c.speed_count), Float), 0)
+        stats += [
+            func.min(rollup.c.speed_min).label(f"{name}_min"),
+            func.max(rollup.c.speed_max).label(f"{name}_max"),
+            (func.sum(rollup.c.speed_sum) / speed_count).label(f"{name}_avg"),
+            _last(rollup.c.speed_last, rollup.c.bucket, gapfill).label(f"{name}_last"),
+        ]
+    return stats
+
+
+@router.get("/reports/aggregate/", response_model=list[dict[str, Any]])
+async def aggregate_telemetry_data(
+    session: AsyncSessionDep,
+    timestamp_from: datetime = Query(description="Start of the first bucket"),
+    timestamp_to: datetime = Query(description="End of the range, exclusive"),
+    bucket: timedelta = Query(
+        description="Bucket width, as seconds or an ISO 8601 duration"
+    ),
+    fields: str | None = Query(
+        None,
+        description="Comma separated numeric fields to aggregate, position_speed"
+        " by default. distance_km and ignition_on_seconds are summed from the"
+        " hourly rollups",
+    ),
+    device_id: list[uuid.UUID] | None = Query(None, description="Filter by devices"),
+    ident: str | None = Query(None, description="Filter by device identifier (ident)"),
+    gapfill: bool = Query(
+        False,
+        description="Return empty buckets too, with the last value carried over",
+    ),
+) -> Response:
+    """
+    Aggregate telemetry per device in buckets of time.
+
+    Each row holds a device, the start of a bucket, the number of reports in
+    it and the min, max, avg and last value of every field, named
+    <field>_<stat>. Buckets are computed by the database with time_bucket,
+    only the aggregated rows are returned.
+
+    Buckets of whole hours or days over a range aligned to them are read from
+    the hourly or daily rollups when the fields allow it and the rollup is
+    current over the range, instead of the raw reports. Only the rollups can
+    return the estimated distance_km and ignition_on_seconds.
+    """
+    names = _parse_fields(
+        fields, [*_AGGREGATE_FIELDS, *_ROLLUP_METRICS], ["position_speed"]
+    )
+    timestamp_from = _naive_utc(timestamp_from)
+    timestamp_to = _naive_utc(timestamp_to)
+    if bucket <= timedelta(0) or timestamp_to <= timestamp_from:
+        raise HTTPException(status_code=400, detail="Empty time range or bucket width")
+    if (timestamp_to - timestamp_from) / bucket > settings.TELEMETRY_MAX_BUCKETS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"More than {settings.TELEMETRY_MAX_BUCKETS} buckets requested",
+        )
+
+    metrics = set(names) & set(_ROLLUP_METRICS)
+    rollup = None
+    if not ident and set(names) <= {*_ROLLUP_FIELDS, *_ROLLUP_METRICS}:
+        rollup = _rollup(bucket, timestamp_from, timestamp_to)
+    if rollup is None and metrics:
+        raise HTTPException(
+            status_code=400,
+            detail="distance_km and ignition_on_seconds need buckets of whole"
+            " hours over a range aligned to them, without an ident filter",
+        )
+    # Fields the raw reports have are read from them when the rollup may miss
+    # late reports of the range
+    try:
+        if (
+            rollup is not None
+            and not metrics
+            and not await is_current(session, rollup, timestamp_from)
+        ):
+            rollup = None
+    except exc.SQLAlchemyError as e:
+        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}") from e
+
+    if rollup is not None:
+        table = _ROLLUP_TABLES[rollup.name]
+        time, device = table.c.bucket, table.c.device_id
+        stats = _rollup_stats(table, names, gapfill)
+    else:
+        time, device = _TELEMETRY_TABLE.c.timestamp, _TELEMETRY_TABLE.c.device_id
+        stats = _telemetry_stats(names, gapfill)
+    if gapfill:
+        bucket_column = func.time_bucket_gapfill(
+            bucket, time, timestamp_from, timestamp_to
+        )
+    else:
+        bucket_column = func.time_bucket(bucket, time)
+    # Grouped and ordered by position: the bucket width is a parameter that
+    # would differ between the select list and GROUP BY, and a rollup has an
+    # input column named bucket too
+    positions: tuple[ColumnElement[Any], ...] = (
+        literal_column("1"),
+        literal_column("2"),
+    )
+    query = (
+        select(device, bucket_column.label("bucket"), *stats)
+        .where(time >= timestamp_from, time < timestamp_to)
+        .group_by(*positions)
+        .order_by(*positions)
+    )
+    if device_id:
+        query = query.where(device.in_(device_id))
+    if ident:
+        query = query.where(_TELEMETRY_TABLE.c.ident == ident)
+
     try:
-        with Session(engine) as session:
-            # Start building the query
-            query = select(TelemetryData)
-
-            # Apply filters if provided
-            if ident:
-                query = query.where(TelemetryData.ident == ident)
-            if position_latitude:
-                query = query.where(
-                    TelemetryData.position_latitude == position_latitude
-                )
-            if position_longitude:
-                query = query.where(
-                    TelemetryData.position_longitude == position_longitude
-                )
-            if engine_ignition_status is not None:
-                query = query.where(
-                    TelemetryData.engine_ignition_status == engine_ignition_status
-                )
-
-            if timestamp_from and TelemetryData.timestamp:
-                query = query.where(TelemetryData.timestamp >= timestamp_from)
-            if timestamp_to and TelemetryData.timestamp:
-                query = query.where(TelemetryData.timestamp <= timestamp_to)
-
-            # Apply pagination
-            query = query.offset(offset).limit(limit)
-
-            # Execute the query and fetch results
-            results = session.exec(query).all()
-            return list(results)
+        results = await session.execute(query)
     except exc.SQLAlchemyError as e:
         raise HTTPException(status_code=500, detail=f"Database error: {str(e)}") from e
+    content = jsonlib.dumps([dict(row) for row in results.mappings()])
+    return Response(content, media_type="application/json")
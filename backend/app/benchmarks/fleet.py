@@ -0,0 +1,156 @@
+"""
+Synthetic fleet of devices producing telemetry reports.
+
+Every device drives along its own track: it moves with a heading that drifts
+and a speed that changes gradually while the ignition is on, and stands still
+between ignition cycles. Reports use the same dotted keys as real ones and
+carry increasing event sequence numbers, so they go through mapping and
+deduplication like production traffic. The fleet is seeded, two fleets with
+the same arguments produce the same reports.
+"""
+
+import math
+import random
+from collections.abc import Iterator
+from dataclasses import dataclass
+from itertools import islice
+from typing import Any
+
+# Degrees of latitude per metre
+_DEGREES_PER_METRE = 1 / 111_320
+
+
+@dataclass
+class _Vehicle:
+    provider_device_id: str
+    name: str
+    latitude: float
+    longitude: float
+    heading: float
+    speed: float
+    ignition: bool
+    # Reports left before the ignition toggles
+    cycle_left: int
+    seqnum: int
+    odometer: float
+    engine_hours: float
+
+
+class Fleet:
+    """Devices reporting every interval seconds from start onwards"""
+
+    def __init__(
+        self,
+        devices: int,
+        *,
+        start: float,
+        interval: float = 10.0,
+        seed: int = 0,
+        prefix: str = "bench",
+    ) -> None:
+        self.start = start
+        self.interval = interval
+        self._random = random.Random(seed)
+        self._vehicles = [
+            _Vehicle(
+                provider_device_id=f"{prefix}-{i:06d}",
+                name=f"Vehicle {i}",
+                # Spread over a metropolitan area
+                latitude=4.6 + self._random.uniform(-0.3, 0.3),
+                longitude=-74.1 + self._random.uniform(-0.3, 0.3),
+                heading=self._random.uniform(0, 360),
+                speed=0.0,
+                ignition=self._random.random() < 0.7,
+                cycle_left=self._random.randint(1, 360),
+                seqnum=self._random.randint(0, 1_000_000),
+                odometer=self._random.uniform(0, 500_000_000),
+                engine_hours=self._random.uniform(0, 20_000),
+            )
+            for i in range(devices)
+        ]
+        self._tick = 0
+
+    def __len__(self) -> int:
+        return len(self._vehicles)
+
+    def _advance(self, vehicle: _Vehicle) -> None:
+        vehicle.cycle_left -= 1
+        if vehicle.cycle_left <= 0:
+            vehicle.ignition = not vehicle.ignition
+            # Trips are longer than stops
+            vehicle.cycle_left = self._random.randint(
+                *((30, 720) if vehicle.ignition else (6, 360))
+            )
+        if vehicle.ignition:
+            vehicle.speed = min(
+                max(vehicle.speed + self._random.gauss(0, 3), 0.0), 110.0
+            )
+            vehicle.heading = (vehicle.heading + self._random.gauss(0, 15)) % 360
+            vehicle.engine_hours += self.interval / 3600
+        else:
+            vehicle.speed = 0.0
+        metres = vehicle.speed / 3.6 * self.interval
+        heading = math.radians(vehicle.heading)
+        vehicle.latitude += metres * math.cos(heading) * _DEGREES_PER_METRE
+        vehicle.longitude += (
+            metres
+            * math.sin(heading)
+            * _DEGREES_PER_METRE
+            / math.cos(math.radians(vehicle.latitude))
+        )
+        vehicle.odometer += metres
+        vehicle.seqnum += 1
+
+    def _report(self, vehicle: _Vehicle, timestamp: float) -> dict[str, Any]:
+        return {
+            "ident": vehicle.provider_device_id,
+            "timestamp": round(timestamp, 6),
+            "server.timestamp": round(timestamp + self._random.uniform(0.1, 2), 6),
+            "device.id": vehicle.provider_device_id,
+            "device.name": vehicle.name,
+            "device.type.id": 409,
+            "channel.id": 1,
+            "protocol.id": 42,
+            "peer": f"10.0.{self._random.randint(0, 255)}.1:4000",
+            "event.enum": 1 if vehicle.ignition else 0,
+            "event.seqnum": vehicle.seqnum,
+            "message.type.enum": 0,
+            "engine.ignition.status": vehicle.ignition,
+            "din": 1 if vehicle.ignition else 0,
+            "gnss.antenna.status": "ok",
+            "gsm.network.roaming.status": "home",
+            "position.latitude": round(vehicle.latitude, 6),
+            "position.longitude": round(vehicle.longitude, 6),
+            "position.altitude": round(2600 + self._random.uniform(-20, 20), 1),
+            "position.direction": round(vehicle.heading, 1),
+            "position.speed": round(vehicle.speed, 1),
+            "position.hdop": round(self._random.uniform(0.6, 2.5), 1),
+            "position.satellites": self._random.randint(6, 18),
+            "position.valid": True,
+            "timestamp.key": int(timestamp),
+            "accumulator.0": round(vehicle.odometer, 1),
+            "accumulator.1": round(vehicle.engine_hours, 3),
+            "battery.voltage": round(12.4 + self._random.uniform(-0.4, 1.8), 2),
+        }
+
+    def reports(self, count: int) -> Iterator[dict[str, Any]]:
+        """
+        Yield the next count reports.
+
+        Devices report in turns, each at its own offset within the interval.
+        """
+        devices = len(self._vehicles)
+        for _ in range(count):
+            index = self._tick % devices
+            cycle = self._tick // devices
+            vehicle = self._vehicles[index]
+            self._advance(vehicle)
+            offset = self.interval * index / devices
+            yield self._report(vehicle, self.start + cycle * self.interval + offset)
+            self._tick += 1
+
+    def batches(self, count: int, batch_size: int) -> Iterator[list[dict[str, Any]]]:
+        """Yield the next count reports in lists of at most batch_size"""
+        reports = self.reports(count)
+        while batch := list(islice(reports, batch_size)):
+            yield batch
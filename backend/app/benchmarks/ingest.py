@@ -0,0 +1,347 @@
+"""
+Ingest throughput benchmark.
+
+Sends reports of a synthetic fleet to the receive_report endpoint and
+measures reports/s, request latency and the rate rows reach the database, for
+every combination of write strategy, body format, batch size and concurrency
+given.
+
+In-process runs drive the app through its ASGI interface with the queue and
+the spool disabled, so every request writes its rows before it returns and
+each write strategy is measured on its own. HTTP runs post to a running
+server, whose configuration decides how rows are written. Rows accepted for
+later writing are counted in the database until they have all arrived.
+
+    python -m app.benchmarks.ingest --devices 1000 --reports 100000 \\
+        --batch-size 100 1000 --concurrency 1 8 --strategy insert copy \\
+        --format json ndjson \\
+        --output benchmark-results/ingest.json
+
+Run it against a disposable database, it stores what it sends.
+"""
+
+import argparse
+import asyncio
+import itertools
+import logging
+import time
+from collections.abc import Sequence
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Any, Literal, get_args
+
+import httpx
+from sqlalchemy import text
+
+from app.benchmarks.fleet import Fleet
+from app.benchmarks.results import (
+    compare_results,
+    latency_summary,
+    load_results,
+    write_results,
+)
+from app.core import jsonlib
+from app.core.config import settings
+from app.core.db import async_engine
+from app.ingest.mapping import to_datetime
+
+logging.basicConfig(level=logging.INFO, format="%(message)s")
+logger = logging.getLogger(__name__)
+# One line per request would drown the results
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+BodyFormat = Literal["json", "ndjson"]
+
+_CONTENT_TYPES: dict[BodyFormat, str] = {
+    "json": "application/json",
+    "ndjson": "application/x-ndjson",
+}
+
+_COUNT_ROWS = text(
+    "SELECT count(*) FROM telemetrydata"
+    " WHERE timestamp >= :start AND storage_server_timestamp_utc >= :since"
+)
+
+# Fields identifying the same scenario in another run
+RESULT_KEY = ("mode", "strategy", "body_format", "batch_size", "concurrency")
+
+
+@dataclass
+class IngestResult:
+    mode: str
+    strategy: str
+    body_format: str
+    devices: int
+    batch_size: int
+    concurrency: int
+    reports: int
+    requests: int
+    errors: int
+    seconds: float
+    reports_per_second: float
+    db_rows: int
+    db_seconds: float
+    db_rows_per_second: float
+    latency_ms: dict[str, float]
+
+
+def encode_batches(
+    batches: Sequence[list[dict[str, Any]]], body_format: BodyFormat
+) -> list[tuple[bytes, int]]:
+    """
+    Serialize batches up front, so encoding isn't part of the measurement.
+    Returns each body with its number of reports.
+    """
+    if body_format == "ndjson":
+        return [
+            (b"\n".join(jsonlib.dumps(report) for report in batch), len(batch))
+            for batch in batches
+        ]
+    return [(jsonlib.dumps(batch), len(batch)) for batch in batches]
+
+
+@dataclass
+class _Sent:
+    latencies: list[float]
+    accepted: int
+    inserted: int
+    errors: int
+    seconds: float
+
+
+async def send_bodies(
+    client: httpx.AsyncClient,
+    url: str,
+    bodies: Sequence[tuple[bytes, int]],
+    content_type: str,
+    concurrency: int,
+) -> _Sent:
+    """Post bodies with concurrency requests in flight"""
+    sent = _Sent(latencies=[], accepted=0, inserted=0, errors=0, seconds=0.0)
+    pending = iter(bodies)
+
+    async def worker() -> None:
+        for body, reports in pending:
+            started = time.perf_counter()
+            response = await client.post(
+                url, content=body, headers={"content-type": content_type}
+            )
+            sent.latencies.append(time.perf_counter() - started)
+            if response.status_code >= 400:
+                sent.errors += 1
+                logger.warning("Request failed: %s", response.text[:200])
+                continue
+            sent.accepted += reports
+            # Only counted when rows are written before the response
+            sent.inserted += int(response.json().get("inserted", 0))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    sent.seconds = time.perf_counter() - started
+    return sent
+
+
+async def wait_for_rows(
+    start: float, since: float, expected: int, timeout: float
+) -> tuple[int, float]:
+    """
+    Count the rows written since the run started until expected rows arrived,
+    or none arrived for timeout seconds. Returns the count and the time the
+    last one arrived at, relative to since.
+    """
+    parameters = {
+        "start": to_datetime(start),
+        "since": to_datetime(since),
+    }
+    rows, arrived, changed = 0, 0.0, time.monotonic()
+    while rows < expected and time.monotonic() - changed < timeout:
+        async with async_engine.connect() as connection:
+            count = (await connection.execute(_COUNT_ROWS, parameters)).scalar_one()
+        if count != rows:
+            rows, arrived, changed = count, time.time() - since, time.monotonic()
+        else:
+            await asyncio.sleep(0.1)
+    return rows, arrived
+
+
+async def run_scenario(
+    client: httpx.AsyncClient,
+    url: str,
+    *,
+    mode: str,
+    strategy: str,
+    devices: int,
+    reports: int,
+    batch_size: int,
+    concurrency: int,
+    body_format: BodyFormat,
+    drain_timeout: float,
+    seed: int,
+) -> IngestResult:
+    # A fresh start time keeps the reports of every run apart from earlier ones
+    fleet = Fleet(devices, start=time.time(), seed=seed)
+    bodies = encode_batches(list(fleet.batches(reports, batch_size)), body_format)
+    since = time.time()
+    sent = await send_bodies(
+        client, url, bodies, _CONTENT_TYPES[body_format], concurrency
+    )
+    if mode == "in-process":
+        db_rows, db_seconds = sent.inserted, sent.seconds
+    else:
+        db_rows, db_seconds = await wait_for_rows(
+            fleet.start, since, sent.accepted, drain_timeout
+        )
+    result = IngestResult(
+        mode=mode,
+        strategy=strategy,
+        body_format=body_format,
+        devices=devices,
+        batch_size=batch_size,
+        concurrency=concurrency,
+        reports=reports,
+        requests=len(bodies),
+        errors=sent.errors,
+        seconds=round(sent.seconds, 3),
+        reports_per_second=round(reports / sent.seconds, 1),
+        db_rows=db_rows,
+        db_seconds=round(db_seconds, 3),
+        db_rows_per_second=round(db_rows / db_seconds, 1) if db_seconds else 0.0,
+        latency_ms=latency_summary(sent.latencies),
+    )
+    logger.info(
+        "%s %s %s batch=%d concurrency=%d: %.0f reports/s, %.0f rows/s,"
+        " p50 %.1f ms, p99 %.1f ms, %d errors",
+        mode,
+        strategy,
+        body_format,
+        batch_size,
+        concurrency,
+        result.reports_per_second,
+        result.db_rows_per_second,
+        result.latency_ms["p50"],
+        result.latency_ms["p99"],
+        result.errors,
+    )
+    return result
+
+
+async def run(args: argparse.Namespace) -> list[IngestResult]:
+    path = f"{settings.API_V1_STR}/reports/reports/"
+    results = []
+    if args.url:
+        async with httpx.AsyncClient(base_url=args.url, timeout=None) as client:
+            for body_format, batch_size, concurrency in itertools.product(
+                args.format, args.batch_size, args.concurrency
+            ):
+                results.append(
+                    await run_scenario(
+                        client,
+                        path,
+                        mode="http",
+                        strategy="server",
+                        devices=args.devices,
+                        reports=args.reports,
+                        batch_size=batch_size,
+                        concurrency=concurrency,
+                        body_format=body_format,
+                        drain_timeout=args.drain_timeout,
+                        seed=args.seed,
+                    )
+                )
+    else:
+        from app.main import app
+
+        # Requests write their rows before returning
+        settings.INGEST_SPOOL_ENABLED = False
+        settings.INGEST_QUEUE_ENABLED = False
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://benchmark", timeout=None
+        ) as client:
+            for strategy in args.strategy:
+                settings.TELEMETRY_WRITE_STRATEGY = strategy
+                for body_format, batch_size, concurrency in itertools.product(
+                    args.format, args.batch_size, args.concurrency
+                ):
+                    results.append(
+                        await run_scenario(
+                            client,
+                            path,
+                            mode="in-process",
+                            strategy=strategy,
+                            devices=args.devices,
+                            reports=args.reports,
+                            batch_size=batch_size,
+                            concurrency=concurrency,
+                            body_format=body_format,
+                            drain_timeout=args.drain_timeout,
+                            seed=args.seed,
+                        )
+                    )
+    await async_engine.dispose()
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Measure telemetry ingest")
+    parser.add_argument("--devices", type=int, default=1_000)
+    parser.add_argument("--reports", type=int, default=100_000)
+    parser.add_argument("--batch-size", type=int, nargs="+", default=[1_000])
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8])
+    parser.add_argument(
+        "--strategy",
+        nargs="+",
+        choices=["orm", "insert", "copy"],
+        default=["insert", "copy"],
+        help="Write strategies measured in process",
+    )
+    parser.add_argument(
+        "--format",
+        nargs="+",
+        choices=get_args(BodyFormat),
+        default=list(get_args(BodyFormat)),
+        help="Body formats sent",
+    )
+    parser.add_argument(
+        "--url", help="Post to a running server instead of the app in process"
+    )
+    parser.add_argument(
+        "--drain-timeout",
+        type=float,
+        default=30.0,
+        help="Seconds to wait for more rows to reach the database over HTTP",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--output", type=Path, default=Path("benchmark-results/ingest.json")
+    )
+    parser.add_argument(
+        "--baseline", type=Path, help="Results of an earlier run to compare with"
+    )
+    args = parser.parse_args()
+
+    results = [asdict(result) for result in asyncio.run(run(args))]
+    write_results(
+        args.output,
+        "ingest",
+        {
+            key: value
+            for key, value in vars(args).items()
+            if key not in ("output", "baseline")
+        },
+        results,
+    )
+    logger.info("Results written to %s", args.output)
+    if args.baseline:
+        for result, change in compare_results(
+            results, load_results(args.baseline), RESULT_KEY, "reports_per_second"
+        ):
+            logger.info(
+                "%s: %+.1f%% reports/s",
+                " ".join(str(result[field]) for field in RESULT_KEY),
+                change * 100,
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,431 @@
+"""
+Query benchmark over a large seeded telemetry hypertable.
+
+``seed`` fills a local TimescaleDB with synthetic devices, users, items and
+telemetry generated in the database itself, one day per transaction, and
+compresses the chunks older than --compress-after days, so scenarios cover
+compressed and uncompressed chunks. Seeding again skips the rows already
+there.
+
+``run`` times the list endpoints through the app in process under typical
+filters and page depths, and captures ``EXPLAIN (ANALYZE, BUFFERS)`` of every
+statement each scenario runs.
+
+    python -m app.benchmarks.queries seed --devices 2000 --days 60
+    python -m app.benchmarks.queries run --repeat 20 \\
+        --output benchmark-results/queries.json
+
+Run it against a disposable database.
+"""
+
+import argparse
+import asyncio
+import logging
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Any
+
+import httpx
+from sqlalchemy import event, text
+from sqlmodel import Session, select
+
+from app.benchmarks.results import (
+    compare_results,
+    latency_summary,
+    load_results,
+    write_results,
+)
+from app.core import security
+from app.core.config import settings
+from app.core.db import async_engine, engine
+from app.models import User
+
+logging.basicConfig(level=logging.INFO, format="%(message)s")
+logger = logging.getLogger(__name__)
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+DEVICE_PREFIX = "bench-query-"
+
+_SEED_USERS = text(
+    """
+    INSERT INTO "user" (id, email, is_active, is_superuser, full_name, hashed_password)
+    SELECT gen_random_uuid(), 'bench-user-' || n || '@example.com', TRUE, FALSE,
+        'Benchmark user ' || n, :hashed_password
+    FROM generate_series(1, :users) AS n
+    ON CONFLICT (email) DO NOTHING
+    """
+)
+
+_SEED_ITEMS = text(
+    """
+    INSERT INTO item (id, title, description, owner_id)
+    SELECT gen_random_uuid(), 'Item ' || n, 'Benchmark item', u.id
+    FROM "user" u CROSS JOIN generate_series(1, :items) AS n
+    WHERE u.email LIKE 'bench-user-%'
+        AND NOT EXISTS (SELECT 1 FROM item i WHERE i.owner_id = u.id)
+    """
+)
+
+_SEED_DEVICES = text(
+    """
+    INSERT INTO device (id, provider_device_id, device_name, description, owner_id)
+    SELECT gen_random_uuid(), :prefix || lpad(n::text, 6, '0'), 'Vehicle ' || n,
+        NULL, (SELECT id FROM "user" WHERE email = :owner)
+    FROM generate_series(1, :devices) AS n
+    ON CONFLICT (provider_device_id) DO NOTHING
+    """
+)
+
+_SEED_DEVICE_STATE = text(
+    """
+    INSERT INTO device_state (device_id, last_online_timestamp, is_online)
+    SELECT id, now() AT TIME ZONE 'utc', TRUE
+    FROM device WHERE provider_device_id LIKE :prefix || '%'
+    ON CONFLICT (device_id) DO NOTHING
+    """
+)
+
+# Each device reports every interval seconds, at its own offset. Positions
+# move along a circle, the ignition is on during the day.
+_SEED_TELEMETRY = text(
+    """
+    INSERT INTO telemetrydata (
+        timestamp, server_timestamp, storage_server_timestamp_utc, ident,
+        provider_device_id, device_name, device_id, device_type_id,
+        position_latitude, position_longitude, position_altitude,
+        position_speed, position_direction, position_satellites, position_valid,
+        engine_ignition_status, event_enum, event_seqnum, accumulator_0,
+        accumulator_1, raw_data
+    )
+    SELECT ts, ts + interval '1 second', ts + interval '2 seconds',
+        d.provider_device_id, d.provider_device_id, d.device_name, d.id, 409,
+        4.6 + 0.3 * sin(extract(epoch FROM ts) / 3600 + d.n),
+        -74.1 + 0.3 * cos(extract(epoch FROM ts) / 3600 + d.n),
+        2600 + 20 * sin(d.n),
+        CASE WHEN ignition THEN 30 + 30 * sin(extract(epoch FROM ts) / 600) ELSE 0 END,
+        (extract(epoch FROM ts) / 60 + d.n)::numeric % 360,
+        8 + d.n % 10, TRUE, ignition, ignition::int,
+        (extract(epoch FROM ts) / :interval)::int,
+        d.n * 1000 + extract(epoch FROM ts) / 100,
+        extract(epoch FROM ts) / 3600,
+        jsonb_build_object('battery.voltage', 12.6)
+    FROM (
+        SELECT id, provider_device_id, device_name,
+            row_number() OVER (ORDER BY provider_device_id) AS n
+        FROM device WHERE provider_device_id LIKE :prefix || '%'
+    ) d
+    CROSS JOIN LATERAL generate_series(
+        CAST(:day AS timestamp) + make_interval(secs => d.n % :interval),
+        LEAST(CAST(:day AS timestamp) + interval '1 day', CAST(:until AS timestamp))
+            - interval '1 microsecond',
+        make_interval(secs => :interval)
+    ) AS ts
+    CROSS JOIN LATERAL (
+        SELECT extract(hour FROM ts)::int BETWEEN 6 AND 20 AS ignition
+    ) i
+    ON CONFLICT DO NOTHING
+    """
+)
+
+_COMPRESS = text(
+    """
+    SELECT count(compress_chunk(c, if_not_compressed => TRUE))
+    FROM show_chunks('telemetrydata', older_than => make_interval(days => :days)) c
+    """
+)
+
+
+def _utcnow() -> datetime:
+    """Timestamp columns are WITHOUT TIME ZONE and hold UTC values"""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def seed(args: argparse.Namespace) -> None:
+    with engine.begin() as connection:
+        connection.execute(
+            _SEED_USERS,
+            {
+                "users": args.users,
+                "hashed_password": security.get_password_hash("benchmark"),
+            },
+        )
+        connection.execute(_SEED_ITEMS, {"items": args.items_per_user})
+        connection.execute(
+            _SEED_DEVICES,
+            {
+                "prefix": DEVICE_PREFIX,
+                "devices": args.devices,
+                "owner": settings.FIRST_SUPERUSER,
+            },
+        )
+        connection.execute(_SEED_DEVICE_STATE, {"prefix": DEVICE_PREFIX})
+    logger.info("Seeded %d users and %d devices", args.users, args.devices)
+
+    # Days up to now, the last one is partial
+    until = _utcnow()
+    today = until.replace(hour=0, minute=0, second=0, microsecond=0)
+    for days_ago in range(args.days - 1, -1, -1):
+        day = today - timedelta(days=days_ago)
+        started = time.perf_counter()
+        with engine.begin() as connection:
+            inserted = connection.execute(
+                _SEED_TELEMETRY,
+                {
+                    "prefix": DEVICE_PREFIX,
+                    "day": day,
+                    "until": until,
+                    "interval": args.interval,
+                },
+            ).rowcount
+        logger.info(
+            "Seeded %s: %d rows in %.1f s",
+            day.date(),
+            inserted,
+            time.perf_counter() - started,
+        )
+
+    with engine.begin() as connection:
+        compressed = connection.execute(
+            _COMPRESS, {"days": args.compress_after}
+        ).scalar_one()
+        logger.info("Compressed %d chunks", compressed)
+        connection.exec_driver_sql(
+            'ANALYZE telemetrydata, device, device_state, item, "user"'
+        )
+
+
+@dataclass
+class Scenario:
+    name: str
+    path: str
+    params: dict[str, Any] = field(default_factory=dict)
+
+
+def scenarios(args: argparse.Namespace) -> list[Scenario]:
+    now = _utcnow()
+    old = now - timedelta(days=args.old_days)
+    reports = f"{settings.API_V1_STR}/reports/reports/"
+    result = [
+        Scenario("telemetry latest page", reports, {"limit": 100}),
+        Scenario(
+            "telemetry by ident",
+            reports,
+            {"ident": f"{DEVICE_PREFIX}000001", "limit": 100},
+        ),
+        Scenario(
+            "telemetry last hour",
+            reports,
+            {"timestamp_from": (now - timedelta(hours=1)).isoformat(), "limit": 100},
+        ),
+        Scenario(
+            "telemetry compressed hour",
+            reports,
+            {
+                "timestamp_from": old.isoformat(),
+                "timestamp_to": (old + timedelta(hours=1)).isoformat(),
+                "limit": 100,
+            },
+        ),
+        Scenario(
+            "telemetry ignition off",
+            reports,
+            {"engine_ignition_status": False, "limit": 100},
+        ),
+    ]
+    for depth in args.page_depths:
+        result.append(
+            Scenario(
+                f"telemetry offset {depth}", reports, {"offset": depth, "limit": 100}
+            )
+        )
+    for name, path in (
+        ("devices", f"{settings.API_V1_STR}/devices/"),
+        ("items", f"{settings.API_V1_STR}/items/"),
+        ("users", f"{settings.API_V1_STR}/users/"),
+    ):
+        for depth in (0, *args.page_depths):
+            result.append(
+                Scenario(f"{name} skip {depth}", path, {"skip": depth, "limit": 100})
+            )
+    return result
+
+
+class StatementRecorder:
+    """Records the statements run by the app's engines while capturing"""
+
+    def __init__(self) -> None:
+        self.statements: list[tuple[str, Any]] | None = None
+        for target in (engine, async_engine.sync_engine):
+            event.listen(target, "before_cursor_execute", self._record)
+
+    def _record(
+        self,
+        _connection: Any,
+        _cursor: Any,
+        statement: str,
+        parameters: Any,
+        _context: Any,
+        executemany: bool,
+    ) -> None:
+        if self.statements is not None and not executemany:
+            self.statements.append((statement, parameters))
+
+    @contextmanager
+    def capture(self) -> Iterator[list[tuple[str, Any]]]:
+        self.statements = []
+        try:
+            yield self.statements
+        finally:
+            self.statements = None
+
+
+def explain(statement: str, parameters: Any) -> dict[str, Any]:
+    """EXPLAIN (ANALYZE, BUFFERS) a statement, in a transaction rolled back"""
+    with engine.connect() as connection:
+        [[plans]] = connection.exec_driver_sql(
+            f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {statement}", parameters
+        ).all()
+        connection.rollback()
+    plan = plans[0]
+    return {
+        "statement": statement,
+        "execution_ms": plan["Execution Time"],
+        "planning_ms": plan["Planning Time"],
+        "shared_hit_blocks": plan["Plan"].get("Shared Hit Blocks"),
+        "shared_read_blocks": plan["Plan"].get("Shared Read Blocks"),
+        "plan": plan["Plan"],
+    }
+
+
+async def run_scenarios(args: argparse.Namespace) -> list[dict[str, Any]]:
+    from app.main import app
+
+    with Session(engine) as session:
+        superuser_id = session.exec(
+            select(User.id).where(User.email == settings.FIRST_SUPERUSER)
+        ).one()
+    token = security.create_access_token(superuser_id, timedelta(hours=1))
+    recorder = StatementRecorder()
+    results = []
+    async with httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=app),
+        base_url="http://benchmark",
+        headers={"Authorization": f"Bearer {token}"},
+        timeout=None,
+    ) as client:
+        for scenario in scenarios(args):
+            # The first request warms up caches and records the statements
+            with recorder.capture() as statements:
+                response = await client.get(scenario.path, params=scenario.params)
+            response.raise_for_status()
+            content = response.json()
+            rows = len(content["data"] if isinstance(content, dict) else content)
+
+            latencies = []
+            for _ in range(args.repeat):
+                started = time.perf_counter()
+                response = await client.get(scenario.path, params=scenario.params)
+                latencies.append(time.perf_counter() - started)
+                response.raise_for_status()
+
+            plans = [
+                explain(statement, parameters)
+                for statement, parameters in statements
+                if statement.lstrip().upper().startswith("SELECT")
+            ]
+            latency = latency_summary(latencies)
+            result = {
+                **asdict(scenario),
+                "rows": rows,
+                "requests": args.repeat,
+                "latency_ms": latency,
+                "p50_ms": latency["p50"],
+                "plans": plans,
+            }
+            results.append(result)
+            logger.info(
+                "%s: p50 %.1f ms, p99 %.1f ms, %s",
+                scenario.name,
+                result["latency_ms"]["p50"],
+                result["latency_ms"]["p99"],
+                ", ".join(
+                    f"{plan['execution_ms']:.1f} ms"
+                    f" {plan['shared_hit_blocks']}+{plan['shared_read_blocks']} blocks"
+                    for plan in plans
+                ),
+            )
+    await async_engine.dispose()
+    return results
+
+
+def run(args: argparse.Namespace) -> None:
+    results = asyncio.run(run_scenarios(args))
+    write_results(
+        args.output,
+        "queries",
+        {
+            key: value
+            for key, value in vars(args).items()
+            if key not in ("output", "baseline", "command", "handler")
+        },
+        results,
+    )
+    logger.info("Results written to %s", args.output)
+    if args.baseline:
+        for result, change in compare_results(
+            results, load_results(args.baseline), ["name"], "p50_ms"
+        ):
+            logger.info("%s: %+.1f%% p50 latency", result["name"], change * 100)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Measure telemetry queries")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    seed_parser = commands.add_parser("seed", help="Fill the database")
+    seed_parser.add_argument("--devices", type=int, default=2_000)
+    seed_parser.add_argument(
+        "--days", type=int, default=60, help="Days of telemetry up to today"
+    )
+    seed_parser.add_argument(
+        "--interval", type=int, default=300, help="Seconds between reports"
+    )
+    seed_parser.add_argument(
+        "--compress-after",
+        type=int,
+        default=7,
+        help="Compress the chunks older than this many days",
+    )
+    seed_parser.add_argument("--users", type=int, default=1_000)
+    seed_parser.add_argument("--items-per-user", type=int, default=20)
+    seed_parser.set_defaults(handler=seed)
+
+    run_parser = commands.add_parser("run", help="Time the scenarios")
+    run_parser.add_argument("--repeat", type=int, default=20)
+    run_parser.add_argument(
+        "--page-depths", type=int, nargs="+", default=[1_000, 100_000]
+    )
+    run_parser.add_argument(
+        "--old-days",
+        type=int,
+        default=30,
+        help="Age of the compressed hour queried, in days",
+    )
+    run_parser.add_argument(
+        "--output", type=Path, default=Path("benchmark-results/queries.json")
+    )
+    run_parser.add_argument(
+        "--baseline", type=Path, help="Results of an earlier run to compare with"
+    )
+    run_parser.set_defaults(handler=run)
+
+    args = parser.parse_args()
+    args.handler(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+Latency statistics and result files shared by the benchmarks.
+
+Results are written as JSON with the revision and environment they were
+measured on, so runs of different releases can be compared.
+"""
+
+import json
+import platform
+import statistics
+import subprocess
+from collections.abc import Sequence
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any
+
+
+def latency_summary(seconds: Sequence[float]) -> dict[str, float]:
+    """Percentiles of a list of durations, in milliseconds"""
+    if not seconds:
+        return {"p50": 0.0, "p90": 0.0, "p99": 0.0, "max": 0.0}
+    milliseconds = sorted(duration * 1000 for duration in seconds)
+    if len(milliseconds) == 1:
+        percentiles = milliseconds * 99
+    else:
+        percentiles = statistics.quantiles(milliseconds, n=100, method="inclusive")
+    return {
+        "p50": round(percentiles[49], 3),
+        "p90": round(percentiles[89], 3),
+        "p99": round(percentiles[98], 3),
+        "max": round(milliseconds[-1], 3),
+    }
+
+
+def git_revision() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            check=True,
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def write_results(
+    path: Path,
+    benchmark: str,
+    parameters: dict[str, Any],
+    results: Sequence[dict[str, Any]],
+) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    document = {
+        "benchmark": benchmark,
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": parameters,
+        "results": list(results),
+    }
+    path.write_text(json.dumps(document, indent=2, default=str) + "\n")
+
+
+def load_results(path: Path) -> list[dict[str, Any]]:
+    results: list[dict[str, Any]] = json.loads(path.read_text())["results"]
+    return results
+
+
+def compare_results(
+    results: Sequence[dict[str, Any]],
+    baseline: Sequence[dict[str, Any]],
+    key: Sequence[str],
+    metric: str,
+) -> list[tuple[dict[str, Any], float]]:
+    """
+    Match results to the baseline run by the key fields and return the
+    relative change of metric for each one found.
+    """
+    previous = {tuple(result[field] for field in key): result for result in baseline}
+    changes = []
+    for result in results:
+        match = previous.get(tuple(result[field] for field in key))
+        if match is not None and match[metric]:
+            changes.append((result, result[metric] / match[metric] - 1))
+    return changes
@@ -0,0 +1,151 @@
+"""
+Arrow IPC stream and Parquet encoding of query results, for columnar
+responses. pyarrow is optional (the arrow extra), check available() first.
+
+Record batches are built column by column from batches of result rows and
+encoded as they are written, so large results can be streamed.
+"""
+
+from collections.abc import Callable, Sequence
+from typing import Any, Literal
+
+from sqlalchemy import (
+    JSON,
+    BigInteger,
+    Boolean,
+    ColumnElement,
+    DateTime,
+    Float,
+    Integer,
+    String,
+    Uuid,
+)
+from sqlalchemy.types import TypeDecorator, TypeEngine
+
+from app.core import jsonlib
+
+try:
+    import pyarrow  # type: ignore[import-untyped]
+    import pyarrow.parquet  # type: ignore[import-untyped]
+except ImportError:  # pragma: no cover
+    pyarrow = None
+
+ARROW_STREAM_MEDIA_TYPE = "application/vnd.apache.arrow.stream"
+PARQUET_MEDIA_TYPE = "application/vnd.apache.parquet"
+
+FileFormat = Literal["arrow", "parquet"]
+
+# Canonical extension type of JSON text in a string column
+_JSON_METADATA = {b"ARROW:extension:name": b"arrow.json"}
+
+
+def _json_text(value: Any) -> str:
+    return jsonlib.dumps(value).decode()
+
+
+# Arrow types of column types, and the conversion of their values, in lookup
+# order
+_ARROW_TYPES: tuple[
+    tuple[type[TypeEngine[Any]], Callable[[], Any], Callable[[Any], Any] | None],
+    ...,
+] = (
+    (Boolean, lambda: pyarrow.bool_(), None),
+    (BigInteger, lambda: pyarrow.int64(), None),
+    (Integer, lambda: pyarrow.int32(), None),
+    (Float, lambda: pyarrow.float64(), None),
+    (DateTime, lambda: pyarrow.timestamp("us"), None),
+    (JSON, lambda: pyarrow.string(), _json_text),
+    (Uuid, lambda: pyarrow.string(), str),
+    (String, lambda: pyarrow.string(), None),
+)
+
+
+def available() -> bool:
+    return pyarrow is not None
+
+
+def _arrow_field(column: ColumnElement[Any]) -> tuple[Any, Callable[[Any], Any] | None]:
+    type_ = column.type
+    if isinstance(type_, TypeDecorator):
+        type_ = type_.impl_instance
+    for sa_type, arrow_type, convert in _ARROW_TYPES:
+        if isinstance(type_, sa_type):
+            metadata = _JSON_METADATA if isinstance(type_, JSON) else None
+            field = pyarrow.field(column.name, arrow_type(), metadata=metadata)
+            return field, convert
+    raise TypeError(f"Unsupported column type for Arrow: {type_!r}")
+
+
+class _Sink:
+    """Output stream of a writer, the bytes written are taken as chunks"""
+
+    closed = False
+
+    def __init__(self) -> None:
+        self._chunks: list[bytes] = []
+        self._position = 0
+
+    def write(self, data: bytes) -> int:
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+    def take(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+class RecordBatchWriter:
+    """
+    Encode batches of result rows as an Arrow IPC stream or a Parquet file,
+    with one field per selected column. Rows may hold more values than there
+    are columns, the values past them are left out.
+
+    write() returns the bytes of each batch and close() the end of the
+    stream. Each batch becomes a record batch, or a Parquet row group.
+    """
+
+    def __init__(
+        self, columns: Sequence[ColumnElement[Any]], file_format: FileFormat
+    ) -> None:
+        fields = [_arrow_field(column) for column in columns]
+        self.schema = pyarrow.schema([field for field, _ in fields])
+        self._converters = [convert for _, convert in fields]
+        self._sink = _Sink()
+        if file_format == "parquet":
+            self._writer = pyarrow.parquet.ParquetWriter(self._sink, self.schema)
+        else:
+            self._writer = pyarrow.ipc.new_stream(self._sink, self.schema)
+
+    def _record_batch(self, rows: Sequence[Sequence[Any]]) -> Any:
+        # Rows are transposed into columns once, values are converted only
+        # for the types that need it
+        columns = zip(*rows, strict=False)
+        arrays = []
+        for field, convert, column in zip(
+            self.schema, self._converters, columns, strict=False
+        ):
+            values: Sequence[Any] = column
+            if convert is not None:
+                values = [None if value is None else convert(value) for value in column]
+            arrays.append(pyarrow.array(values, type=field.type))
+        return pyarrow.RecordBatch.from_arrays(arrays, schema=self.schema)
+
+    def write(self, rows: Sequence[Sequence[Any]]) -> bytes:
+        if rows:
+            self._writer.write_batch(self._record_batch(rows))
+        return self._sink.take()
+
+    def close(self) -> bytes:
+        self._writer.close()
+        return self._sink.take()
@@ -68,6 +68,50 @@ class Settings(BaseSettings):
             path=self.TIMESCALE_DB,
         )
 
+    # How telemetry rows are written: ORM objects, multi-row INSERT or binary COPY
+    TELEMETRY_WRITE_STRATEGY: Literal["orm", "insert", "copy"] = "copy"
+    # Skip resent reports (same device, timestamp and event.seqnum). Needs the
+    # unique index created by migration 1043207a1a90, which it skips when
+    # this is off. Off, COPY writes straight into telemetrydata.
+    TELEMETRY_DEDUPLICATE: bool = True
+    # Store accumulators in the accumulator_N columns or packed in one array
+    TELEMETRY_ACCUMULATORS: Literal["columns", "array"] = "columns"
+    # Rows an export fetches from its server-side cursor at a time
+    TELEMETRY_EXPORT_BATCH_SIZE: int = 10_000
+    # Buckets an aggregation may return per device
+    TELEMETRY_MAX_BUCKETS: int = 10_000
+    # Number of reports parsed from an upload before they are processed
+    INGEST_CHUNK_SIZE: int = 1_000
+    # Limit on the size of an upload once its Content-Encoding is decoded
+    INGEST_MAX_DECOMPRESSED_BYTES: int = 256 * 1024 * 1024
+    # Store whole reports in raw_data, or only the keys not mapped to a column
+    INGEST_RAW_DATA: Literal["full", "unmapped"] = "full"
+    # Buffer accepted reports in memory and write them in batches in the background
+    INGEST_QUEUE_ENABLED: bool = True
+    INGEST_QUEUE_MAX_ROWS: int = 100_000
+    INGEST_QUEUE_PUT_TIMEOUT_MS: int = 1_000
+    INGEST_BATCH_SIZE: int = 5_000
+    INGEST_FLUSH_INTERVAL_MS: int = 200
+    # Write accepted reports to a local spool on disk first, takes precedence
+    # over the in-memory queue
+    INGEST_SPOOL_ENABLED: bool = False
+    INGEST_SPOOL_DIR: str = "/var/spool/telemetry"
+    INGEST_SPOOL_SEGMENT_BYTES: int = 64 * 1024 * 1024
+    INGEST_SPOOL_SEGMENT_MS: int = 1_000
+    INGEST_SPOOL_FSYNC_INTERVAL_MS: int = 5
+    # Drain the spool into the database from the API workers, disable when
+    # running app.ingest_worker instead
+    INGEST_SPOOL_REPLAY_ENABLED: bool = True
+    INGEST_WORKER_PROCESSES: int = 1
+    # Devices resolved by ingest, cached in shared memory for all workers of
+    # a host, or per process when the path is empty. The file name gets a
+    # suffix identifying the database.
+    DEVICE_CACHE_MAX_SIZE: int = 100_000
+    DEVICE_CACHE_TTL_SECONDS: int = 300
+    DEVICE_CACHE_SHARED_PATH: str | None = "/dev/shm/telemetry-devices"
+    # Apply device changes from other processes and hosts (LISTEN/NOTIFY)
+    DEVICE_CACHE_LISTEN_ENABLED: bool = True
+
     SMTP_TLS: bool = True
     SMTP_SSL: bool = False
     SMTP_PORT: int = 587
@@ -0,0 +1,282 @@
+"""
+Cache of the devices reports are resolved to.
+
+The fleet is stable, so ingest caches provider_device_id to device and owner
+id with a TTL. Devices missing from the cache are created or resolved in bulk
+by the pipeline and cached once the transaction that resolved them commits.
+
+The cache is either a hash table in shared memory, read by all worker
+processes of a host, or a per-process LRU. Changes to devices are broadcast
+with NOTIFY on the device_changed channel, and every process LISTENs to apply
+them to its cache.
+"""
+
+import asyncio
+import hashlib
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from collections.abc import Iterable, Mapping
+from pathlib import Path
+from typing import NamedTuple
+
+import psycopg
+from sqlalchemy import TextClause, event, make_url, text
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from app.core import jsonlib
+from app.core.config import settings
+from app.ingest.shm import SharedHashTable
+
+logger = logging.getLogger(__name__)
+
+# Session.info key of devices resolved in the session's transaction
+PENDING_DEVICES = "pending_devices"
+
+DEVICE_CHANGED_CHANNEL = "device_changed"
+
+
+class CachedDevice(NamedTuple):
+    device_id: uuid.UUID
+    owner_id: uuid.UUID
+
+
+class DeviceCache:
+    """Bounded LRU cache of provider_device_id to device, with a TTL"""
+
+    def __init__(self, max_size: int, ttl: float) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        # Entries and their expiry time, least recently used first
+        self._entries: OrderedDict[str, tuple[float, CachedDevice]] = OrderedDict()
+        # The devices routes run in the threadpool
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get_many(self, provider_device_ids: Iterable[str]) -> dict[str, CachedDevice]:
+        """Return the cached devices among provider_device_ids"""
+        now = time.monotonic()
+        found: dict[str, CachedDevice] = {}
+        requested = 0
+        with self._lock:
+            for provider_device_id in provider_device_ids:
+                requested += 1
+                entry = self._entries.get(provider_device_id)
+                if entry is None:
+                    continue
+                expires, device = entry
+                if expires <= now:
+                    del self._entries[provider_device_id]
+                    continue
+                self._entries.move_to_end(provider_device_id)
+                found[provider_device_id] = device
+        self.hits += len(found)
+        self.misses += requested - len(found)
+        return found
+
+    def put_many(self, devices: Mapping[str, CachedDevice]) -> None:
+        expires = time.monotonic() + self.ttl
+        with self._lock:
+            for provider_device_id, device in devices.items():
+                self._entries[provider_device_id] = (expires, device)
+                self._entries.move_to_end(provider_device_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, provider_device_id: str | None) -> None:
+        if provider_device_id is None:
+            return
+        with self._lock:
+            self._entries.pop(provider_device_id, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+class SharedDeviceCache:
+    """Device cache in a hash table shared by the worker processes of a host"""
+
+    def __init__(self, path: Path, max_size: int, ttl: float) -> None:
+        self.ttl = ttl
+        self._table = SharedHashTable(path, max_size)
+
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, provider_device_ids: Iterable[str]) -> dict[str, CachedDevice]:
+        """Return the cached devices among provider_device_ids"""
+        now = time.time()
+        found: dict[str, CachedDevice] = {}
+        requested = 0
+        for provider_device_id in provider_device_ids:
+            requested += 1
+            value = self._table.get(provider_device_id, now)
+            if value is not None:
+                found[provider_device_id] = CachedDevice(
+                    uuid.UUID(bytes=value[:16]), uuid.UUID(bytes=value[16:])
+                )
+        self.hits += len(found)
+        self.misses += requested - len(found)
+        return found
+
+    def put_many(self, devices: Mapping[str, CachedDevice]) -> None:
+        self._table.put_many(
+            {
+                provider_device_id: device.device_id.bytes + device.owner_id.bytes
+                for provider_device_id, device in devices.items()
+            },
+            time.time() + self.ttl,
+        )
+
+    def invalidate(self, provider_device_id: str | None) -> None:
+        if provider_device_id is not None:
+            self._table.delete(provider_device_id)
+
+    def clear(self) -> None:
+        self._table.clear()
+
+
+def _shared_cache_path(path: str) -> Path:
+    """
+    Path of the shared cache of the configured database. Deployments on one
+    host using other databases get other files, and never see its devices.
+    """
+    database = (
+        f"{settings.TIMESCALE_USER}@{settings.TIMESCALE_SERVER}:"
+        f"{settings.TIMESCALE_PORT}/{settings.TIMESCALE_DB}"
+    )
+    digest = hashlib.blake2b(database.encode(), digest_size=8).hexdigest()
+    return Path(f"{path}-{digest}")
+
+
+device_cache: DeviceCache | SharedDeviceCache
+if settings.DEVICE_CACHE_SHARED_PATH:
+    device_cache = SharedDeviceCache(
+        _shared_cache_path(settings.DEVICE_CACHE_SHARED_PATH),
+        max_size=settings.DEVICE_CACHE_MAX_SIZE,
+        ttl=settings.DEVICE_CACHE_TTL_SECONDS,
+    )
+else:
+    device_cache = DeviceCache(
+        max_size=settings.DEVICE_CACHE_MAX_SIZE,
+        ttl=settings.DEVICE_CACHE_TTL_SECONDS,
+    )
+
+
+def add_pending_devices(
+    session: AsyncSession | Session, devices: Mapping[str, CachedDevice]
+) -> None:
+    """Cache devices once the session's transaction commits"""
+    session.info.setdefault(PENDING_DEVICES, {}).update(devices)
+
+
+@event.listens_for(Session, "after_commit")
+def _cache_committed_devices(session: Session) -> None:
+    pending = session.info.pop(PENDING_DEVICES, None)
+    if pending:
+        device_cache.put_many(pending)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_pending_devices(session: Session) -> None:
+    session.info.pop(PENDING_DEVICES, None)
+
+
+def notify_devices_changed(
+    changes: Iterable[tuple[str | None, CachedDevice | None]],
+) -> TextClause:
+    """
+    Statement notifying every process of changed devices on commit.
+
+    Created devices carry their device so listeners can cache them, changed
+    or deleted ones are only invalidated.
+    """
+    payloads = [
+        jsonlib.dumps(
+            {"provider_device_id": provider_device_id}
+            if device is None
+            else {
+                "provider_device_id": provider_device_id,
+                "device_id": str(device.device_id),
+                "owner_id": str(device.owner_id),
+            }
+        ).decode()
+        for provider_device_id, device in changes
+        if provider_device_id is not None
+    ]
+    return text(
+        "SELECT pg_notify(:channel, payload)"
+        " FROM unnest(CAST(:payloads AS text[])) AS payload"
+    ).bindparams(channel=DEVICE_CHANGED_CHANNEL, payloads=payloads)
+
+
+def apply_device_change(payload: str) -> None:
+    change = jsonlib.loads(payload)
+    provider_device_id = change["provider_device_id"]
+    if "device_id" in change:
+        device = CachedDevice(
+            uuid.UUID(change["device_id"]), uuid.UUID(change["owner_id"])
+        )
+        device_cache.put_many({provider_device_id: device})
+    else:
+        device_cache.invalidate(provider_device_id)
+
+
+class DeviceChangeListener:
+    """LISTENs for device changes and applies them to the device cache"""
+
+    def __init__(self, retry_interval: float) -> None:
+        self.retry_interval = retry_interval
+        self._task: asyncio.Task[None] | None = None
+
+    async def run(self) -> None:
+        conninfo = (
+            make_url(str(settings.SQLALCHEMY_DATABASE_URI))
+            .set(drivername="postgresql")
+            .render_as_string(hide_password=False)
+        )
+        connected_before = False
+        while True:
+            try:
+                async with await psycopg.AsyncConnection.connect(
+                    conninfo, autocommit=True
+                ) as connection:
+                    await connection.execute(f"LISTEN {DEVICE_CHANGED_CHANNEL}")
+                    if connected_before:
+                        # Changes made while disconnected were missed
+                        device_cache.clear()
+                    connected_before = True
+                    async for notify in connection.notifies():
+                        try:
+                            apply_device_change(notify.payload)
+                        except (ValueError, KeyError):
+                            logger.exception("Invalid device change %r", notify.payload)
+            except psycopg.OperationalError:
+                logger.exception("Listening for device changes failed, retrying")
+                await asyncio.sleep(self.retry_interval)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+
+device_listener = DeviceChangeListener(retry_interval=1.0)
@@ -0,0 +1,208 @@
+"""
+Declarative mapping of dotted report keys to telemetrydata columns.
+
+The mapping table is compiled once at import into ``extract_row``, a
+generated function that turns a report into a plain tuple in
+``ROW_COLUMNS`` order without building any model instances.
+
+The raw_data column holds either the whole report (``full``) or only the keys
+that aren't mapped to a column (``unmapped``), chosen with the
+INGEST_RAW_DATA setting.
+"""
+
+from collections.abc import Callable, Iterable, Mapping, Sequence
+from datetime import datetime
+from datetime import timezone as tz
+from itertools import repeat
+from typing import Any, Literal, NamedTuple
+
+Row = tuple[Any, ...]
+
+RawDataMode = Literal["full", "unmapped"]
+
+REQUIRED_FIELDS = ("timestamp", "server.timestamp", "device.id")
+
+
+def to_datetime(value: Any) -> datetime:
+    """Convert a Unix timestamp to a naive UTC datetime"""
+    return datetime.fromtimestamp(float(value), tz.utc).replace(tzinfo=None)
+
+
+def to_int4(value: Any) -> int:
+    """Convert to an int that fits the 4 byte integer columns"""
+    converted = int(value)
+    if not -(2**31) <= converted < 2**31:
+        raise ValueError(f"Integer out of range: {value!r}")
+    return converted
+
+
+def to_bool(value: Any) -> bool:
+    if isinstance(value, str):
+        return value.strip().lower() in ("1", "true", "yes", "on")
+    return bool(value)
+
+
+class FieldMapping(NamedTuple):
+    """A report key, the column it is stored in and how to convert it"""
+
+    column: str
+    source: str
+    converter: Callable[[Any], Any] | None = None
+    default: Any = None
+
+
+FIELD_MAPPINGS: tuple[FieldMapping, ...] = (
+    FieldMapping("ident", "ident", str, "unknown_device"),
+    FieldMapping("position_altitude", "position.altitude", float),
+    FieldMapping("position_hdop", "position.hdop", float),
+    FieldMapping("position_latitude", "position.latitude", float),
+    FieldMapping("position_longitude", "position.longitude", float),
+    FieldMapping("position_satellites", "position.satellites", to_int4),
+    FieldMapping("server_timestamp", "server.timestamp", to_datetime),
+    FieldMapping("timestamp", "timestamp", to_datetime),
+    FieldMapping("device_type_id", "device.type.id", to_int4),
+    FieldMapping("channel_id", "channel.id", to_int4),
+    FieldMapping("protocol_id", "protocol.id", to_int4),
+    FieldMapping("engine_ignition_status", "engine.ignition.status", to_bool, False),
+    FieldMapping("provider_device_id", "device.id", str),
+    FieldMapping("device_name", "device.name", str),
+    FieldMapping("din", "din", to_int4),
+    FieldMapping("event_enum", "event.enum", to_int4),
+    FieldMapping("event_seqnum", "event.seqnum", to_int4),
+    FieldMapping("gnss_antenna_status", "gnss.antenna.status", str),
+    FieldMapping("gsm_network_roaming_status", "gsm.network.roaming.status", str),
+    FieldMapping("message_type_enum", "message.type.enum", to_int4),
+    FieldMapping("peer", "peer", str),
+    FieldMapping("position_direction", "position.direction", float),
+    FieldMapping("position_speed", "position.speed", float),
+    FieldMapping("position_valid", "position.valid", to_bool),
+    FieldMapping("timestamp_key", "timestamp.key", to_int4),
+    *(FieldMapping(f"accumulator_{i}", f"accumulator.{i}", float) for i in range(16)),
+)
+
+MAPPED_SOURCES = frozenset(mapping.source for mapping in FIELD_MAPPINGS)
+
+ACCUMULATOR_COLUMNS = tuple(f"accumulator_{i}" for i in range(16))
+
+# Columns of the tuples returned by extract_row, the raw report comes last
+ROW_COLUMNS: tuple[str, ...] = (
+    *(mapping.column for mapping in FIELD_MAPPINGS),
+    "raw_data",
+)
+
+
+def unmapped_fields(report: dict[str, Any]) -> dict[str, Any] | None:
+    """Return the keys of a report that aren't mapped to a column, if any"""
+    unmapped = {
+        key: value for key, value in report.items() if key not in MAPPED_SOURCES
+    }
+    return unmapped or None
+
+
+def pack_accumulators(values: Sequence[float | None]) -> list[float | None] | None:
+    """
+    Pack accumulator values into the accumulators array.
+
+    Trailing nulls are dropped, so sparse accumulators take little space, and
+    None is returned when every value is null.
+    """
+    end = len(values)
+    while end and values[end - 1] is None:
+        end -= 1
+    return list(values[:end]) if end else None
+
+
+def compile_extractor(
+    mappings: Sequence[FieldMapping], raw_data: RawDataMode = "full"
+) -> Callable[[dict[str, Any]], Row]:
+    """
+    Generate a function returning the mapped values of a report as a tuple.
+
+    Each converter is only applied to values that are present and not null,
+    otherwise the mapping's default is used.
+    """
+    namespace: dict[str, Any] = {"_unmapped_fields": unmapped_fields}
+    values: list[str] = []
+    for i, mapping in enumerate(mappings):
+        namespace[f"_default_{i}"] = mapping.default
+        if mapping.converter is None:
+            values.append(f"get({mapping.source!r}, _default_{i})")
+            continue
+        namespace[f"_convert_{i}"] = mapping.converter
+        values.append(
+            f"_convert_{i}(value) if (value := get({mapping.source!r})) is not None"
+            f" else _default_{i}"
+        )
+    source = "def extract_row(report):\n    get = report.get\n    return (\n"
+    source += "".join(f"        {value},\n" for value in values)
+    if raw_data == "full":
+        source += "        report,\n    )\n"
+    else:
+        source += "        _unmapped_fields(report),\n    )\n"
+    exec(compile(source, "<telemetry field mapping>", "exec"), namespace)
+    extractor: Callable[[dict[str, Any]], Row] = namespace["extract_row"]
+    return extractor
+
+
+extract_row = compile_extractor(FIELD_MAPPINGS)
+_EXTRACTORS: dict[RawDataMode, Callable[[dict[str, Any]], Row]] = {
+    "full": extract_row,
+    "unmapped": compile_extractor(FIELD_MAPPINGS, raw_data="unmapped"),
+}
+
+
+def validate_report(report: dict[str, Any]) -> None:
+    """Validate a report dictionary"""
+    missing_fields = [field for field in REQUIRED_FIELDS if not report.get(field)]
+    if missing_fields:
+        raise ValueError(f"Missing required fields: {', '.join(missing_fields)}")
+
+
+def extract_rows(
+    reports: Sequence[dict[str, Any]], raw_data: RawDataMode = "full"
+) -> list[Row]:
+    """Validate reports and convert them into rows"""
+    extract = _EXTRACTORS[raw_data]
+    rows = []
+    for report in reports:
+        validate_report(report)
+        rows.append(extract(report))
+    return rows
+
+
+def extract_columns(columns: Mapping[str, Sequence[Any]], length: int) -> list[Row]:
+    """
+    Validate reports given column-wise, keyed by report key, and convert them
+    into rows.
+
+    Each mapping is applied to a whole column at once. Only the keys without a
+    mapping are kept per row in raw_data.
+    """
+    missing_fields = [
+        field
+        for field in REQUIRED_FIELDS
+        if field not in columns or not all(columns[field])
+    ]
+    if missing_fields:
+        raise ValueError(f"Missing required fields: {', '.join(missing_fields)}")
+
+    values: list[Iterable[Any]] = []
+    for mapping in FIELD_MAPPINGS:
+        column = columns.get(mapping.source)
+        if column is None:
+            values.append(repeat(mapping.default, length))
+        elif mapping.converter is None:
+            values.append(column)
+        else:
+            convert, default = mapping.converter, mapping.default
+            values.append([default if v is None else convert(v) for v in column])
+
+    unmapped = [key for key in columns if key not in MAPPED_SOURCES]
+    raw_data: Iterable[Any] = repeat(None, length)
+    if unmapped:
+        raw_data = [
+            dict(zip(unmapped, row, strict=True))
+            for row in zip(*(columns[key] for key in unmapped), strict=True)
+        ]
+    # Missing columns repeat their default endlessly
+    return list(zip(*values, raw_data, strict=False))
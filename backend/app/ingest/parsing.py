@@ -0,0 +1,366 @@
+"""
+Incremental parsing of report uploads.
+
+Request bodies are decompressed and parsed while they are received and handed
+out in chunks of a fixed number of reports, so memory stays bounded regardless
+of the size of the upload. JSON bodies (a single report or an array of
+reports) go through a streaming parser and NDJSON bodies are parsed line by
+line. Small JSON bodies are decoded in one go, which is faster.
+
+MessagePack bodies are a sequence of report maps (or one array of them).
+Arrow IPC stream and Parquet bodies hold one column per report key and are
+converted to rows column by column, without building a dict per report. Arrow
+streams are read record batch by record batch as they arrive. Parquet files
+are read from their footer, so they are stored first, on disk once large.
+"""
+
+import asyncio
+import io
+import tempfile
+import zlib
+from collections.abc import AsyncIterator, Iterator
+from typing import Any
+
+import ijson  # type: ignore[import-untyped]
+
+from app.core import jsonlib
+from app.ingest.mapping import RawDataMode, Row, extract_columns, extract_rows
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None  # type: ignore[assignment]
+
+try:
+    import msgpack  # type: ignore[import-untyped]
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+NDJSON_CONTENT_TYPES = frozenset(
+    {"application/x-ndjson", "application/ndjson", "application/jsonl"}
+)
+MSGPACK_CONTENT_TYPES = frozenset(
+    {"application/msgpack", "application/x-msgpack", "application/vnd.msgpack"}
+)
+ARROW_CONTENT_TYPES = frozenset({"application/vnd.apache.arrow.stream"})
+PARQUET_CONTENT_TYPES = frozenset(
+    {"application/vnd.apache.parquet", "application/x-parquet"}
+)
+
+# JSON bodies up to this size are buffered and decoded at once
+BUFFERED_JSON_LIMIT = 1024 * 1024
+# Parquet bodies up to this size are stored in memory, larger ones on disk
+BUFFERED_BODY_LIMIT = 8 * 1024 * 1024
+
+# Bound the output of each decompression step, so a small compressed chunk
+# can't expand into an arbitrarily large buffer
+_DECOMPRESS_STEP = 64 * 1024
+_ZSTD_INPUT_STEP = 1024
+# zstd can't bound the output of a step, but a block of 4 bytes decodes to at
+# most 128 KiB, so the input of a step is sized to the remaining size limit
+_ZSTD_MAX_RATIO = 128 * 1024 // 4
+
+
+class UnsupportedEncodingError(ValueError):
+    """The request body uses a Content-Encoding that can't be decoded"""
+
+
+class PayloadTooLargeError(ValueError):
+    """The decompressed request body exceeds the configured limit"""
+
+
+class UnsupportedMediaTypeError(ValueError):
+    """The request body uses a Content-Type that can't be parsed"""
+
+
+def media_type(content_type: str | None) -> str:
+    return (content_type or "").split(";", 1)[0].strip().lower()
+
+
+async def _gunzip(chunks: AsyncIterator[bytes], wbits: int) -> AsyncIterator[bytes]:
+    decompressor = zlib.decompressobj(wbits=wbits)
+    async for chunk in chunks:
+        data = chunk
+        while data:
+            output = decompressor.decompress(data, _DECOMPRESS_STEP)
+            data = decompressor.unconsumed_tail
+            if output:
+                yield output
+    output = decompressor.flush()
+    if output:
+        yield output
+    if not decompressor.eof:
+        raise ValueError("Truncated compressed request body")
+    if decompressor.unused_data:
+        raise ValueError("Unexpected data after the compressed request body")
+
+
+async def _unzstd(chunks: AsyncIterator[bytes], max_size: int) -> AsyncIterator[bytes]:
+    if zstandard is None:
+        raise UnsupportedEncodingError("zstd request bodies are not supported")
+    decompressor = zstandard.ZstdDecompressor().decompressobj()
+    size = 0
+    async for chunk in chunks:
+        start = 0
+        while start < len(chunk):
+            if decompressor.eof:
+                raise ValueError("Unexpected data after the compressed request body")
+            step = min(max((max_size - size) // _ZSTD_MAX_RATIO, 4), _ZSTD_INPUT_STEP)
+            output = decompressor.decompress(chunk[start : start + step])
+            start += step
+            if output:
+                size += len(output)
+                yield output
+    if not decompressor.eof:
+        raise ValueError("Truncated compressed request body")
+    if decompressor.unused_data:
+        raise ValueError("Unexpected data after the compressed request body")
+
+
+async def decode_body(
+    chunks: AsyncIterator[bytes], content_encoding: str | None, max_size: int
+) -> AsyncIterator[bytes]:
+    """Decompress a request body according to its Content-Encoding"""
+    encoding = (content_encoding or "identity").strip().lower()
+    if encoding in ("gzip", "x-gzip"):
+        decoded = _gunzip(chunks, zlib.MAX_WBITS | 16)
+    elif encoding == "deflate":
+        decoded = _gunzip(chunks, zlib.MAX_WBITS)
+    elif encoding == "zstd":
+        decoded = _unzstd(chunks, max_size)
+    elif encoding == "identity":
+        decoded = chunks
+    else:
+        raise UnsupportedEncodingError(f"Unsupported Content-Encoding: {encoding}")
+    size = 0
+    async for chunk in decoded:
+        size += len(chunk)
+        if size > max_size:
+            raise PayloadTooLargeError(
+                f"Request body exceeds {max_size} bytes once decompressed"
+            )
+        yield chunk
+
+
+async def _iter_json(chunks: AsyncIterator[bytes]) -> AsyncIterator[Any]:
+    buffered: list[bytes] = []
+    buffered_size = 0
+    reports: list[Any] = ijson.sendable_list()
+    parser = None
+    async for chunk in chunks:
+        if parser is None:
+            buffered.append(chunk)
+            buffered_size += len(chunk)
+            if buffered_size <= BUFFERED_JSON_LIMIT:
+                continue
+            head = b"".join(buffered)
+            buffered = []
+            # An array yields its items, a single object yields itself
+            prefix = "item" if head.lstrip().startswith(b"[") else ""
+            parser = ijson.items_coro(reports, prefix, use_float=True)
+            chunk = head
+        parser.send(chunk)
+        for report in reports:
+            yield report
+        del reports[:]
+
+    if parser is None:
+        body = b"".join(buffered)
+        if not body.strip():
+            raise ValueError("Empty request body")
+        decoded = jsonlib.loads(body)
+        for report in decoded if isinstance(decoded, list) else [decoded]:
+            yield report
+        return
+
+    parser.close()
+    for report in reports:
+        yield report
+
+
+async def _iter_ndjson(chunks: AsyncIterator[bytes]) -> AsyncIterator[Any]:
+    pending = b""
+    async for chunk in chunks:
+        lines = (pending + chunk).split(b"\n")
+        pending = lines.pop()
+        for line in lines:
+            if line.strip():
+                yield jsonlib.loads(line)
+    if pending.strip():
+        yield jsonlib.loads(pending)
+
+
+async def _iter_msgpack(chunks: AsyncIterator[bytes]) -> AsyncIterator[Any]:
+    if msgpack is None:
+        raise UnsupportedMediaTypeError("MessagePack request bodies are not supported")
+    unpacker = msgpack.Unpacker(raw=False)
+    fed = 0
+    async for chunk in chunks:
+        unpacker.feed(chunk)
+        fed += len(chunk)
+        for unpacked in unpacker:
+            if isinstance(unpacked, list):
+                for report in unpacked:
+                    yield report
+            else:
+                yield unpacked
+    if unpacker.tell() < fed:
+        raise ValueError("Truncated MessagePack request body")
+
+
+class _BodyReader(io.RawIOBase):
+    """
+    Blocking file over a request body, for readers running in a thread.
+
+    Each chunk is received by the event loop when the reader needs it, so
+    only the chunk being read is held in memory.
+    """
+
+    def __init__(
+        self, chunks: AsyncIterator[bytes], loop: asyncio.AbstractEventLoop
+    ) -> None:
+        self._chunks = chunks
+        self._loop = loop
+        self._pending = b""
+        self._done = False
+
+    def readable(self) -> bool:
+        return True
+
+    async def _next_chunk(self) -> bytes:
+        return await anext(self._chunks)
+
+    def _receive(self) -> None:
+        future = asyncio.run_coroutine_threadsafe(self._next_chunk(), self._loop)
+        try:
+            self._pending = future.result()
+        except StopAsyncIteration:
+            self._done = True
+
+    def read(self, size: int | None = -1) -> bytes:
+        # Readers expect short reads only at the end of the body
+        parts = []
+        wanted = -1 if size is None else size
+        while wanted and not self._done:
+            if not self._pending:
+                self._receive()
+                continue
+            part = self._pending if wanted < 0 else self._pending[:wanted]
+            self._pending = self._pending[len(part) :]
+            parts.append(part)
+            if wanted > 0:
+                wanted -= len(part)
+        return b"".join(parts)
+
+
+def _next_batch(batches: Iterator[Any]) -> Any:
+    # StopIteration can't be raised through a future
+    return next(batches, None)
+
+
+def _batch_rows(record_batch: Any, chunk_size: int) -> Iterator[list[Row]]:
+    for offset in range(0, record_batch.num_rows, chunk_size):
+        batch = record_batch.slice(offset, chunk_size)
+        columns = {
+            name: column.to_pylist()
+            for name, column in zip(batch.schema.names, batch.columns, strict=True)
+        }
+        yield extract_columns(columns, batch.num_rows)
+
+
+async def _iter_arrow_rows(
+    chunks: AsyncIterator[bytes], chunk_size: int
+) -> AsyncIterator[list[Row]]:
+    try:
+        import pyarrow  # type: ignore[import-untyped]
+    except ImportError as e:  # pragma: no cover
+        raise UnsupportedMediaTypeError("Arrow request bodies are not supported") from e
+    # The IPC reader runs in a thread and reads the body as it arrives, one
+    # record batch at a time
+    body = _BodyReader(chunks, asyncio.get_running_loop())
+    try:
+        reader = await asyncio.to_thread(pyarrow.ipc.open_stream, body)
+    except pyarrow.ArrowInvalid as e:
+        raise ValueError(f"Invalid Arrow stream: {e}") from e
+    batches = iter(reader)
+    while (record_batch := await asyncio.to_thread(_next_batch, batches)) is not None:
+        for rows in _batch_rows(record_batch, chunk_size):
+            yield rows
+
+
+async def _iter_parquet_rows(
+    chunks: AsyncIterator[bytes], chunk_size: int
+) -> AsyncIterator[list[Row]]:
+    try:
+        import pyarrow
+        import pyarrow.parquet  # type: ignore[import-untyped]
+    except ImportError as e:  # pragma: no cover
+        raise UnsupportedMediaTypeError(
+            "Parquet request bodies are not supported"
+        ) from e
+    # Parquet files are read from their footer, so the body is stored first,
+    # in memory while it is small and on disk after. Its size is bounded by
+    # decode_body.
+    with tempfile.SpooledTemporaryFile(max_size=BUFFERED_BODY_LIMIT) as file:
+        async for chunk in chunks:
+            await asyncio.to_thread(file.write, chunk)
+        if not file.tell():
+            raise ValueError("Empty request body")
+        file.seek(0)
+        try:
+            parquet_file = await asyncio.to_thread(pyarrow.parquet.ParquetFile, file)
+        except pyarrow.ArrowInvalid as e:
+            raise ValueError(f"Invalid Parquet file: {e}") from e
+        batches = parquet_file.iter_batches(batch_size=chunk_size)
+        while (
+            record_batch := await asyncio.to_thread(_next_batch, batches)
+        ) is not None:
+            for rows in _batch_rows(record_batch, chunk_size):
+                yield rows
+
+
+async def iter_report_chunks(
+    chunks: AsyncIterator[bytes], content_type: str | None, chunk_size: int
+) -> AsyncIterator[list[dict[str, Any]]]:
+    """Parse a request body into lists of at most chunk_size reports"""
+    body_type = media_type(content_type)
+    if body_type in NDJSON_CONTENT_TYPES:
+        reports = _iter_ndjson(chunks)
+    elif body_type in MSGPACK_CONTENT_TYPES:
+        reports = _iter_msgpack(chunks)
+    else:
+        reports = _iter_json(chunks)
+    batch: list[dict[str, Any]] = []
+    async for report in reports:
+        if not isinstance(report, dict):
+            raise ValueError("Each report must be an object")
+        batch.append(report)
+        if len(batch) >= chunk_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+async def iter_row_chunks(
+    chunks: AsyncIterator[bytes],
+    content_type: str | None,
+    chunk_size: int,
+    raw_data: RawDataMode = "full",
+) -> AsyncIterator[list[Row]]:
+    """
+    Parse and validate a request body into lists of at most chunk_size rows.
+
+    Arrow and Parquet bodies only ever keep the unmapped keys in raw_data.
+    """
+    body_type = media_type(content_type)
+    if body_type in ARROW_CONTENT_TYPES:
+        async for rows in _iter_arrow_rows(chunks, chunk_size):
+            yield rows
+        return
+    if body_type in PARQUET_CONTENT_TYPES:
+        async for rows in _iter_parquet_rows(chunks, chunk_size):
+            yield rows
+        return
+    async for reports in iter_report_chunks(chunks, content_type, chunk_size):
+        yield extract_rows(reports, raw_data)
@@ -0,0 +1,269 @@
+"""
+Telemetry ingest pipeline.
+
+Turns batches of extracted report rows into device state updates and
+telemetrydata rows, written in a single transaction.
+
+Each batch is reduced to the newest row per device, and the state of all its
+devices is upserted into device_state with one statement. The device rows
+themselves are only written when a device is first seen. The last known
+state of a device never moves back in time, so out-of-order batches don't
+overwrite newer positions.
+"""
+
+import uuid
+from collections.abc import Sequence
+from datetime import datetime
+from datetime import timezone as tz
+
+from sqlalchemy import exc, or_
+from sqlalchemy.dialects.postgresql import insert
+from sqlmodel import col, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app.core.config import settings
+from app.core.db import async_engine
+from app.ingest.devices import (
+    CachedDevice,
+    add_pending_devices,
+    device_cache,
+    notify_devices_changed,
+)
+from app.ingest.mapping import (
+    ACCUMULATOR_COLUMNS,
+    ROW_COLUMNS,
+    Row,
+    pack_accumulators,
+)
+from app.ingest.writer import write_telemetry
+from app.models import Device, DeviceState, User
+
+# Errors of a statement caused by values of the rows written
+_ROW_ERRORS = (
+    exc.DataError,
+    exc.IntegrityError,
+    exc.ProgrammingError,
+    ValueError,
+    TypeError,
+)
+
+
+class IngestUnavailableError(Exception):
+    """Rows can't be written for now, for reasons unrelated to them"""
+
+
+def is_row_error(error: BaseException) -> bool:
+    """
+    Whether writing rows failed because of some of them, and would fail again
+    with the same rows. Other errors, like a lost connection or an exhausted
+    pool, may go away when the rows are written again.
+    """
+    if isinstance(error, exc.DBAPIError) and error.connection_invalidated:
+        return False
+    return isinstance(error, _ROW_ERRORS)
+
+
+# Extracted rows are extended with the resolved device and the storage time
+TELEMETRY_ROW_COLUMNS: tuple[str, ...] = (
+    *ROW_COLUMNS,
+    "device_id",
+    "storage_server_timestamp_utc",
+)
+
+# Accumulators are contiguous in extracted rows
+_ACCUMULATORS = slice(
+    ROW_COLUMNS.index(ACCUMULATOR_COLUMNS[0]),
+    ROW_COLUMNS.index(ACCUMULATOR_COLUMNS[-1]) + 1,
+)
+assert ROW_COLUMNS[_ACCUMULATORS] == ACCUMULATOR_COLUMNS
+
+# With TELEMETRY_ACCUMULATORS=array, accumulators are packed into one column
+PACKED_TELEMETRY_ROW_COLUMNS: tuple[str, ...] = (
+    *ROW_COLUMNS[: _ACCUMULATORS.start],
+    *ROW_COLUMNS[_ACCUMULATORS.stop :],
+    "accumulators",
+    "device_id",
+    "storage_server_timestamp_utc",
+)
+
+_PROVIDER_DEVICE_ID = ROW_COLUMNS.index("provider_device_id")
+_DEVICE_NAME = ROW_COLUMNS.index("device_name")
+_TIMESTAMP = ROW_COLUMNS.index("timestamp")
+_LATITUDE = ROW_COLUMNS.index("position_latitude")
+_LONGITUDE = ROW_COLUMNS.index("position_longitude")
+_SPEED = ROW_COLUMNS.index("position_speed")
+_IGNITION = ROW_COLUMNS.index("engine_ignition_status")
+
+
+async def insert_devices(
+    session: AsyncSession, rows: Sequence[Row]
+) -> dict[str, CachedDevice]:
+    """
+    Create or resolve the devices of new provider ids.
+
+    Unknown devices are created and owned by the first superuser, existing
+    ones are left untouched and only looked up. Creations are broadcast to
+    the caches of all processes. Returns the devices by provider_device_id.
+    """
+    owner_id = (
+        await session.exec(
+            select(User.id).where(User.email == settings.FIRST_SUPERUSER)
+        )
+    ).first()
+    if owner_id is None:
+        raise IngestUnavailableError("Superuser not found")
+
+    device_values = [
+        {
+            "id": uuid.uuid4(),
+            "provider_device_id": row[_PROVIDER_DEVICE_ID],
+            "device_name": row[_DEVICE_NAME] or "",
+            "owner_id": owner_id,
+        }
+        for row in rows
+    ]
+    result = await session.execute(
+        insert(Device)
+        .values(device_values)
+        .on_conflict_do_nothing(index_elements=[col(Device.provider_device_id)])
+        .returning(col(Device.provider_device_id), col(Device.id), col(Device.owner_id))
+    )
+    devices = {
+        str(provider_id): CachedDevice(device_id, device_owner_id)
+        for provider_id, device_id, device_owner_id in result
+    }
+    if devices:
+        # Other processes cache the new devices once this transaction commits
+        await session.execute(notify_devices_changed(devices.items()))
+
+    existing = [
+        row[_PROVIDER_DEVICE_ID]
+        for row in rows
+        if row[_PROVIDER_DEVICE_ID] not in devices
+    ]
+    if existing:
+        result = await session.execute(
+            select(
+                col(Device.provider_device_id), col(Device.id), col(Device.owner_id)
+            ).where(col(Device.provider_device_id).in_(existing))
+        )
+        for provider_id, device_id, device_owner_id in result:
+            devices[str(provider_id)] = CachedDevice(device_id, device_owner_id)
+    return devices
+
+
+async def update_device_states(
+    session: AsyncSession, devices: dict[str, CachedDevice], rows: Sequence[Row]
+) -> None:
+    """
+    Upsert the last known state of devices in one statement.
+
+    States whose last_online_timestamp is already newer are left alone.
+    """
+    state_values = sorted(
+        (
+            {
+                "device_id": devices[row[_PROVIDER_DEVICE_ID]].device_id,
+                "last_online_timestamp": row[_TIMESTAMP],
+                "last_reported_latitude": row[_LATITUDE],
+                "last_reported_longitude": row[_LONGITUDE],
+                "last_reported_speed": row[_SPEED],
+                "engine_ignition_status": row[_IGNITION],
+                "is_online": True,
+            }
+            for row in rows
+        ),
+        # Concurrent batches lock the states they share in the same order
+        key=lambda state: state["device_id"],
+    )
+    insert_statement = insert(DeviceState).values(state_values)
+    excluded = insert_statement.excluded
+    await session.execute(
+        insert_statement.on_conflict_do_update(
+            index_elements=[col(DeviceState.device_id)],
+            set_={
+                "last_online_timestamp": excluded.last_online_timestamp,
+                "last_reported_latitude": excluded.last_reported_latitude,
+                "last_reported_longitude": excluded.last_reported_longitude,
+                "last_reported_speed": excluded.last_reported_speed,
+                "engine_ignition_status": excluded.engine_ignition_status,
+                "is_online": excluded.is_online,
+            },
+            where=or_(
+                col(DeviceState.last_online_timestamp).is_(None),
+                col(DeviceState.last_online_timestamp) < excluded.last_online_timestamp,
+            ),
+        )
+    )
+
+
+async def resolve_devices(
+    session: AsyncSession, rows: Sequence[Row]
+) -> dict[str, CachedDevice]:
+    """
+    Resolve the devices of a batch of rows and update their last state.
+
+    Only the newest row of each device is used. Devices missing from the
+    cache go through insert_devices and are cached once the transaction
+    commits. Returns the devices by provider_device_id.
+    """
+    latest_rows: dict[str, Row] = {}
+    for row in rows:
+        provider_id = row[_PROVIDER_DEVICE_ID]
+        latest = latest_rows.get(provider_id)
+        if latest is None or row[_TIMESTAMP] >= latest[_TIMESTAMP]:
+            latest_rows[provider_id] = row
+
+    devices = device_cache.get_many(latest_rows)
+    if len(devices) < len(latest_rows):
+        resolved = await insert_devices(
+            session,
+            # Concurrent batches lock the device rows they share in the same order
+            [
+                latest_rows[provider_id]
+                for provider_id in sorted(latest_rows)
+                if provider_id not in devices
+            ],
+        )
+        add_pending_devices(session, resolved)
+        devices.update(resolved)
+    await update_device_states(session, devices, list(latest_rows.values()))
+    return devices
+
+
+async def store_rows(session: AsyncSession, rows: Sequence[Row]) -> int:
+    """
+    Write a batch of extracted rows in the session's transaction.
+
+    Returns the number of telemetry rows inserted, resent rows that were
+    already stored are skipped and not counted.
+    """
+    if not rows:
+        return 0
+    devices = await resolve_devices(session, rows)
+    stored_at = datetime.now(tz.utc).replace(tzinfo=None)
+    if settings.TELEMETRY_ACCUMULATORS == "array":
+        start, stop = _ACCUMULATORS.start, _ACCUMULATORS.stop
+        packed_rows = [
+            (
+                *row[:start],
+                *row[stop:],
+                pack_accumulators(row[start:stop]),
+                devices[row[_PROVIDER_DEVICE_ID]].device_id,
+                stored_at,
+            )
+            for row in rows
+        ]
+        return await write_telemetry(session, PACKED_TELEMETRY_ROW_COLUMNS, packed_rows)
+    telemetry_rows = [
+        (*row, devices[row[_PROVIDER_DEVICE_ID]].device_id, stored_at) for row in rows
+    ]
+    return await write_telemetry(session, TELEMETRY_ROW_COLUMNS, telemetry_rows)
+
+
+async def ingest_rows(rows: Sequence[Row]) -> int:
+    """Write a batch of extracted rows and commit it"""
+    async with AsyncSession(async_engine) as session:
+        written = await store_rows(session, rows)
+        await session.commit()
+    return written
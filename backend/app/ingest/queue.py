@@ -0,0 +1,194 @@
+"""
+In-process micro-batching ingest queue.
+
+Rows extracted from accepted reports are buffered in a bounded queue and a
+background flusher writes them to the database in large batches, either when
+enough rows are buffered or when the flush interval elapses.
+"""
+
+import asyncio
+import logging
+import time
+from collections.abc import Awaitable, Callable, Sequence
+
+from app.core.config import settings
+from app.ingest.mapping import Row
+from app.ingest.pipeline import ingest_rows, is_row_error
+from app.models import IngestQueueStats
+
+logger = logging.getLogger(__name__)
+
+FlushFunction = Callable[[Sequence[Row]], Awaitable[int]]
+
+
+class IngestQueue:
+    """Bounded queue of rows drained in batches by a background task"""
+
+    def __init__(
+        self,
+        flush: FlushFunction,
+        *,
+        max_rows: int,
+        batch_size: int,
+        flush_interval: float,
+        put_timeout: float,
+    ) -> None:
+        self.flush = flush
+        self.max_rows = max_rows
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+
+        self._buffer: list[Row] = []
+        # Rows buffered or being flushed, bounded by max_rows
+        self._depth = 0
+        # Created in start() so they belong to the running event loop
+        self._batch_ready: asyncio.Event | None = None
+        self._room: asyncio.Condition | None = None
+        self._task: asyncio.Task[None] | None = None
+        self._stopping = False
+
+        self.enqueued = 0
+        self.flushed = 0
+        self.duplicates = 0
+        self.dropped = 0
+        self.failed = 0
+        self.batches = 0
+        self.last_flush_seconds = 0.0
+        self.max_flush_seconds = 0.0
+
+    @property
+    def depth(self) -> int:
+        return self._depth
+
+    async def put(self, rows: Sequence[Row]) -> bool:
+        """
+        Enqueue rows, waiting up to put_timeout for room in the queue.
+
+        Returns False and counts the rows as dropped if the queue stayed full.
+        """
+        assert self._room is not None and self._batch_ready is not None
+        if len(rows) > self.max_rows:
+            self.dropped += len(rows)
+            return False
+        async with self._room:
+            try:
+                await asyncio.wait_for(
+                    self._room.wait_for(
+                        lambda: self._depth + len(rows) <= self.max_rows
+                    ),
+                    timeout=self.put_timeout,
+                )
+            except asyncio.TimeoutError:
+                self.dropped += len(rows)
+                return False
+            self._buffer.extend(rows)
+            self._depth += len(rows)
+        self.enqueued += len(rows)
+        if len(self._buffer) >= self.batch_size:
+            self._batch_ready.set()
+        return True
+
+    async def _flush_rows(self, rows: list[Row]) -> None:
+        while True:
+            try:
+                inserted = await self.flush(rows)
+            except Exception as e:
+                if is_row_error(e):
+                    if len(rows) == 1:
+                        logger.exception("Ingest flush failed, dropping 1 row")
+                        self.failed += 1
+                        break
+                    # Batches merge rows of many requests, split the batch in
+                    # halves until the rows that fail are isolated
+                    logger.warning(
+                        "Ingest flush of %d rows failed, splitting", len(rows)
+                    )
+                    middle = len(rows) // 2
+                    await self._flush_rows(rows[:middle])
+                    await self._flush_rows(rows[middle:])
+                    break
+                if self._stopping:
+                    logger.exception("Ingest flush failed, dropping %d rows", len(rows))
+                    self.failed += len(rows)
+                    break
+                # The database is unavailable, keep the rows and retry later
+                logger.exception("Ingest flush failed, retrying")
+                await asyncio.sleep(self.flush_interval)
+                continue
+            else:
+                self.flushed += len(rows)
+                self.duplicates += len(rows) - inserted
+            break
+
+    async def _flush_batch(self, batch: list[Row]) -> None:
+        started = time.perf_counter()
+        await self._flush_rows(batch)
+        self.batches += 1
+        self.last_flush_seconds = time.perf_counter() - started
+        self.max_flush_seconds = max(self.max_flush_seconds, self.last_flush_seconds)
+        assert self._room is not None
+        async with self._room:
+            self._depth -= len(batch)
+            self._room.notify_all()
+
+    async def drain(self) -> None:
+        """Flush everything currently buffered"""
+        while self._buffer:
+            batch = self._buffer[: self.batch_size]
+            del self._buffer[: self.batch_size]
+            await self._flush_batch(batch)
+
+    async def run(self) -> None:
+        """Flush batches on a size or time trigger until stopped"""
+        assert self._batch_ready is not None
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(
+                    self._batch_ready.wait(), timeout=self.flush_interval
+                )
+            except asyncio.TimeoutError:
+                pass
+            self._batch_ready.clear()
+            await self.drain()
+
+    def start(self) -> None:
+        if self._task is None:
+            self._batch_ready = asyncio.Event()
+            self._room = asyncio.Condition()
+            self._stopping = False
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        """Stop the flusher once whatever is still buffered has been written"""
+        if self._task is None:
+            return
+        assert self._batch_ready is not None
+        self._stopping = True
+        self._batch_ready.set()
+        await self._task
+        self._task = None
+        await self.drain()
+
+    def stats(self) -> IngestQueueStats:
+        return IngestQueueStats(
+            depth=self._depth,
+            max_rows=self.max_rows,
+            enqueued=self.enqueued,
+            flushed=self.flushed,
+            duplicates=self.duplicates,
+            dropped=self.dropped,
+            failed=self.failed,
+            batches=self.batches,
+            last_flush_seconds=self.last_flush_seconds,
+            max_flush_seconds=self.max_flush_seconds,
+        )
+
+
+ingest_queue = IngestQueue(
+    ingest_rows,
+    max_rows=settings.INGEST_QUEUE_MAX_ROWS,
+    batch_size=settings.INGEST_BATCH_SIZE,
+    flush_interval=settings.INGEST_FLUSH_INTERVAL_MS / 1000,
+    put_timeout=settings.INGEST_QUEUE_PUT_TIMEOUT_MS / 1000,
+)
@@ -0,0 +1,190 @@
+"""
+Telemetry rollups and their refresh after late reports.
+
+telemetry_hourly and telemetry_daily are continuous aggregates. Their
+policies refresh a window of recent buckets, and queries aggregate the
+buckets above the materialization watermark in real time. Reports written
+below the watermark, by devices uploading their history late, are missing
+from the rollups until the buckets they fall in are refreshed again.
+
+Writers record the days of such reports in the session. Once the transaction
+commits they are handed to the refresher, which refreshes the hourly rollup
+and then the daily one, computed from it, over those days in the background.
+"""
+
+import asyncio
+import logging
+from collections.abc import Iterable, Iterator
+from datetime import datetime, timedelta
+from datetime import time as day_start
+from datetime import timezone as tz
+from typing import NamedTuple
+
+from sqlalchemy import event, exc, text
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from app.core.db import async_engine
+
+logger = logging.getLogger(__name__)
+
+# Session.info key of the days of late reports written in the transaction
+PENDING_ROLLUP_DAYS = "pending_rollup_days"
+
+_DAY = timedelta(days=1)
+_EPOCH = datetime(1970, 1, 1)
+
+
+class Rollup(NamedTuple):
+    name: str
+    width: timedelta
+    # Window refreshed by the policy, back from now
+    start_offset: timedelta
+    end_offset: timedelta
+
+
+# Widest first, the daily rollup is computed from the hourly one
+ROLLUPS = (
+    Rollup("telemetry_daily", _DAY, timedelta(days=7), _DAY),
+    Rollup(
+        "telemetry_hourly", timedelta(hours=1), timedelta(days=3), timedelta(hours=1)
+    ),
+)
+
+# Reports older than this may be below a watermark
+_LATE = min(rollup.end_offset for rollup in ROLLUPS)
+
+_WATERMARK = text(
+    "SELECT _timescaledb_functions.cagg_watermark(mat_hypertable_id)"
+    " FROM _timescaledb_catalog.continuous_agg"
+    " WHERE user_view_name = :name"
+)
+_REFRESH = text(
+    "CALL refresh_continuous_aggregate(CAST(:name AS regclass),"
+    " CAST(:start AS timestamp), CAST(:end AS timestamp))"
+)
+
+
+def _utcnow() -> datetime:
+    return datetime.now(tz.utc).replace(tzinfo=None)
+
+
+async def watermark(session: AsyncSession, rollup: Rollup) -> datetime:
+    """End of the materialized buckets of a rollup, in naive UTC"""
+    value = (await session.execute(_WATERMARK, {"name": rollup.name})).scalar_one()
+    # Microseconds since the epoch, the minimum when nothing is materialized
+    try:
+        return _EPOCH + timedelta(microseconds=value)
+    except OverflowError:
+        return datetime.min
+
+
+async def is_current(session: AsyncSession, rollup: Rollup, start: datetime) -> bool:
+    """
+    Whether the rollup holds every report from start on: the buckets are
+    aggregated in real time above the watermark, and refreshed by the policy
+    and after late reports within its window. Older materialized buckets miss
+    the reports written below the window since they were refreshed.
+    """
+    if start >= _utcnow() - rollup.start_offset:
+        return True
+    return start >= await watermark(session, rollup)
+
+
+def add_late_reports(
+    session: AsyncSession | Session, timestamps: Iterable[datetime | None]
+) -> None:
+    """Refresh the rollups over the days of late reports once the session's
+    transaction commits"""
+    late = _utcnow() - _LATE
+    days = {
+        datetime.combine(timestamp.date(), day_start())
+        for timestamp in timestamps
+        if timestamp is not None and timestamp < late
+    }
+    if days:
+        session.info.setdefault(PENDING_ROLLUP_DAYS, set()).update(days)
+
+
+def _day_ranges(days: Iterable[datetime]) -> Iterator[tuple[datetime, datetime]]:
+    """Merge days into ranges of consecutive days"""
+    start = end = None
+    for day in sorted(days):
+        if end is not None and day == end:
+            end = day + _DAY
+            continue
+        if start is not None and end is not None:
+            yield start, end
+        start, end = day, day + _DAY
+    if start is not None and end is not None:
+        yield start, end
+
+
+class RollupRefresher:
+    """Refreshes the rollups over the days of committed late reports"""
+
+    def __init__(self, interval: float) -> None:
+        self.interval = interval
+        self.refreshed = 0
+        self._pending: set[datetime] = set()
+        self._task: asyncio.Task[None] | None = None
+
+    def add(self, days: Iterable[datetime]) -> None:
+        self._pending.update(days)
+
+    async def refresh(self) -> None:
+        days, self._pending = self._pending, set()
+        for start, end in _day_ranges(days):
+            try:
+                async with async_engine.connect() as connection:
+                    # Refreshing can't run in a transaction
+                    await connection.execution_options(isolation_level="AUTOCOMMIT")
+                    for rollup in reversed(ROLLUPS):
+                        await connection.execute(
+                            _REFRESH, {"name": rollup.name, "start": start, "end": end}
+                        )
+            except exc.DBAPIError:
+                logger.exception("Refreshing rollups from %s to %s failed", start, end)
+                self._pending.update(
+                    start + _DAY * i for i in range((end - start) // _DAY)
+                )
+            else:
+                self.refreshed += (end - start) // _DAY
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            if self._pending:
+                await self.refresh()
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        # Late reports committed since the last refresh
+        if self._pending:
+            await self.refresh()
+
+
+rollup_refresher = RollupRefresher(interval=10.0)
+
+
+@event.listens_for(Session, "after_commit")
+def _refresh_committed_days(session: Session) -> None:
+    pending = session.info.pop(PENDING_ROLLUP_DAYS, None)
+    if pending:
+        rollup_refresher.add(pending)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_pending_days(session: Session) -> None:
+    session.info.pop(PENDING_ROLLUP_DAYS, None)
@@ -0,0 +1,217 @@
+"""
+Fixed-size hash table in a memory-mapped file shared by processes.
+
+Every process that opens the same file sees the same entries. Keys are short
+strings, values are fixed-size byte strings with an expiry time. The table
+uses open addressing with a bounded probe sequence. When no slot of the
+sequence is free, the entry expiring first is replaced.
+
+Readers don't lock. Each slot carries a version that writers make odd while
+they update the slot, and readers retry when it changed under them. Writers
+serialize on an flock of the file. Clearing the table bumps a generation in
+the header, which invalidates every slot at once.
+"""
+
+import fcntl
+import mmap
+import os
+import struct
+import threading
+import zlib
+from collections.abc import Iterator
+from contextlib import contextmanager
+from pathlib import Path
+
+MAX_KEY_BYTES = 64
+VALUE_BYTES = 32
+MAX_PROBES = 16
+_READ_RETRIES = 100
+
+_MAGIC = b"SHT1"
+# Magic, slot count, value size, generation
+_HEADER = struct.Struct("<4sIII")
+_GENERATION = struct.Struct("<I")
+_GENERATION_OFFSET = 12
+# Version, generation, key length, expiry, value, key
+_SLOT = struct.Struct(f"<IIHxxd{VALUE_BYTES}s{MAX_KEY_BYTES}s")
+_VERSION = struct.Struct("<I")
+_EMPTY = 0
+_DELETED = 0xFFFF
+
+
+class SharedHashTable:
+    """Hash table of short keys to fixed-size values in a shared mmap file"""
+
+    def __init__(self, path: Path, capacity: int) -> None:
+        # Keep the load factor at or below one half
+        self.slots = 1 << max(capacity * 2 - 1, 1).bit_length()
+        # Processes configured for another capacity use another file
+        self.path = path.with_name(f"{path.name}.{self.slots}")
+        self._mask = self.slots - 1
+        self._size = _HEADER.size + self.slots * _SLOT.size
+        self._fd: int | None = None
+        self._map: mmap.mmap | None = None
+        # flock doesn't exclude threads sharing the file descriptor
+        self._thread_lock = threading.Lock()
+
+    def _open(self) -> mmap.mmap:
+        if self._map is not None:
+            return self._map
+        with self._thread_lock:
+            if self._map is None:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                try:
+                    if os.fstat(fd).st_size < self._size:
+                        # Zero filled, so every slot starts out empty
+                        os.ftruncate(fd, self._size)
+                    magic, *_ = _HEADER.unpack(os.pread(fd, _HEADER.size, 0))
+                    if magic != _MAGIC:
+                        header = _HEADER.pack(_MAGIC, self.slots, VALUE_BYTES, 1)
+                        os.pwrite(fd, header, 0)
+                finally:
+                    fcntl.flock(fd, fcntl.LOCK_UN)
+                self._fd = fd
+                self._map = mmap.mmap(fd, self._size)
+        return self._map
+
+    @contextmanager
+    def _write_lock(self) -> Iterator[mmap.mmap]:
+        table = self._open()
+        assert self._fd is not None
+        with self._thread_lock:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                yield table
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _offset(self, index: int) -> int:
+        return _HEADER.size + index * _SLOT.size
+
+    def _read_slot(
+        self, table: mmap.mmap, index: int, locked: bool = False
+    ) -> tuple[int, int, int, float, bytes, bytes] | None:
+        """
+        Read a consistent copy of a slot.
+
+        Returns None if writers kept changing it. Under the write lock the
+        slot is read as is, an odd version there is left by a writer that died.
+        """
+        offset = self._offset(index)
+        for _ in range(1 if locked else _READ_RETRIES):
+            slot = _SLOT.unpack_from(table, offset)
+            if locked or (
+                not slot[0] & 1 and _VERSION.unpack_from(table, offset)[0] == slot[0]
+            ):
+                return slot
+        return None
+
+    def _write_slot(
+        self,
+        table: mmap.mmap,
+        index: int,
+        generation: int,
+        key_length: int,
+        expires: float,
+        value: bytes,
+        key: bytes,
+    ) -> None:
+        offset = self._offset(index)
+        # Odd while writing, even if the previous writer died mid-write
+        writing = ((_VERSION.unpack_from(table, offset)[0] + 1) | 1) & 0xFFFFFFFF
+        _VERSION.pack_into(table, offset, writing)
+        _SLOT.pack_into(
+            table, offset, writing, generation, key_length, expires, value, key
+        )
+        _VERSION.pack_into(table, offset, (writing + 1) & 0xFFFFFFFF)
+
+    def _probe(self, key: bytes) -> Iterator[int]:
+        start = zlib.crc32(key) & self._mask
+        for i in range(MAX_PROBES):
+            yield (start + i) & self._mask
+
+    def _generation(self, table: mmap.mmap) -> int:
+        generation: int = _GENERATION.unpack_from(table, _GENERATION_OFFSET)[0]
+        return generation
+
+    def get(self, key: str, now: float) -> bytes | None:
+        """Return the value of key, or None if it is missing or expired"""
+        encoded = key.encode()
+        if len(encoded) > MAX_KEY_BYTES:
+            return None
+        table = self._open()
+        generation = self._generation(table)
+        for index in self._probe(encoded):
+            slot = self._read_slot(table, index)
+            if slot is None:
+                return None
+            _, slot_generation, key_length, expires, value, slot_key = slot
+            if key_length == _EMPTY:
+                return None
+            if (
+                slot_generation == generation
+                and key_length == len(encoded)
+                and slot_key[:key_length] == encoded
+            ):
+                return value if expires > now else None
+        return None
+
+    def put_many(self, items: dict[str, bytes], expires: float) -> None:
+        with self._write_lock() as table:
+            generation = self._generation(table)
+            for key, value in items.items():
+                encoded = key.encode()
+                if len(encoded) > MAX_KEY_BYTES:
+                    continue
+                target = None
+                target_expires = float("inf")
+                for index in self._probe(encoded):
+                    slot = self._read_slot(table, index, locked=True)
+                    assert slot is not None
+                    _, slot_generation, key_length, slot_expires, _, slot_key = slot
+                    live = slot_generation == generation and key_length not in (
+                        _EMPTY,
+                        _DELETED,
+                    )
+                    if live and slot_key[:key_length] == encoded:
+                        target = index
+                        break
+                    if not live:
+                        # A free slot, but the key may still be further on
+                        if target_expires > float("-inf"):
+                            target, target_expires = index, float("-inf")
+                        if key_length == _EMPTY:
+                            break
+                    elif slot_expires < target_expires:
+                        target, target_expires = index, slot_expires
+                assert target is not None
+                self._write_slot(
+                    table, target, generation, len(encoded), expires, value, encoded
+                )
+
+    def delete(self, key: str) -> None:
+        encoded = key.encode()
+        if len(encoded) > MAX_KEY_BYTES:
+            return
+        with self._write_lock() as table:
+            generation = self._generation(table)
+            for index in self._probe(encoded):
+                slot = self._read_slot(table, index, locked=True)
+                assert slot is not None
+                _, slot_generation, key_length, _, _, slot_key = slot
+                if key_length == _EMPTY:
+                    return
+                if (
+                    slot_generation == generation
+                    and key_length == len(encoded)
+                    and slot_key[:key_length] == encoded
+                ):
+                    self._write_slot(table, index, generation, _DELETED, 0.0, b"", b"")
+                    return
+
+    def clear(self) -> None:
+        with self._write_lock() as table:
+            generation = self._generation(table) + 1
+            _GENERATION.pack_into(table, _GENERATION_OFFSET, generation & 0xFFFFFFFF)
@@ -0,0 +1,461 @@
+"""
+Local write-ahead spool for accepted telemetry rows.
+
+Accepted rows are appended to segment files on local disk before the request
+is acknowledged, and a replay worker drains sealed segments into the
+database. This decouples the accept rate from database latency and keeps
+accepted data through database outages.
+
+Each segment is a sequence of records: a header with the payload length and
+its CRC32, followed by a pickled batch of rows. Writers fsync in groups, so
+concurrent requests share one fsync. A segment is written by one process
+under an exclusive flock as ``<name>.seg.open``, created as ``<name>.seg.new``
+and renamed once locked. It is renamed to
+``<name>.seg`` once it is full or old enough, and replayed from there.
+
+The replay position of a segment is stored in the spoolcheckpoint table in
+the same transaction as the rows replayed from it, so a crash never inserts
+a record twice. Fully replayed segments are deleted.
+
+When rows of a batch can't be written because of their values, the batch is
+written again in savepoints, split in halves until the failing rows are
+isolated. Those are appended to ``<name>.dead``, in the segment format, and
+the rest of the batch is written and checkpointed past them. Any other error
+leaves the segment to be replayed again later.
+"""
+
+import asyncio
+import copy
+import fcntl
+import logging
+import os
+import pickle
+import struct
+import time
+import zlib
+from collections.abc import Iterator, Sequence
+from datetime import datetime
+from datetime import timezone as tz
+from pathlib import Path
+from typing import BinaryIO
+
+from sqlalchemy.dialects.postgresql import insert
+from sqlmodel import col, delete, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app.core.config import settings
+from app.core.db import async_engine
+from app.ingest.mapping import Row
+from app.ingest.pipeline import is_row_error, store_rows
+from app.models import SpoolCheckpoint
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_SUFFIX = ".seg"
+OPEN_SEGMENT_SUFFIX = ".seg.open"
+# Segments are created under this name and locked before they are renamed to
+# their open name, replayers never look at them
+NEW_SEGMENT_SUFFIX = ".seg.new"
+# Rows that failed to be written, kept for inspection
+DEAD_LETTER_SUFFIX = ".dead"
+
+# Payload length and CRC32 of the payload
+_HEADER = struct.Struct("<II")
+
+
+def _fsync_directory(directory: Path) -> None:
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _try_lock(file: BinaryIO) -> bool:
+    try:
+        fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return False
+    return True
+
+
+def encode_record(rows: Sequence[Row]) -> bytes:
+    payload = pickle.dumps(list(rows), protocol=pickle.HIGHEST_PROTOCOL)
+    return _HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def read_records(file: BinaryIO, position: int) -> Iterator[tuple[int, list[Row]]]:
+    """
+    Read the records of a segment from position.
+
+    Yields the position after each record and its rows. Reading stops at a
+    torn or corrupt record, which is what a crash while appending leaves.
+    """
+    file.seek(position)
+    while True:
+        header = file.read(_HEADER.size)
+        if len(header) < _HEADER.size:
+            if header:
+                logger.warning("Torn record header in %s at %d", file.name, position)
+            return
+        length, checksum = _HEADER.unpack(header)
+        payload = file.read(length)
+        if len(payload) < length or zlib.crc32(payload) != checksum:
+            logger.warning("Torn record in %s at %d", file.name, position)
+            return
+        position += _HEADER.size + length
+        yield position, pickle.loads(payload)
+
+
+class _OpenSegment:
+    """A segment being appended to by this process"""
+
+    def __init__(self, directory: Path) -> None:
+        name = f"{time.time_ns():020d}-{os.getpid()}"
+        self.path = directory / f"{name}{OPEN_SEGMENT_SUFFIX}"
+        self.sealed_path = directory / f"{name}{SEGMENT_SUFFIX}"
+        new_path = directory / f"{name}{NEW_SEGMENT_SUFFIX}"
+        self.file = open(new_path, "xb")  # noqa: SIM115
+        # Held until the segment is sealed, tells replayers it is in use. It
+        # is taken before the segment gets a name replayers look for, or one
+        # could seal it as abandoned first.
+        fcntl.flock(self.file, fcntl.LOCK_EX)
+        os.rename(new_path, self.path)
+        self.created = time.monotonic()
+        self.size = 0
+
+    def seal(self) -> None:
+        # Renamed while still locked, so a replayer can't seal it as abandoned
+        os.rename(self.path, self.sealed_path)
+        self.file.close()
+
+
+class SpoolWriter:
+    """Appends batches of rows to the spool with group fsync"""
+
+    def __init__(
+        self,
+        directory: Path,
+        *,
+        segment_bytes: int,
+        segment_interval: float,
+        fsync_interval: float,
+    ) -> None:
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.segment_interval = segment_interval
+        self.fsync_interval = fsync_interval
+
+        self._segment: _OpenSegment | None = None
+        self._sealing: list[_OpenSegment] = []
+        # Resolved once everything written before it was created is on disk
+        self._synced: asyncio.Future[None] | None = None
+        # Created in start() so they belong to the running event loop
+        self._lock: asyncio.Lock | None = None
+        self._dirty: asyncio.Event | None = None
+        self._task: asyncio.Task[None] | None = None
+        self._stopping = False
+
+        self.spooled = 0
+        self.fsyncs = 0
+
+    async def put(self, rows: Sequence[Row]) -> bool:
+        """Append rows to the spool, returns once they are on disk"""
+        assert self._lock is not None and self._dirty is not None
+        record = encode_record(rows)
+        async with self._lock:
+            if self._segment is None:
+                self._segment = _OpenSegment(self.directory)
+            self._segment.file.write(record)
+            self._segment.size += len(record)
+            if self._synced is None:
+                self._synced = asyncio.get_running_loop().create_future()
+            synced = self._synced
+        self._dirty.set()
+        await asyncio.shield(synced)
+        self.spooled += len(rows)
+        return True
+
+    async def _sync(self, seal: bool = False) -> None:
+        assert self._lock is not None
+        async with self._lock:
+            segment = self._segment
+            if segment is not None and (
+                seal
+                or segment.size >= self.segment_bytes
+                or time.monotonic() - segment.created >= self.segment_interval
+            ):
+                self._sealing.append(segment)
+                self._segment = None
+            segments = [*self._sealing, *([self._segment] if self._segment else [])]
+            sealing, self._sealing = self._sealing, []
+            synced, self._synced = self._synced, None
+            for segment in segments:
+                segment.file.flush()
+        if not segments:
+            return
+
+        def sync() -> None:
+            for segment in segments:
+                os.fsync(segment.file.fileno())
+            for segment in sealing:
+                segment.seal()
+            if sealing:
+                _fsync_directory(self.directory)
+
+        try:
+            await asyncio.to_thread(sync)
+        except OSError as e:
+            if synced is not None:
+                synced.set_exception(e)
+            raise
+        self.fsyncs += 1
+        if synced is not None:
+            synced.set_result(None)
+
+    async def run(self) -> None:
+        """Fsync appended records in groups and seal segments until stopped"""
+        assert self._dirty is not None
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(
+                    self._dirty.wait(), timeout=self.segment_interval
+                )
+                # Let concurrent writers append before syncing
+                await asyncio.sleep(self.fsync_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._dirty.clear()
+            try:
+                await self._sync()
+            except OSError:
+                logger.exception("Spool fsync failed")
+
+    def start(self) -> None:
+        if self._task is None:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            self._lock = asyncio.Lock()
+            self._dirty = asyncio.Event()
+            self._stopping = False
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        """Stop the writer and seal the current segment"""
+        if self._task is None:
+            return
+        assert self._dirty is not None
+        self._stopping = True
+        self._dirty.set()
+        await self._task
+        self._task = None
+        await self._sync(seal=True)
+
+
+async def load_checkpoint(session: AsyncSession, segment: str) -> int:
+    position = (
+        await session.exec(
+            select(SpoolCheckpoint.position).where(SpoolCheckpoint.segment == segment)
+        )
+    ).first()
+    return position or 0
+
+
+async def save_checkpoint(session: AsyncSession, segment: str, position: int) -> None:
+    updated_at = datetime.now(tz.utc).replace(tzinfo=None)
+    statement = insert(SpoolCheckpoint).values(
+        segment=segment, position=position, updated_at=updated_at
+    )
+    await session.execute(
+        statement.on_conflict_do_update(
+            index_elements=[col(SpoolCheckpoint.segment)],
+            set_={"position": position, "updated_at": updated_at},
+        )
+    )
+
+
+def _read_batch(
+    file: BinaryIO, position: int, batch_size: int
+) -> tuple[int, list[Row]]:
+    rows: list[Row] = []
+    for end, records in read_records(file, position):
+        rows.extend(records)
+        position = end
+        if len(rows) >= batch_size:
+            break
+    return position, rows
+
+
+async def _store_isolating(
+    session: AsyncSession, rows: Sequence[Row]
+) -> tuple[int, list[Row]]:
+    """
+    Write rows in savepoints, splitting them in halves until the rows that
+    fail are isolated. Returns the number of rows inserted and the rows that
+    failed.
+    """
+    # Devices and rollup days recorded by rows that get rolled back
+    info = {key: copy.copy(value) for key, value in session.info.items()}
+    try:
+        async with session.begin_nested():
+            return await store_rows(session, rows), []
+    except Exception as e:
+        if not is_row_error(e):
+            raise
+        session.info.clear()
+        session.info.update(info)
+    if len(rows) == 1:
+        return 0, list(rows)
+    middle = len(rows) // 2
+    inserted, failed = await _store_isolating(session, rows[:middle])
+    more_inserted, more_failed = await _store_isolating(session, rows[middle:])
+    return inserted + more_inserted, failed + more_failed
+
+
+def _dead_letter(path: Path, rows: Sequence[Row]) -> None:
+    with open(path.with_suffix(DEAD_LETTER_SUFFIX), "ab") as file:
+        file.write(encode_record(rows))
+        file.flush()
+        os.fsync(file.fileno())
+
+
+class SpoolReplayer:
+    """Drains sealed spool segments into the database"""
+
+    def __init__(
+        self, directory: Path, *, batch_size: int, poll_interval: float
+    ) -> None:
+        self.directory = directory
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self._task: asyncio.Task[None] | None = None
+        self._stopping = False
+
+        self.replayed = 0
+        self.duplicates = 0
+        self.failed = 0
+
+    def seal_abandoned(self) -> None:
+        """Seal open segments whose writer is gone, so they get replayed"""
+        for path in sorted(self.directory.glob(f"*{OPEN_SEGMENT_SUFFIX}")):
+            try:
+                with open(path, "rb") as file:
+                    if _try_lock(file):
+                        logger.warning("Sealing abandoned spool segment %s", path)
+                        os.rename(path, path.with_suffix(""))
+            except FileNotFoundError:
+                # Sealed by its writer in the meantime
+                continue
+
+    async def replay_segment(self, path: Path) -> int:
+        """Replay a sealed segment from its checkpoint, then delete it"""
+        written = 0
+        with open(path, "rb") as file:
+            # Another replayer has it, or finished and deleted it since we
+            # opened it (its checkpoint may be gone already)
+            if not _try_lock(file) or os.fstat(file.fileno()).st_nlink == 0:
+                return 0
+            async with AsyncSession(async_engine) as session:
+                position = await load_checkpoint(session, path.name)
+            while True:
+                position, rows = await asyncio.to_thread(
+                    _read_batch, file, position, self.batch_size
+                )
+                if not rows:
+                    break
+                failed: list[Row] = []
+                async with AsyncSession(async_engine) as session:
+                    try:
+                        inserted = await store_rows(session, rows)
+                    except Exception as e:
+                        if not is_row_error(e):
+                            raise
+                        logger.warning(
+                            "Replay of %d rows from spool segment %s failed,"
+                            " isolating the failing rows",
+                            len(rows),
+                            path.name,
+                        )
+                        await session.rollback()
+                        inserted, failed = await _store_isolating(session, rows)
+                    if failed:
+                        # Kept before the checkpoint moves past them
+                        await asyncio.to_thread(_dead_letter, path, failed)
+                        logger.error(
+                            "Dropped %d rows of spool segment %s, kept in %s",
+                            len(failed),
+                            path.name,
+                            path.with_suffix(DEAD_LETTER_SUFFIX).name,
+                        )
+                    await save_checkpoint(session, path.name, position)
+                    await session.commit()
+                written += len(rows) - len(failed)
+                self.replayed += len(rows) - len(failed)
+                self.failed += len(failed)
+                self.duplicates += len(rows) - len(failed) - inserted
+            # The file goes first, a leftover checkpoint row is harmless
+            path.unlink()
+        logger.info("Replayed %d rows from spool segment %s", written, path.name)
+        async with AsyncSession(async_engine) as session:
+            await session.execute(
+                delete(SpoolCheckpoint).where(col(SpoolCheckpoint.segment) == path.name)
+            )
+            await session.commit()
+        return written
+
+    async def replay(self) -> int:
+        """Replay every sealed segment, oldest first"""
+        self.seal_abandoned()
+        written = 0
+        for path in sorted(self.directory.glob(f"*{SEGMENT_SUFFIX}")):
+            if self._stopping:
+                break
+            try:
+                written += await self.replay_segment(path)
+            except FileNotFoundError:
+                # Replayed by another process in the meantime
+                continue
+        return written
+
+    async def run(self) -> None:
+        """Replay the spool until stopped"""
+        while not self._stopping:
+            try:
+                written = await self.replay()
+            except Exception:
+                # Failures not caused by rows, like an unreachable database,
+                # leave the segment to the next pass
+                logger.exception("Spool replay failed, retrying")
+                written = 0
+            if not written:
+                await asyncio.sleep(self.poll_interval)
+
+    def start(self) -> None:
+        if self._task is None:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            self._stopping = False
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._stopping = True
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+
+ingest_spool = SpoolWriter(
+    Path(settings.INGEST_SPOOL_DIR),
+    segment_bytes=settings.INGEST_SPOOL_SEGMENT_BYTES,
+    segment_interval=settings.INGEST_SPOOL_SEGMENT_MS / 1000,
+    fsync_interval=settings.INGEST_SPOOL_FSYNC_INTERVAL_MS / 1000,
+)
+
+spool_replayer = SpoolReplayer(
+    Path(settings.INGEST_SPOOL_DIR),
+    batch_size=settings.INGEST_BATCH_SIZE,
+    poll_interval=settings.INGEST_FLUSH_INTERVAL_MS / 1000,
+)
@@ -0,0 +1,237 @@
+"""
+Bulk writers for the telemetrydata hypertable.
+
+Rows are plain tuples, one value per column. The strategy used to persist
+them is chosen with the TELEMETRY_WRITE_STRATEGY setting:
+
+- ``orm``: build TelemetryData instances and save them with the ORM
+- ``insert``: multi-row parameterised INSERT statements
+- ``copy``: stream the rows with ``COPY ... FROM STDIN (FORMAT BINARY)``
+
+With TELEMETRY_DEDUPLICATE, resent reports are skipped by the unique index on
+device_id, timestamp and event_seqnum. The ``insert`` strategy adds ``ON
+CONFLICT DO NOTHING``, and ``copy`` can't, so it copies into a temporary
+staging table and moves the rows over with a single INSERT ... ON CONFLICT DO
+NOTHING. The ``orm`` strategy saves rows one by one, skipping the duplicates,
+when a batch conflicts. Without it, ``copy`` writes straight into
+telemetrydata.
+"""
+
+import zlib
+from collections.abc import Sequence
+from datetime import datetime
+from datetime import timezone as tz
+from functools import lru_cache
+from typing import Any, Literal, NamedTuple
+
+import psycopg
+from sqlalchemy import (
+    ARRAY,
+    JSON,
+    Boolean,
+    DateTime,
+    Float,
+    Integer,
+    String,
+    Uuid,
+    exc,
+)
+from sqlalchemy.dialects.postgresql import JSONB, insert
+from sqlalchemy.types import TypeDecorator, TypeEngine
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app.core.config import settings
+from app.ingest.mapping import Row
+from app.ingest.rollups import add_late_reports
+from app.models import TelemetryData
+
+WriteStrategy = Literal["orm", "insert", "copy"]
+
+# PostgreSQL types used by the binary COPY protocol, in lookup order
+_COPY_TYPES: tuple[tuple[type[TypeEngine[Any]], str], ...] = (
+    (Boolean, "bool"),
+    (Integer, "int4"),
+    (Float, "float8"),
+    (DateTime, "timestamp"),
+    (JSONB, "jsonb"),
+    (JSON, "json"),
+    (Uuid, "uuid"),
+    (String, "text"),
+)
+
+
+def _copy_type(type_: TypeEngine[Any]) -> str:
+    if isinstance(type_, TypeDecorator):
+        type_ = type_.impl_instance
+    if isinstance(type_, ARRAY):
+        return f"{_copy_type(type_.item_type)}[]"
+    for sa_type, pg_type in _COPY_TYPES:
+        if isinstance(type_, sa_type):
+            return pg_type
+    raise TypeError(f"Unsupported column type for COPY: {type_!r}")
+
+
+_TELEMETRY_TABLE = TelemetryData.__table__  # type: ignore[attr-defined]
+
+
+class _CopyPlan(NamedTuple):
+    create_statement: str
+    statement: str
+    direct_statement: str
+    insert_statement: str
+    truncate_statement: str
+    types: list[str]
+    datetime_indexes: tuple[int, ...]
+
+
+@lru_cache
+def _copy_plan(columns: tuple[str, ...]) -> _CopyPlan:
+    types = [_copy_type(_TELEMETRY_TABLE.columns[name].type) for name in columns]
+    column_list = ", ".join(f'"{name}"' for name in columns)
+    # Rows are copied into a temporary table of the connection and moved to
+    # telemetrydata with one INSERT
+    stage = f"telemetrydata_stage_{zlib.crc32(column_list.encode()):08x}"
+    return _CopyPlan(
+        create_statement=(
+            f"CREATE TEMPORARY TABLE IF NOT EXISTS {stage} ON COMMIT DELETE ROWS"
+            f" AS SELECT {column_list} FROM telemetrydata WITH NO DATA"
+        ),
+        statement=f"COPY {stage} ({column_list}) FROM STDIN (FORMAT BINARY)",
+        direct_statement=(
+            f"COPY telemetrydata ({column_list}) FROM STDIN (FORMAT BINARY)"
+        ),
+        insert_statement=(
+            f"INSERT INTO telemetrydata ({column_list})"
+            f" SELECT {column_list} FROM {stage} ON CONFLICT DO NOTHING"
+        ),
+        truncate_statement=f"TRUNCATE {stage}",
+        types=types,
+        datetime_indexes=tuple(
+            i for i, pg_type in enumerate(types) if pg_type == "timestamp"
+        ),
+    )
+
+
+def _naive_utc(value: datetime | None) -> datetime | None:
+    """Timestamp columns are WITHOUT TIME ZONE and hold UTC values"""
+    if value is None or value.tzinfo is None:
+        return value
+    return value.astimezone(tz.utc).replace(tzinfo=None)
+
+
+async def _save_objects(session: AsyncSession, objects: list[TelemetryData]) -> None:
+    await session.run_sync(lambda sync_session: sync_session.bulk_save_objects(objects))
+
+
+def _is_duplicate(error: exc.IntegrityError) -> bool:
+    return isinstance(error.orig, psycopg.errors.UniqueViolation)
+
+
+async def _write_orm(
+    session: AsyncSession, columns: tuple[str, ...], rows: Sequence[Row]
+) -> int:
+    objects = [TelemetryData(**dict(zip(columns, row, strict=True))) for row in rows]
+    if not settings.TELEMETRY_DEDUPLICATE:
+        await _save_objects(session, objects)
+        return len(objects)
+    try:
+        async with session.begin_nested():
+            await _save_objects(session, objects)
+        return len(objects)
+    except exc.IntegrityError as e:
+        if not _is_duplicate(e):
+            raise
+    # A report of the batch was stored already, save them one at a time
+    inserted = 0
+    for telemetry in objects:
+        try:
+            async with session.begin_nested():
+                await _save_objects(session, [telemetry])
+            inserted += 1
+        except exc.IntegrityError as e:
+            if not _is_duplicate(e):
+                raise
+    return inserted
+
+
+async def _write_insert(
+    session: AsyncSession, columns: tuple[str, ...], rows: Sequence[Row]
+) -> int:
+    # A list of parameter sets is sent as batched multi-row VALUES clauses
+    statement = insert(TelemetryData)
+    if settings.TELEMETRY_DEDUPLICATE:
+        statement = statement.on_conflict_do_nothing()
+    result = await session.execute(
+        statement.returning(_TELEMETRY_TABLE.c.id),
+        [dict(zip(columns, row, strict=True)) for row in rows],
+    )
+    return len(result.all())
+
+
+async def _write_copy(
+    session: AsyncSession, columns: tuple[str, ...], rows: Sequence[Row]
+) -> int:
+    plan = _copy_plan(columns)
+    # COPY runs on the session's own connection, so it joins its transaction
+    connection = await session.connection()
+    raw_connection = await connection.get_raw_connection()
+    driver_connection = raw_connection.driver_connection
+    assert isinstance(driver_connection, psycopg.AsyncConnection)
+    deduplicate = settings.TELEMETRY_DEDUPLICATE
+    statement = plan.create_statement if deduplicate else plan.direct_statement
+    try:
+        async with driver_connection.cursor() as cursor:
+            if deduplicate:
+                await cursor.execute(statement)
+                statement = plan.statement
+            async with cursor.copy(statement) as copy:
+                copy.set_types(plan.types)
+                for row in rows:
+                    values = list(row)
+                    for i in plan.datetime_indexes:
+                        values[i] = _naive_utc(values[i])
+                    await copy.write_row(values)
+            if not deduplicate:
+                return len(rows)
+            statement = plan.insert_statement
+            await cursor.execute(statement)
+            inserted = cursor.rowcount
+            # Later batches of the same transaction reuse the stage
+            statement = plan.truncate_statement
+            await cursor.execute(statement)
+    except psycopg.Error as e:
+        # Surface driver errors like the ones raised through SQLAlchemy
+        raise exc.DBAPIError.instance(statement, None, e, psycopg.Error) from e
+    return inserted
+
+
+_WRITERS = {
+    "orm": _write_orm,
+    "insert": _write_insert,
+    "copy": _write_copy,
+}
+
+
+async def write_telemetry(
+    session: AsyncSession,
+    columns: Sequence[str],
+    rows: Sequence[Row],
+    strategy: WriteStrategy | None = None,
+) -> int:
+    """
+    Write telemetry rows in the session's transaction, without committing.
+
+    Each row is a tuple of values in the order of ``columns``. Returns the
+    number of rows inserted, rows that were already stored are not counted.
+    Late reports get the rollups refreshed over their days after the commit.
+    """
+    if not rows:
+        return 0
+    columns = tuple(columns)
+    inserted = await _WRITERS[strategy or settings.TELEMETRY_WRITE_STRATEGY](
+        session, columns, rows
+    )
+    if "timestamp" in columns:
+        index = columns.index("timestamp")
+        add_late_reports(session, (_naive_utc(row[index]) for row in rows))
+    return inserted
@@ -0,0 +1,105 @@
+"""
+Standalone ingest worker.
+
+Drains the local ingest spool into the database from separate processes, so
+API workers only validate and accept reports. Run it next to API containers
+that share the spool directory and have INGEST_SPOOL_REPLAY_ENABLED=false:
+
+    python -m app.ingest_worker --processes 2 --batch-size 10000
+"""
+
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import signal
+from pathlib import Path
+
+from app.core.config import settings
+from app.core.db import async_engine
+from app.ingest.devices import device_listener
+from app.ingest.rollups import rollup_refresher
+from app.ingest.spool import SpoolReplayer
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+async def replay_until_stopped(batch_size: int) -> None:
+    replayer = SpoolReplayer(
+        Path(settings.INGEST_SPOOL_DIR),
+        batch_size=batch_size,
+        poll_interval=settings.INGEST_FLUSH_INTERVAL_MS / 1000,
+    )
+    stopped = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stopped.set)
+
+    if settings.DEVICE_CACHE_LISTEN_ENABLED:
+        device_listener.start()
+    rollup_refresher.start()
+    replayer.start()
+    await stopped.wait()
+    await replayer.stop()
+    await device_listener.stop()
+    await rollup_refresher.stop()
+    await async_engine.dispose()
+    logger.info(
+        "Ingest worker stopped, %d rows replayed, %d failed",
+        replayer.replayed,
+        replayer.failed,
+    )
+
+
+def run_worker(batch_size: int) -> None:
+    asyncio.run(replay_until_stopped(batch_size))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Drain the ingest spool")
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=settings.INGEST_WORKER_PROCESSES,
+        help="Number of replay processes",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=settings.INGEST_BATCH_SIZE,
+        help="Maximum number of rows written per transaction",
+    )
+    args = parser.parse_args()
+
+    logger.info(
+        "Starting %d ingest worker processes on %s",
+        args.processes,
+        settings.INGEST_SPOOL_DIR,
+    )
+    if args.processes == 1:
+        run_worker(args.batch_size)
+        return
+
+    # Segments are claimed with flock, so processes never replay the same one
+    context = multiprocessing.get_context("spawn")
+    processes = [
+        context.Process(target=run_worker, args=(args.batch_size,), daemon=False)
+        for _ in range(args.processes)
+    ]
+
+    def terminate(_signum: int, _frame: object) -> None:
+        for process in processes:
+            process.terminate()
+
+    # Children handle signals themselves, the parent waits for them to finish
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    for process in processes:
+        process.start()
+    signal.signal(signal.SIGTERM, terminate)
+    for process in processes:
+        process.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,6 @@
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
+
 import sentry_sdk
 from fastapi import FastAPI
 from fastapi.routing import APIRoute
@@ -5,6 +8,11 @@ from starlette.middleware.cors import CORSMiddleware
 
 from app.api.main import api_router
 from app.core.config import settings
+from app.core.db import async_engine
+from app.ingest.devices import device_listener
+from app.ingest.queue import ingest_queue
+from app.ingest.rollups import rollup_refresher
+from app.ingest.spool import ingest_spool, spool_replayer
 
 
 def custom_generate_unique_id(route: APIRoute) -> str:
@@ -14,10 +22,32 @@ def custom_generate_unique_id(route: APIRoute) -> str:
 if settings.SENTRY_DSN and settings.ENVIRONMENT != "local":
     sentry_sdk.init(dsn=str(settings.SENTRY_DSN), enable_tracing=True)
 
+
+@asynccontextmanager
+async def lifespan(_app: FastAPI) -> AsyncIterator[None]:
+    if settings.INGEST_SPOOL_ENABLED:
+        ingest_spool.start()
+        if settings.INGEST_SPOOL_REPLAY_ENABLED:
+            spool_replayer.start()
+    elif settings.INGEST_QUEUE_ENABLED:
+        ingest_queue.start()
+    if settings.DEVICE_CACHE_LISTEN_ENABLED:
+        device_listener.start()
+    rollup_refresher.start()
+    yield
+    await device_listener.stop()
+    await ingest_spool.stop()
+    await spool_replayer.stop()
+    await ingest_queue.stop()
+    await rollup_refresher.stop()
+    await async_engine.dispose()
+
+
 app = FastAPI(
     title=settings.PROJECT_NAME,
     openapi_url=f"{settings.API_V1_STR}/openapi.json",
     generate_unique_id_function=custom_generate_unique_id,
+    lifespan=lifespan,
 )
 
 # Set all CORS enabled origins
@@ -28,6 +58,8 @@ if settings.all_cors_origins:
         allow_credentials=True,
         allow_methods=["*"],
         allow_headers=["*"],
+        # Telemetry page cursors, reports accepted by a failed upload
+        expose_headers=["X-Next-Cursor", "X-Prev-Cursor", "X-Reports-Accepted"],
     )
 
 app.include_router(api_router, prefix=settings.API_V1_STR)
@@ -5,11 +5,12 @@ Data models for the application
 import uuid
 from datetime import datetime
 from datetime import timezone as tz
-from typing import Any
+from typing import Any, Optional
 
 from pydantic import EmailStr
-from sqlalchemy import Integer, PrimaryKeyConstraint
-from sqlmodel import JSON, Column, Field, Relationship, SQLModel
+from sqlalchemy import BigInteger, Float, Index, Integer, PrimaryKeyConstraint
+from sqlalchemy.dialects.postgresql import ARRAY, JSONB
+from sqlmodel import Column, Field, Relationship, SQLModel
 
 
 def utcnow() -> datetime:
@@ -157,6 +158,22 @@ class TokenPayload(SQLModel):
     sub: str | None = None
 
 
+# Ingest queue metrics
+class IngestQueueStats(SQLModel):
+    """Ingest queue metrics"""
+
+    depth: int
+    max_rows: int
+    enqueued: int
+    flushed: int
+    duplicates: int
+    dropped: int
+    failed: int
+    batches: int
+    last_flush_seconds: float
+    max_flush_seconds: float
+
+
 class NewPassword(SQLModel):
     """New password"""
 
@@ -198,22 +215,45 @@ class Device(DeviceBase, table=True):
 
     id: uuid.UUID = Field(default_factory=uuid.uuid4, primary_key=True)
     provider_device_id: str | None = Field(
-        None, description="Unique identifier of the external device"
+        None,
+        unique=True,
+        index=True,
+        description="Unique identifier of the external device",
     )
     device_name: str = Field(max_length=255)
-    last_reported_latitude: float | None = None
-    last_reported_longitude: float | None = None
-    is_online: bool = True
-    last_online_timestamp: datetime | None
     owner_id: uuid.UUID = Field(
         foreign_key="user.id", nullable=False, ondelete="CASCADE"
     )
     owner: User | None = Relationship(back_populates="devices")
+    state: Optional["DeviceState"] = Relationship(
+        back_populates="device",
+        cascade_delete=True,
+        sa_relationship_kwargs={"uselist": False},
+    )
     telemetry_data: list["TelemetryData"] = Relationship(
         back_populates="device", cascade_delete=True
     )
 
 
+# Rewritten by every report, kept apart from the device metadata. The table
+# has a low fillfactor and no index on these columns, so updates are HOT.
+class DeviceState(SQLModel, table=True):
+    """Database model for the last known state of devices"""
+
+    __tablename__ = "device_state"
+
+    device_id: uuid.UUID = Field(
+        foreign_key="device.id", primary_key=True, ondelete="CASCADE"
+    )
+    last_online_timestamp: datetime | None = None
+    last_reported_latitude: float | None = None
+    last_reported_longitude: float | None = None
+    last_reported_speed: float | None = None
+    engine_ignition_status: bool | None = None
+    is_online: bool = True
+    device: Device | None = Relationship(back_populates="state")
+
+
 # Properties to return via API, id is always required
 class DevicePublic(DeviceBase):
     """Properties to return via API"""
@@ -236,8 +276,9 @@ class DevicesPublic(SQLModel):
     count: int
 
 
-class TelemetryData(SQLModel, table=True):
-    """Database model for telemetry data"""
+# Shared properties
+class TelemetryDataBase(SQLModel):
+    """Base telemetry data properties"""
 
     id: int = Field(default=None, sa_column=Column(Integer, autoincrement=True))
     storage_server_timestamp_utc: datetime = Field(default_factory=utcnow)
@@ -296,8 +337,44 @@ class TelemetryData(SQLModel, table=True):
     accumulator_13: float | None = None
     accumulator_14: float | None = None
     accumulator_15: float | None = None
-    raw_data: dict[str, Any] | None = Field(sa_column=Column(JSON))
+    raw_data: dict[str, Any] | None = Field(sa_column=Column(JSONB))
     device_id: uuid.UUID = Field(foreign_key="device.id", nullable=False)
+
+
+# Database model, database table inferred from class name
+class TelemetryData(TelemetryDataBase, table=True):
+    """Database model for telemetry data"""
+
+    # Accumulators packed in one array instead of the accumulator_N columns,
+    # with TELEMETRY_ACCUMULATORS=array
+    accumulators: list[float | None] | None = Field(
+        default=None, sa_column=Column(ARRAY(Float))
+    )
     device: Device | None = Relationship(back_populates="telemetry_data")
 
-    __table_args__ = (PrimaryKeyConstraint("id", "timestamp"),)
+    __table_args__ = (
+        PrimaryKeyConstraint("id", "timestamp"),
+        # Resent reports are skipped on insert
+        Index(
+            "uq_telemetrydata_device_id_timestamp_event_seqnum",
+            "device_id",
+            "timestamp",
+            "event_seqnum",
+            unique=True,
+        ),
+        # Keyset pagination of reads by (timestamp, id)
+        Index("ix_telemetrydata_timestamp_id", "timestamp", "id"),
+    )
+
+
+# Properties to return via API, packed accumulators are returned unpacked
+class TelemetryDataPublic(TelemetryDataBase):
+    """Properties to return via API"""
+
+
+class SpoolCheckpoint(SQLModel, table=True):
+    """Replay position of an ingest spool segment"""
+
+    segment: str = Field(primary_key=True, max_length=255)
+    position: int = Field(sa_column=Column(BigInteger, nullable=False))
+    updated_at: datetime = Field(default_factory=utcnow)
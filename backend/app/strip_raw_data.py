@@ -0,0 +1,138 @@
+"""
+Strip mapped fields from stored telemetrydata raw_data.
+
+Rows ingested with INGEST_RAW_DATA=full keep the whole report in raw_data,
+including every key already stored in a typed column. This removes those keys
+from existing rows one hypertable chunk at a time, oldest first, so each
+statement only touches the chunk it updates. Within a chunk rows are updated
+in ranges of ids, one transaction per range, so it can run next to ingest and
+be resumed from a chunk with --start:
+
+    python -m app.strip_raw_data --batch-size 50000 --start 2024-01-01
+
+Compressed chunks are decompressed, stripped and compressed again, which needs
+the disk space of the uncompressed chunk meanwhile. A chunk left uncompressed
+by an interrupted run is compressed again by the compression policy. The space
+freed is reused once the rows are vacuumed.
+"""
+
+import argparse
+import logging
+import time
+from datetime import datetime, timezone
+
+from sqlalchemy import Connection, text
+
+from app.core.db import engine
+from app.ingest.mapping import MAPPED_SOURCES
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+_CHUNKS = text(
+    "SELECT format('%I.%I', chunk_schema, chunk_name), range_start, range_end,"
+    " is_compressed"
+    " FROM timescaledb_information.chunks"
+    " WHERE hypertable_name = 'telemetrydata'"
+    " ORDER BY range_start"
+)
+_DECOMPRESS = text("SELECT decompress_chunk(CAST(:chunk AS regclass), TRUE)")
+_COMPRESS = text("SELECT compress_chunk(CAST(:chunk AS regclass), TRUE)")
+
+
+def strip_range(connection: Connection, chunk: str, start: int, end: int) -> int:
+    """Strip the mapped keys of the rows of a chunk with start <= id < end"""
+    # Rows left without any key get a NULL raw_data. The chunk name comes
+    # from the TimescaleDB catalog, quoted.
+    statement = text(
+        f"UPDATE {chunk}"
+        " SET raw_data = NULLIF(raw_data - CAST(:keys AS text[]), CAST('{}' AS jsonb))"
+        " WHERE id >= :start AND id < :end AND raw_data ?| CAST(:keys AS text[])"
+    )
+    result = connection.execute(
+        statement, {"keys": sorted(MAPPED_SOURCES), "start": start, "end": end}
+    )
+    return result.rowcount
+
+
+def strip_chunk(chunk: str, batch_size: int, pause: float) -> int:
+    """Strip the mapped keys of the rows of an uncompressed chunk"""
+    with engine.connect() as connection:
+        first_id, last_id = connection.execute(
+            text(f"SELECT min(id), max(id) FROM {chunk}")
+        ).one()
+    stripped = 0
+    if first_id is None:
+        return stripped
+    start = first_id
+    while start <= last_id:
+        end = start + batch_size
+        with engine.begin() as connection:
+            stripped += strip_range(connection, chunk, start, end)
+        start = end
+        if pause:
+            time.sleep(pause)
+    return stripped
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Remove mapped fields from stored raw_data"
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=10_000,
+        help="Number of ids updated per transaction",
+    )
+    parser.add_argument(
+        "--start",
+        type=datetime.fromisoformat,
+        default=None,
+        help="Skip the chunks ending at or before this time",
+    )
+    parser.add_argument(
+        "--pause",
+        type=float,
+        default=0.0,
+        help="Seconds to wait between transactions",
+    )
+    args = parser.parse_args()
+
+    with engine.connect() as connection:
+        chunks = connection.execute(_CHUNKS).all()
+    if args.start is not None:
+        # Chunk ranges are timestamptz, a time without offset is UTC
+        start = args.start
+        if start.tzinfo is None:
+            start = start.replace(tzinfo=timezone.utc)
+        chunks = [chunk for chunk in chunks if chunk[2] > start]
+    if not chunks:
+        logger.info("No telemetry data to strip")
+        return
+
+    stripped = 0
+    for number, (chunk, range_start, range_end, is_compressed) in enumerate(chunks, 1):
+        if is_compressed:
+            with engine.begin() as connection:
+                connection.execute(_DECOMPRESS, {"chunk": chunk})
+        updated = strip_chunk(chunk, args.batch_size, args.pause)
+        if is_compressed:
+            with engine.begin() as connection:
+                connection.execute(_COMPRESS, {"chunk": chunk})
+        stripped += updated
+        logger.info(
+            "Chunk %d/%d %s (%s to %s%s): %d rows updated",
+            number,
+            len(chunks),
+            chunk,
+            range_start,
+            range_end,
+            ", recompressed" if is_compressed else "",
+            updated,
+        )
+    logger.info("Done, %d rows updated", stripped)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,32 @@
+from fastapi.testclient import TestClient
+
+from app.core.config import settings
+from app.tests.utils.utils import random_lower_string
+
+
+def test_create_device_duplicate_provider_device_id(
+    client: TestClient, superuser_token_headers: dict[str, str]
+) -> None:
+    data = {
+        "device_name": "Foo",
+        "provider_device_id": random_lower_string(),
+        "last_online_timestamp": None,
+    }
+    response = client.post(
+        f"{settings.API_V1_STR}/devices/",
+        headers=superuser_token_headers,
+        json=data,
+    )
+    assert response.status_code == 200
+    assert response.json()["provider_device_id"] == data["provider_device_id"]
+
+    response = client.post(
+        f"{settings.API_V1_STR}/devices/",
+        headers=superuser_token_headers,
+        json=data,
+    )
+    assert response.status_code == 409
+    assert (
+        response.json()["detail"]
+        == "Device with this provider_device_id already exists"
+    )
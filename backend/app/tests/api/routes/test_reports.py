@@ -0,0 +1,446 @@
+import io
+import json
+import time
+from datetime import datetime, timezone
+from typing import Any
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlmodel import Session, func, select
+
+from app.core.config import settings
+from app.ingest.queue import ingest_queue
+from app.models import Device, DeviceState, TelemetryData
+from app.tests.utils.utils import random_lower_string
+
+
+def make_reports(provider_device_id: str, count: int) -> list[dict[str, Any]]:
+    return [
+        {
+            "timestamp": 1727000000 + i,
+            "server.timestamp": 1727000001 + i,
+            "device.id": provider_device_id,
+            "device.name": "Truck",
+            "position.latitude": 4.6 + i,
+            "position.longitude": -74.0,
+            "event.seqnum": i,
+        }
+        for i in range(count)
+    ]
+
+
+def test_receive_report_batch_upserts_device_once(
+    client: TestClient, db: Session, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(settings, "INGEST_QUEUE_ENABLED", False)
+    provider_device_id = random_lower_string()
+    reports = make_reports(provider_device_id, 3)
+    response = client.post(f"{settings.API_V1_STR}/reports/reports/", json=reports)
+    assert response.status_code == 200
+
+    devices = db.exec(
+        select(Device).where(Device.provider_device_id == provider_device_id)
+    ).all()
+    assert len(devices) == 1
+    device = devices[0]
+    state = db.get(DeviceState, device.id)
+    assert state is not None
+    assert state.last_reported_latitude == 6.6
+
+    count = db.exec(
+        select(func.count())
+        .select_from(TelemetryData)
+        .where(TelemetryData.device_id == device.id)
+    ).one()
+    assert count == 3
+
+
+def test_receive_report_skips_resent_reports(
+    client: TestClient, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(settings, "INGEST_QUEUE_ENABLED", False)
+    reports = make_reports(random_lower_string(), 3)
+    response = client.post(f"{settings.API_V1_STR}/reports/reports/", json=reports[:2])
+    assert response.json()["inserted"] == 2
+    response = client.post(f"{settings.API_V1_STR}/reports/reports/", json=reports)
+    assert response.status_code == 200
+    content = response.json()
+    assert content["inserted"] == 1
+    assert content["duplicates"] == 2
+
+
+@pytest.mark.parametrize("strategy", ["orm", "insert"])
+def test_receive_report_skips_resent_reports_with_strategy(
+    client: TestClient, monkeypatch: pytest.MonkeyPatch, strategy: str
+) -> None:
+    monkeypatch.setattr(settings, "INGEST_QUEUE_ENABLED", False)
+    monkeypatch.setattr(settings, "TELEMETRY_WRITE_STRATEGY", strategy)
+    reports = make_reports(random_lower_string(), 3)
+    response = client.post(f"{settings.API_V1_STR}/reports/reports/", json=reports[:2])
+    assert response.json()["inserted"] == 2
+    response = client.post(f"{settings.API_V1_STR}/reports/reports/", json=reports)
+    assert response.status_code == 200
+    assert response.json()["inserted"] == 1
+
+
+def test_read_packed_accumulators(
+    client: TestClient, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(settings, "INGEST_QUEUE_ENABLED", False)
+    monkeypatch.setattr(settings, "TELEMETRY_ACCUMULATORS", "array")
+    ident = random_lower_string()
+    reports = make_reports(random_lower_string(), 1)
+    reports[0].update({"ident": ident, "accumulator.1": 12.5})
+    response = client.post(f"{settings.API_V1_STR}/reports/reports/", json=reports)
+    assert response.status_code == 200
+
+    response = client.get(
+        f"{settings.API_V1_STR}/reports/reports/", params={"ident": ident}
+    )
+    assert response.status_code == 200
+    [row] = response.json()
+    assert row["accumulator_0"] is None
+    assert row["accumulator_1"] == 12.5
+    assert "accumulators" not in row
+
+
+def test_read_reports_fields(
+    client: TestClient, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(settings, "INGEST_QUEUE_ENABLED", False)
+    monkeypatch.setattr(settings, "INGEST_RAW_DATA", "full")
+    ident = random_lower_string()
+    reports = make_reports(random_lower_string(), 1)
+    reports[0]["ident"] = ident
+    response = client.post(f"{settings.API_V1_STR}/reports/reports/", json=reports)
+    assert response.status_code == 200
+
+    url = f"{settings.API_V1_STR}/reports/reports/"
+    response = client.get(url, params={"ident": ident})
+    [row] = response.json()
+    assert "raw_data" not in row
+    assert row["position_latitude"] == 4.6
+
+    response = client.get(
+        url, params={"ident": ident, "fields": "position_latitude,raw_data"}
+    )
+    [row] = response.json()
+    assert list(row) == ["position_latitude", "raw_data"]
+    assert row["raw_data"]["event.seqnum"] == 0
+
+    response = client.get(url, params={"ident": ident, "fields": "password"})
+    assert response.status_code == 400
+
+
+def test_read_reports_cursor_pages(
+    client: TestClient, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(settings, "INGEST_QUEUE_ENABLED", False)
+    ident = random_lower_string()
+    reports = make_reports(random_lower_string(), 5)
+    for report in reports:
+        report["ident"] = ident
+    response = client.post(f"{settings.API_V1_STR}/reports/reports/", json=reports)
+    assert response.status_code == 200
+
+    url = f"{settings.API_V1_STR}/reports/reports/"
+    params: dict[str, Any] = {"ident": ident, "limit": 2, "order": "asc"}
+    response = client.get(url, params=params)
+    assert [row["event_seqnum"] for row in response.json()] == [0, 1]
+    assert "X-Prev-Cursor" not in response.headers
+
+    response = client.get(
+        url, params={**params, "cursor": response.headers["X-Next-Cursor"]}
+    )
+    assert [row["event_seqnum"] for row in response.json()] == [2, 3]
+
+    next_cursor = response.headers["X-Next-Cursor"]
+    response = client.get(
+        url, params={**params, "cursor": response.headers["X-Prev-Cursor"]}
+    )
+    assert [row["event_seqnum"] for row in response.json()] == [0, 1]
+
+    response = client.get(url, params={**params, "cursor": next_cursor})
+    assert [row["event_seqnum"] for row in response.json()] == [4]
+    assert "X-Next-Cursor" not in response.headers
+
+    response = client.get(url, params={**params, "cursor": "not-a-cursor"})
+    assert response.status_code == 400
+
+
+def test_export_reports(client: TestClient, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(settings, "INGEST_QUEUE_ENABLED", False)
+    monkeypatch.setattr(settings, "TELEMETRY_EXPORT_BATCH_SIZE", 2)
+    ident = random_lower_string()
+    reports = make_reports(random_lower_string(), 5)
+    for report in reports:
+        report["ident"] = ident
+    response = client.post(f"{settings.API_V1_STR}/reports/reports/", json=reports)
+    assert response.status_code == 200
+
+    url = f"{settings.API_V1_STR}/reports/reports/export/"
+    params = {"ident": ident, "fields": "event_seqnum,position_latitude"}
+    response = client.get(url, params=params)
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert [line["event_seqnum"] for line in lines] == [0, 1, 2, 3, 4]
+
+    response = client.get(url, params={**params, "format": "csv"})
+    assert response.status_code == 200
+    assert response.text.splitlines() == [
+        "event_seqnum,position_latitude",
+        "0,4.6",
+        "1,5.6",
+        "2,6.6",
+        "3,7.6",
+        "4,8.6",
+    ]
+
+
+def test_read_reports_columnar(
+    client: TestClient, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    pyarrow = pytest.importorskip("pyarrow")
+    parquet = pytest.importorskip("pyarrow.parquet")
+    monkeypatch.setattr(settings, "INGEST_QUEUE_ENABLED", False)
+    ident = random_lower_string()
+    reports = make_reports(random_lower_string(), 3)
+    for report in reports:
+        report["ident"] = ident
+    response = client.post(f"{settings.API_V1_STR}/reports/reports/", json=reports)
+    assert response.status_code == 200
+
+    params = {"ident": ident, "fields": "event_seqnum,timestamp,raw_data"}
+    response = client.get(
+        f"{settings.API_V1_STR}/reports/reports/",
+        params={**params, "order": "asc"},
+        headers={"Accept": "application/vnd.apache.arrow.stream"},
+    )
+    assert response.status_code == 200
+    table = pyarrow.ipc.open_stream(response.content).read_all()
+    assert table.schema.names == ["event_seqnum", "timestamp", "raw_data"]
+    assert table.column("event_seqnum").to_pylist() == [0, 1, 2]
+
+    response = client.get(
+        f"{settings.API_V1_STR}/reports/reports/export/",
+        params={**params, "format": "parquet"},
+    )
+    assert response.status_code == 200
+    table = parquet.read_table(io.BytesIO(response.content))
+    assert table.column("event_seqnum").to_pylist() == [0, 1, 2]
+    assert pyarrow.types.is_timestamp(table.schema.field("timestamp").type)
+
+
+def test_aggregate_reports(client: TestClient, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(settings, "INGEST_QUEUE_ENABLED", False)
+    ident = random_lower_string()
+    reports = make_reports(random_lower_string(), 5)
+    for report in reports:
+        report["ident"] = ident
+    response = client.post(f"{settings.API_V1_STR}/reports/reports/", json=reports)
+    assert response.status_code == 200
+
+    # The reports are at 10:13:20 to 10:13:24
+    url = f"{settings.API_V1_STR}/reports/reports/aggregate/"
+    params: dict[str, Any] = {
+        "ident": ident,
+        "fields": "position_latitude",
+        "timestamp_from": "2024-09-22T10:13:00",
+        "timestamp_to": "2024-09-22T10:14:00",
+        "bucket": 20,
+    }
+    response = client.get(url, params=params)
+    assert response.status_code == 200
+    [row] = response.json()
+    assert row["bucket"] == "2024-09-22T10:13:20"
+    assert row["count"] == 5
+    assert row["position_latitude_min"] == 4.6
+    assert row["position_latitude_max"] == 8.6
+    assert row["position_latitude_last"] == 8.6
+
+    response = client.get(url, params={**params, "gapfill": True})
+    rows = response.json()
+    assert [row["count"] for row in rows] == [None, 5, None]
+    assert [row["position_latitude_last"] for row in rows] == [None, 8.6, 8.6]
+
+    response = client.get(url, params={**params, "fields": "ident"})
+    assert response.status_code == 400
+
+
+def test_aggregate_reports_mixed_bounds(
+    client: TestClient, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(settings, "INGEST_QUEUE_ENABLED", False)
+    ident = random_lower_string()
+    reports = make_reports(random_lower_string(), 5)
+    for report in reports:
+        report["ident"] = ident
+    response = client.post(f"{settings.API_V1_STR}/reports/reports/", json=reports)
+    assert response.status_code == 200
+
+    # One bound with an offset and one without, both 10:13:00 to 10:14:00 UTC
+    response = client.get(
+        f"{settings.API_V1_STR}/reports/reports/aggregate/",
+        params={
+            "ident": ident,
+            "fields": "position_latitude",
+            "timestamp_from": "2024-09-22T12:13:00+02:00",
+            "timestamp_to": "2024-09-22T10:14:00",
+            "bucket": 60,
+        },
+    )
+    assert response.status_code == 200
+    [row] = response.json()
+    assert row["bucket"] == "2024-09-22T10:13:00"
+    assert row["count"] == 5
+
+
+def test_aggregate_reports_from_rollup(
+    client: TestClient, db: Session, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(settings, "INGEST_QUEUE_ENABLED", False)
+    provider_device_id = random_lower_string()
+    # Reports of the current hour are above the rollup watermark
+    hour = int(time.time()) // 3600 * 3600
+    reports = make_reports(provider_device_id, 5)
+    for i, report in enumerate(reports):
+        report["timestamp"] = hour + i
+        report["position.speed"] = 36.0
+    response = client.post(f"{settings.API_V1_STR}/reports/reports/", json=reports)
+    assert response.status_code == 200
+    device = db.exec(
+        select(Device).where(Device.provider_device_id == provider_device_id)
+    ).one()
+
+    # Buckets of whole hours are read from the hourly rollup, the reports
+    # span 4 seconds at 36 km/h
+    url = f"{settings.API_V1_STR}/reports/reports/aggregate/"
+    params: dict[str, Any] = {
+        "device_id": str(device.id),
+        "fields": "position_speed,distance_km",
+        "timestamp_from": datetime.fromtimestamp(hour, timezone.utc).isoformat(),
+        "timestamp_to": datetime.fromtimestamp(hour + 3600, timezone.utc).isoformat(),
+        "bucket": 3600,
+    }
+    response = client.get(url, params=params)
+    assert response.status_code == 200
+    [row] = response.json()
+    start = datetime.fromtimestamp(hour, timezone.utc)
+    assert row["bucket"] == start.replace(tzinfo=None).isoformat()
+    assert row["count"] == 5
+    assert row["position_speed_avg"] == 36.0
+    assert row["distance_km"] == pytest.approx(0.04)
+
+    response = client.get(url, params={**params, "bucket": 60})
+    assert response.status_code == 400
+
+
+def test_aggregate_reports_aligned_history(
+    client: TestClient, db: Session, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(settings, "INGEST_QUEUE_ENABLED", False)
+    provider_device_id = random_lower_string()
+    reports = make_reports(provider_device_id, 5)
+    for report in reports:
+        report["position.speed"] = 36.0
+    response = client.post(f"{settings.API_V1_STR}/reports/reports/", json=reports)
+    assert response.status_code == 200
+    device = db.exec(
+        select(Device).where(Device.provider_device_id == provider_device_id)
+    ).one()
+
+    # Old reports may be missing from the materialized rollup, aligned and
+    # unaligned ranges are both read from the reports
+    url = f"{settings.API_V1_STR}/reports/reports/aggregate/"
+    params: dict[str, Any] = {
+        "device_id": str(device.id),
+        "fields": "position_speed",
+        "timestamp_from": "2024-09-22T10:00:00",
+        "timestamp_to": "2024-09-22T11:00:00",
+        "bucket": 3600,
+    }
+    aligned = client.get(url, params=params).json()
+    unaligned = client.get(
+        url, params={**params, "timestamp_to": "2024-09-22T10:59:59"}
+    ).json()
+    assert [row["count"] for row in aligned] == [5]
+    assert aligned == unaligned
+
+
+def test_receive_report_missing_fields(client: TestClient) -> None:
+    response = client.post(
+        f"{settings.API_V1_STR}/reports/reports/", json={"timestamp": 1727000000}
+    )
+    assert response.status_code == 400
+    assert "device.id" in response.json()["detail"]
+
+
+def test_receive_report_integer_out_of_range(client: TestClient) -> None:
+    [report] = make_reports(random_lower_string(), 1)
+    report["event.seqnum"] = 2**31
+    response = client.post(f"{settings.API_V1_STR}/reports/reports/", json=report)
+    assert response.status_code == 400
+    assert "out of range" in response.json()["detail"]
+
+
+def test_receive_report_queued(client: TestClient, db: Session) -> None:
+    provider_device_id = random_lower_string()
+    reports = make_reports(provider_device_id, 2)
+    response = client.post(f"{settings.API_V1_STR}/reports/reports/", json=reports)
+    assert response.status_code == 202
+    assert response.json()["status"] == "accepted"
+
+    deadline = time.monotonic() + 5
+    while ingest_queue.depth and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert ingest_queue.depth == 0
+
+    device = db.exec(
+        select(Device).where(Device.provider_device_id == provider_device_id)
+    ).one()
+    count = db.exec(
+        select(func.count())
+        .select_from(TelemetryData)
+        .where(TelemetryData.device_id == device.id)
+    ).one()
+    assert count == 2
+
+
+def test_receive_report_malformed_tail(
+    client: TestClient, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(settings, "INGEST_CHUNK_SIZE", 2)
+    reports = make_reports(random_lower_string(), 3)
+    body = b"".join(json.dumps(report).encode() + b"\n" for report in reports)
+    headers = {"Content-Type": "application/x-ndjson"}
+    response = client.post(
+        f"{settings.API_V1_STR}/reports/reports/",
+        content=body + b'{"timestamp": ',
+        headers=headers,
+    )
+    assert response.status_code == 400
+    # The first chunk was queued before the tail was parsed
+    assert response.headers["X-Reports-Accepted"] == "2"
+
+    monkeypatch.setattr(settings, "INGEST_QUEUE_ENABLED", False)
+    response = client.post(
+        f"{settings.API_V1_STR}/reports/reports/",
+        content=body + b'{"timestamp": ',
+        headers=headers,
+    )
+    assert response.status_code == 400
+    assert response.headers["X-Reports-Accepted"] == "0"
+
+
+def test_read_ingest_stats(
+    client: TestClient, superuser_token_headers: dict[str, str]
+) -> None:
+    response = client.get(
+        f"{settings.API_V1_STR}/reports/ingest-stats/",
+        headers=superuser_token_headers,
+    )
+    assert response.status_code == 200
+    content = response.json()
+    assert content["max_rows"] == settings.INGEST_QUEUE_MAX_ROWS
+    assert "dropped" in content
@@ -0,0 +1,38 @@
+from app.benchmarks.fleet import Fleet
+from app.benchmarks.results import compare_results, latency_summary
+from app.ingest.mapping import extract_rows
+
+
+def test_fleet_reports_are_valid_and_reproducible() -> None:
+    reports = list(Fleet(3, start=1727000000, seed=1).reports(30))
+    assert reports == list(Fleet(3, start=1727000000, seed=1).reports(30))
+    assert len(extract_rows(reports)) == 30
+
+    device_reports = [r for r in reports if r["device.id"] == "bench-000000"]
+    assert len(device_reports) == 10
+    assert all(
+        later["event.seqnum"] == earlier["event.seqnum"] + 1
+        and later["timestamp"] > earlier["timestamp"]
+        for earlier, later in zip(device_reports, device_reports[1:], strict=False)
+    )
+
+
+def test_fleet_batches() -> None:
+    batches = list(Fleet(2, start=1727000000).batches(5, 2))
+    assert [len(batch) for batch in batches] == [2, 2, 1]
+
+
+def test_latency_summary_and_compare() -> None:
+    summary = latency_summary([i / 1000 for i in range(1, 101)])
+    assert summary["p50"] == 50.5
+    assert summary["max"] == 100.0
+    assert latency_summary([0.002])["p99"] == 2.0
+
+    [(result, change)] = compare_results(
+        [{"mode": "http", "rate": 150.0}, {"mode": "new", "rate": 1.0}],
+        [{"mode": "http", "rate": 100.0}],
+        ["mode"],
+        "rate",
+    )
+    assert result["mode"] == "http"
+    assert change == 0.5
@@ -1,15 +1,23 @@
+import os
+import shutil
+import tempfile
 from collections.abc import Generator
 
-import pytest
-from fastapi.testclient import TestClient
-from sqlmodel import Session, delete
+# The test run gets a shared device cache of its own, set before the app reads
+# its settings, so it never reads or clears the cache of an app on the host
+_device_cache_dir = tempfile.mkdtemp(prefix="test-device-cache-")
+os.environ["DEVICE_CACHE_SHARED_PATH"] = os.path.join(_device_cache_dir, "devices")
 
-from app.core.config import settings
-from app.core.db import engine, init_db
-from app.main import app
-from app.models import Item, User
-from app.tests.utils.user import authentication_token_from_email
-from app.tests.utils.utils import get_superuser_token_headers
+import pytest  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+from sqlmodel import Session, delete  # noqa: E402
+
+from app.core.config import settings  # noqa: E402
+from app.core.db import engine, init_db  # noqa: E402
+from app.main import app  # noqa: E402
+from app.models import Device, Item, TelemetryData, User  # noqa: E402
+from app.tests.utils.user import authentication_token_from_email  # noqa: E402
+from app.tests.utils.utils import get_superuser_token_headers  # noqa: E402
 
 
 @pytest.fixture(scope="session", autouse=True)
@@ -17,11 +25,16 @@ def db() -> Generator[Session, None, None]:
     with Session(engine) as session:
         init_db(session)
         yield session
+        statement = delete(TelemetryData)
+        session.execute(statement)
+        statement = delete(Device)
+        session.execute(statement)
         statement = delete(Item)
         session.execute(statement)
         statement = delete(User)
         session.execute(statement)
         session.commit()
+    shutil.rmtree(_device_cache_dir, ignore_errors=True)
 
 
 @pytest.fixture(scope="module")
@@ -0,0 +1,70 @@
+import uuid
+from pathlib import Path
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import Session
+
+from app.ingest.devices import (
+    CachedDevice,
+    DeviceCache,
+    SharedDeviceCache,
+    add_pending_devices,
+    device_cache,
+)
+
+
+def make_device() -> CachedDevice:
+    return CachedDevice(uuid.uuid4(), uuid.uuid4())
+
+
+def test_device_cache_evicts_least_recently_used() -> None:
+    cache = DeviceCache(max_size=2, ttl=60)
+    cache.put_many({"a": make_device(), "b": make_device()})
+    cache.get_many(["a"])
+    cache.put_many({"c": make_device()})
+    assert set(cache.get_many(["a", "b", "c"])) == {"a", "c"}
+    assert (cache.hits, cache.misses) == (3, 1)
+
+
+def test_device_cache_expires_and_invalidates() -> None:
+    cache = DeviceCache(max_size=10, ttl=0)
+    cache.put_many({"a": make_device()})
+    assert cache.get_many(["a"]) == {}
+
+    cache = DeviceCache(max_size=10, ttl=60)
+    cache.put_many({"a": make_device()})
+    cache.invalidate("a")
+    assert cache.get_many(["a"]) == {}
+
+
+def test_pending_devices_cached_on_commit_only() -> None:
+    engine = create_engine("sqlite://")
+    committed, rolled_back = make_device(), make_device()
+    with Session(engine) as session:
+        session.execute(text("SELECT 1"))
+        add_pending_devices(session, {"rolled-back": rolled_back})
+        session.rollback()
+        session.execute(text("SELECT 1"))
+        add_pending_devices(session, {"committed": committed})
+        session.commit()
+    assert device_cache.get_many(["committed", "rolled-back"]) == {
+        "committed": committed
+    }
+    device_cache.clear()
+
+
+def test_shared_device_cache_across_instances(tmp_path: Path) -> None:
+    writer = SharedDeviceCache(tmp_path / "devices", max_size=4, ttl=60)
+    reader = SharedDeviceCache(tmp_path / "devices", max_size=4, ttl=60)
+    devices = {f"device-{i}": make_device() for i in range(20)}
+    writer.put_many(devices)
+    found = reader.get_many(devices)
+    assert found and all(devices[key] == device for key, device in found.items())
+
+    key = next(iter(found))
+    writer.invalidate(key)
+    assert key not in reader.get_many([key])
+    writer.put_many({key: devices[key]})
+    assert reader.get_many([key]) == {key: devices[key]}
+    writer.clear()
+    assert reader.get_many(devices) == {}
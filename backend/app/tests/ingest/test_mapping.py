@@ -0,0 +1,92 @@
+from datetime import datetime
+from typing import Any
+
+import pytest
+
+from app.ingest.mapping import (
+    ROW_COLUMNS,
+    extract_columns,
+    extract_row,
+    extract_rows,
+    pack_accumulators,
+)
+
+
+def test_extract_row_converts_values() -> None:
+    report = {
+        "timestamp": 1727000000,
+        "server.timestamp": 1727000001.5,
+        "device.id": 42,
+        "engine.ignition.status": "true",
+        "position.satellites": 7.0,
+        "accumulator.3": 1,
+    }
+    row = dict(zip(ROW_COLUMNS, extract_row(report), strict=True))
+    assert row["timestamp"] == datetime(2024, 9, 22, 10, 13, 20)
+    assert row["server_timestamp"] == datetime(2024, 9, 22, 10, 13, 21, 500000)
+    assert row["provider_device_id"] == "42"
+    assert row["engine_ignition_status"] is True
+    assert row["position_satellites"] == 7
+    assert row["accumulator_3"] == 1.0
+    assert row["raw_data"] is report
+
+
+def test_extract_rows_keeps_unmapped_raw_data() -> None:
+    report = {
+        "timestamp": 1727000000,
+        "server.timestamp": 1727000001,
+        "device.id": 1,
+        "custom.flag": True,
+    }
+    mapped = {
+        key: report[key] for key in ("timestamp", "server.timestamp", "device.id")
+    }
+    rows = extract_rows([report, mapped], raw_data="unmapped")
+    raw_data = [dict(zip(ROW_COLUMNS, row, strict=True))["raw_data"] for row in rows]
+    assert raw_data == [{"custom.flag": True}, None]
+    assert rows[0][:-1] == extract_row(report)[:-1]
+
+
+def test_extract_row_defaults() -> None:
+    report = {"timestamp": 1727000000, "server.timestamp": 1727000001, "device.id": 1}
+    row = dict(zip(ROW_COLUMNS, extract_row(report), strict=True))
+    assert row["ident"] == "unknown_device"
+    assert row["engine_ignition_status"] is False
+    assert row["position_latitude"] is None
+
+
+def test_extract_rows_missing_fields() -> None:
+    with pytest.raises(ValueError, match="server.timestamp, device.id"):
+        extract_rows([{"timestamp": 1727000000}])
+
+
+def test_extract_rows_rejects_integers_out_of_range() -> None:
+    report = {"timestamp": 1727000000, "server.timestamp": 1727000001, "device.id": 1}
+    row = extract_rows([{**report, "event.seqnum": 2**31 - 1}])[0]
+    assert row[ROW_COLUMNS.index("event_seqnum")] == 2**31 - 1
+    with pytest.raises(ValueError, match="out of range"):
+        extract_rows([{**report, "event.seqnum": 2**31}])
+    with pytest.raises(ValueError, match="out of range"):
+        extract_columns(
+            {**{k: [v] for k, v in report.items()}, "din": [-(2**31) - 1]}, 1
+        )
+
+
+def test_extract_columns_matches_extract_row() -> None:
+    columns: dict[str, list[Any]] = {
+        "timestamp": [1727000000, 1727000010],
+        "server.timestamp": [1727000001, 1727000011],
+        "device.id": ["a", "b"],
+        "engine.ignition.status": [None, True],
+        "custom.flag": [1, 2],
+    }
+    rows = extract_columns(columns, 2)
+    reports = [{key: values[i] for key, values in columns.items()} for i in range(2)]
+    for row, report in zip(rows, reports, strict=True):
+        assert row[:-1] == extract_row(report)[:-1]
+    assert rows[1][-1] == {"custom.flag": 2}
+
+
+def test_pack_accumulators_drops_trailing_nulls() -> None:
+    assert pack_accumulators([None, 2.0, None, None]) == [None, 2.0]
+    assert pack_accumulators([None] * 16) is None
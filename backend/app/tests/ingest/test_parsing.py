@@ -0,0 +1,258 @@
+import asyncio
+import gzip
+import json
+from collections.abc import AsyncIterator
+from typing import Any
+
+import pytest
+
+from app.ingest import parsing
+from app.ingest.mapping import ROW_COLUMNS
+from app.ingest.parsing import (
+    PayloadTooLargeError,
+    decode_body,
+    iter_report_chunks,
+    iter_row_chunks,
+)
+
+
+async def stream(data: bytes, size: int = 7) -> AsyncIterator[bytes]:
+    for i in range(0, len(data), size):
+        yield data[i : i + size]
+
+
+def parse(
+    data: bytes, content_type: str | None, chunk_size: int
+) -> list[list[dict[str, Any]]]:
+    async def collect() -> list[list[dict[str, Any]]]:
+        return [
+            chunk
+            async for chunk in iter_report_chunks(
+                stream(data), content_type, chunk_size
+            )
+        ]
+
+    return asyncio.run(collect())
+
+
+def test_parse_json_array_in_chunks() -> None:
+    data = json.dumps([{"device.id": i, "position.speed": 1.5} for i in range(10)])
+    chunks = parse(data.encode(), "application/json", 4)
+    assert [len(chunk) for chunk in chunks] == [4, 4, 2]
+    assert chunks[2][1] == {"device.id": 9, "position.speed": 1.5}
+
+
+def test_parse_streamed_json_array(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(parsing, "BUFFERED_JSON_LIMIT", 16)
+    data = json.dumps([{"device.id": i} for i in range(10)])
+    chunks = parse(data.encode(), "application/json", 4)
+    assert [len(chunk) for chunk in chunks] == [4, 4, 2]
+    assert chunks[0][0] == {"device.id": 0}
+
+
+def test_parse_single_json_object() -> None:
+    chunks = parse(b' {"device.id": 1, "peer": {"ip": "10.0.0.1"}}', None, 4)
+    assert chunks == [[{"device.id": 1, "peer": {"ip": "10.0.0.1"}}]]
+
+
+def test_parse_ndjson() -> None:
+    data = b"\n".join(json.dumps({"device.id": i}).encode() for i in range(5))
+    chunks = parse(data, "application/x-ndjson; charset=utf-8", 2)
+    assert [len(chunk) for chunk in chunks] == [2, 2, 1]
+
+
+def test_parse_msgpack() -> None:
+    msgpack = pytest.importorskip("msgpack")
+    data = b"".join(msgpack.packb({"device.id": i}) for i in range(5))
+    chunks = parse(data, "application/msgpack", 2)
+    assert chunks[2] == [{"device.id": 4}]
+
+
+def test_parse_truncated_msgpack() -> None:
+    msgpack = pytest.importorskip("msgpack")
+    data = b"".join(msgpack.packb({"device.id": i}) for i in range(10))
+    with pytest.raises(ValueError, match="Truncated"):
+        parse(data[:-5], "application/msgpack", 2)
+
+
+def test_parse_arrow_stream_into_rows() -> None:
+    pyarrow = pytest.importorskip("pyarrow")
+    table = pyarrow.table(
+        {
+            "timestamp": [1727000000, 1727000001, 1727000002],
+            "server.timestamp": [1727000001, 1727000002, 1727000003],
+            "device.id": ["a", "b", "c"],
+            "position.speed": [1.5, None, 3.0],
+        }
+    )
+    sink = pyarrow.BufferOutputStream()
+    with pyarrow.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+
+    async def collect() -> list[list[tuple[object, ...]]]:
+        return [
+            rows
+            async for rows in iter_row_chunks(
+                stream(sink.getvalue().to_pybytes(), 64),
+                "application/vnd.apache.arrow.stream",
+                2,
+            )
+        ]
+
+    chunks = asyncio.run(collect())
+    assert [len(rows) for rows in chunks] == [2, 1]
+    speed = ROW_COLUMNS.index("position_speed")
+    assert [rows[0][speed] for rows in chunks] == [1.5, 3.0]
+
+
+def report_table(pyarrow: Any, count: int) -> Any:
+    return pyarrow.table(
+        {
+            "timestamp": [1727000000 + i for i in range(count)],
+            "server.timestamp": [1727000001 + i for i in range(count)],
+            "device.id": [str(i) for i in range(count)],
+            "position.speed": [float(i) for i in range(count)],
+        }
+    )
+
+
+def arrow_stream(pyarrow: Any, table: Any, batch_size: int) -> bytes:
+    sink = pyarrow.BufferOutputStream()
+    with pyarrow.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table, max_chunksize=batch_size)
+    data: bytes = sink.getvalue().to_pybytes()
+    return data
+
+
+def test_parse_arrow_stream_incrementally() -> None:
+    pyarrow = pytest.importorskip("pyarrow")
+    table = report_table(pyarrow, 1000)
+    data = arrow_stream(pyarrow, table, 100)
+    received = []
+
+    async def body() -> AsyncIterator[bytes]:
+        async for chunk in stream(data, 256):
+            received.append(len(chunk))
+            yield chunk
+
+    async def first_rows() -> list[tuple[object, ...]]:
+        chunks = iter_row_chunks(body(), "application/vnd.apache.arrow.stream", 100)
+        return await anext(chunks)
+
+    rows = asyncio.run(first_rows())
+    assert len(rows) == 100
+    assert sum(received) < len(data) / 2
+
+
+def test_parse_arrow_stream_body_size_limit() -> None:
+    pyarrow = pytest.importorskip("pyarrow")
+    table = report_table(pyarrow, 10_000)
+    data = gzip.compress(arrow_stream(pyarrow, table, 1000))
+
+    async def collect() -> None:
+        async for _ in iter_row_chunks(
+            decode_body(stream(data, 256), "gzip", 10_000),
+            "application/vnd.apache.arrow.stream",
+            1000,
+        ):
+            pass
+
+    with pytest.raises(PayloadTooLargeError):
+        asyncio.run(collect())
+
+
+def test_parse_parquet_into_rows(monkeypatch: pytest.MonkeyPatch) -> None:
+    pyarrow = pytest.importorskip("pyarrow")
+    parquet = pytest.importorskip("pyarrow.parquet")
+    # Spill the body to disk
+    monkeypatch.setattr(parsing, "BUFFERED_BODY_LIMIT", 100)
+    table = report_table(pyarrow, 250)
+    sink = pyarrow.BufferOutputStream()
+    parquet.write_table(table, sink, row_group_size=100)
+
+    async def collect() -> list[list[tuple[object, ...]]]:
+        return [
+            rows
+            async for rows in iter_row_chunks(
+                stream(sink.getvalue().to_pybytes(), 64),
+                "application/vnd.apache.parquet",
+                100,
+            )
+        ]
+
+    chunks = asyncio.run(collect())
+    assert [len(rows) for rows in chunks] == [100, 100, 50]
+    speed = ROW_COLUMNS.index("position_speed")
+    assert chunks[2][-1][speed] == 249.0
+
+
+def test_parse_invalid_parquet() -> None:
+    pytest.importorskip("pyarrow")
+
+    async def collect() -> None:
+        async for _ in iter_row_chunks(
+            stream(b"not parquet"), "application/vnd.apache.parquet", 100
+        ):
+            pass
+
+    with pytest.raises(ValueError, match="Invalid Parquet"):
+        asyncio.run(collect())
+
+
+def decode(data: bytes, content_encoding: str | None, max_size: int) -> bytes:
+    async def collect() -> bytes:
+        return b"".join(
+            [
+                chunk
+                async for chunk in decode_body(stream(data), content_encoding, max_size)
+            ]
+        )
+
+    return asyncio.run(collect())
+
+
+def test_decode_gzip_body() -> None:
+    data = json.dumps([{"device.id": i} for i in range(100)]).encode()
+    assert decode(gzip.compress(data), "gzip", len(data)) == data
+
+
+def test_decode_body_size_limit() -> None:
+    data = gzip.compress(b" " * 1_000_000)
+    with pytest.raises(PayloadTooLargeError):
+        decode(data, "gzip", 100_000)
+
+
+def test_decode_truncated_gzip_body() -> None:
+    data = b"".join(b'{"device.id": %d}\n' % i for i in range(100))
+    compressed = gzip.compress(data)
+    with pytest.raises(ValueError, match="Truncated"):
+        decode(compressed[:-8], "gzip", len(data))
+    with pytest.raises(ValueError, match="Unexpected data"):
+        decode(compressed + b"{}", "gzip", len(data))
+
+
+def test_decode_zstd_body() -> None:
+    zstandard = pytest.importorskip("zstandard")
+    data = b"".join(b'{"device.id": %d}\n' % i for i in range(100))
+    compressed = zstandard.ZstdCompressor().compress(data)
+    assert decode(compressed, "zstd", len(data)) == data
+    with pytest.raises(ValueError, match="Truncated"):
+        decode(compressed[:-5], "zstd", len(data))
+
+
+def test_decode_zstd_body_size_limit() -> None:
+    zstandard = pytest.importorskip("zstandard")
+    data = zstandard.ZstdCompressor().compress(b" " * 32 * 1024 * 1024)
+    sizes: list[int] = []
+
+    async def collect() -> None:
+        async for chunk in parsing._unzstd(stream(data, 6 * 1024), 100_000):
+            sizes.append(len(chunk))
+            if sum(sizes) > 100_000:
+                break
+
+    asyncio.run(collect())
+    # The body isn't decompressed much past the limit before it is checked
+    assert sum(sizes) < 100_000 + 128 * 1024
+    with pytest.raises(PayloadTooLargeError):
+        decode(data, "zstd", 100_000)
@@ -0,0 +1,61 @@
+import asyncio
+from collections.abc import Sequence
+
+from sqlalchemy import exc
+
+from app.ingest.mapping import Row
+from app.ingest.pipeline import IngestUnavailableError
+from app.ingest.queue import IngestQueue
+
+
+def test_queue_drops_only_failing_rows() -> None:
+    flushed: list[Row] = []
+
+    async def flush(rows: Sequence[Row]) -> int:
+        if (3,) in rows:
+            raise ValueError("bad row")
+        flushed.extend(rows)
+        return len(rows)
+
+    queue = IngestQueue(
+        flush, max_rows=100, batch_size=10, flush_interval=60, put_timeout=1
+    )
+
+    async def run() -> None:
+        queue.start()
+        await queue.put([(i,) for i in range(8)])
+        await queue.stop()
+
+    asyncio.run(run())
+    assert sorted(flushed) == [(i,) for i in range(8) if i != 3]
+    assert (queue.flushed, queue.failed, queue.batches) == (7, 1, 1)
+    assert queue.depth == 0
+
+
+def test_queue_retries_batch_on_unavailable_database() -> None:
+    flushed: list[Row] = []
+    errors = [
+        exc.TimeoutError("pool exhausted"),
+        IngestUnavailableError("Superuser not found"),
+    ]
+
+    async def flush(rows: Sequence[Row]) -> int:
+        if errors:
+            raise errors.pop(0)
+        flushed.extend(rows)
+        return len(rows)
+
+    queue = IngestQueue(
+        flush, max_rows=100, batch_size=10, flush_interval=0.01, put_timeout=1
+    )
+
+    async def run() -> None:
+        queue.start()
+        await queue.put([(i,) for i in range(8)])
+        while len(flushed) < 8:
+            await asyncio.sleep(0.01)
+        await queue.stop()
+
+    asyncio.run(asyncio.wait_for(run(), timeout=5))
+    assert sorted(flushed) == [(i,) for i in range(8)]
+    assert (queue.flushed, queue.failed, queue.batches) == (8, 0, 1)
@@ -0,0 +1,27 @@
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy.orm import Session
+
+from app.ingest.rollups import PENDING_ROLLUP_DAYS, _day_ranges, add_late_reports
+
+
+def test_add_late_reports_records_days() -> None:
+    session = Session()
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    add_late_reports(
+        session,
+        [datetime(2024, 9, 22, 10, 13), datetime(2024, 9, 22, 23, 59), None, now],
+    )
+    assert session.info[PENDING_ROLLUP_DAYS] == {datetime(2024, 9, 22)}
+
+    session = Session()
+    add_late_reports(session, [now - timedelta(minutes=5)])
+    assert PENDING_ROLLUP_DAYS not in session.info
+
+
+def test_day_ranges_merge_consecutive_days() -> None:
+    days = [datetime(2024, 9, day) for day in (5, 1, 2, 3)]
+    assert list(_day_ranges(days)) == [
+        (datetime(2024, 9, 1), datetime(2024, 9, 4)),
+        (datetime(2024, 9, 5), datetime(2024, 9, 6)),
+    ]
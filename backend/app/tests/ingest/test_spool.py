@@ -0,0 +1,125 @@
+import asyncio
+import threading
+from datetime import datetime
+from pathlib import Path
+
+import pytest
+from sqlmodel import Session, func, select
+
+from app.core.config import settings
+from app.core.db import async_engine
+from app.ingest.mapping import ROW_COLUMNS, extract_rows
+from app.ingest.spool import (
+    SpoolReplayer,
+    SpoolWriter,
+    _OpenSegment,
+    encode_record,
+    read_records,
+)
+from app.models import Device, TelemetryData
+from app.tests.utils.utils import random_lower_string
+
+
+def test_spool_writer_seals_segments(tmp_path: Path) -> None:
+    writer = SpoolWriter(
+        tmp_path, segment_bytes=1, segment_interval=60, fsync_interval=0
+    )
+    rows = [(1, datetime(2024, 9, 22, 10, 13, 20), {"device.id": "a"})]
+
+    async def spool() -> None:
+        writer.start()
+        await asyncio.gather(writer.put(rows), writer.put(rows))
+        await writer.put(rows)
+        await writer.stop()
+
+    asyncio.run(spool())
+    segments = sorted(tmp_path.glob("*.seg"))
+    assert not list(tmp_path.glob("*.seg.open"))
+    with open(segments[0], "rb") as file:
+        assert [records for _, records in read_records(file, 0)] == [rows, rows]
+    assert writer.spooled == 3
+
+
+def test_read_records_stops_at_torn_record(tmp_path: Path) -> None:
+    path = tmp_path / "1.seg"
+    record = encode_record([(1,), (2,)])
+    path.write_bytes(record + record[:-3])
+    with open(path, "rb") as file:
+        assert list(read_records(file, 0)) == [(len(record), [(1,), (2,)])]
+        assert list(read_records(file, len(record))) == []
+
+
+def test_seal_abandoned_segments(tmp_path: Path) -> None:
+    (tmp_path / "1.seg.open").write_bytes(encode_record([(1,)]))
+    replayer = SpoolReplayer(tmp_path, batch_size=10, poll_interval=1)
+    replayer.seal_abandoned()
+    assert [path.name for path in tmp_path.iterdir()] == ["1.seg"]
+
+
+def test_seal_abandoned_skips_segments_being_created(tmp_path: Path) -> None:
+    replayer = SpoolReplayer(tmp_path, batch_size=10, poll_interval=1)
+    stop = threading.Event()
+
+    def seal() -> None:
+        while not stop.is_set():
+            replayer.seal_abandoned()
+
+    thread = threading.Thread(target=seal)
+    thread.start()
+    try:
+        for _ in range(200):
+            segment = _OpenSegment(tmp_path)
+            assert segment.path.exists()
+            # Removed while still locked, a replayer can't seal it either
+            segment.path.unlink()
+            segment.file.close()
+    finally:
+        stop.set()
+        thread.join()
+    assert not list(tmp_path.iterdir())
+
+
+def test_replay_dead_letters_failing_rows(
+    tmp_path: Path, db: Session, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(settings, "TELEMETRY_WRITE_STRATEGY", "insert")
+    provider_device_id = random_lower_string()
+    rows = extract_rows(
+        [
+            {
+                "timestamp": 1727000000 + i,
+                "server.timestamp": 1727000001 + i,
+                "device.id": provider_device_id,
+                "event.seqnum": i,
+            }
+            for i in range(10)
+        ]
+    )
+    # Out of the range of the int4 column, the database rejects it
+    seqnum = ROW_COLUMNS.index("event_seqnum")
+    poison = (*rows[5][:seqnum], 2**31, *rows[5][seqnum + 1 :])
+    path = tmp_path / "1.seg"
+    path.write_bytes(
+        encode_record(rows[:4])
+        + encode_record([rows[4], poison, *rows[6:8]])
+        + encode_record(rows[8:])
+    )
+    replayer = SpoolReplayer(tmp_path, batch_size=4, poll_interval=1)
+
+    async def replay() -> int:
+        written = await replayer.replay_segment(path)
+        await async_engine.dispose()
+        return written
+
+    assert asyncio.run(replay()) == 9
+    assert (replayer.replayed, replayer.failed) == (9, 1)
+    assert not path.exists()
+    with open(tmp_path / "1.dead", "rb") as file:
+        assert [records for _, records in read_records(file, 0)] == [[poison]]
+    count = db.exec(
+        select(func.count())
+        .select_from(TelemetryData)
+        .join(Device)
+        .where(Device.provider_device_id == provider_device_id)
+    ).one()
+    assert count == 9